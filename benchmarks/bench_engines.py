@@ -0,0 +1,55 @@
+"""Compares the execution engines of VirtualMachineV2 on a call loop.
+
+    python benchmarks/bench_engines.py [instructions]
+"""
+import sys
+import time
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t
+
+# 0x0000: mov 0x0100 -> Reg01, call Reg01, mov 0x0000 -> IP
+# 0x0100: push Reg01, pop Reg01, 8 x noop, ret
+MAIN = b'\x08\x01\x00\x03\x09\x03\x08\x00\x00\x00'
+SUB = b'\x06\x03\x07\x03' + b'\x90' * 8 + b'\x0a'
+
+ENGINES = [
+    ("run_program", {}),
+    ("run_program", {"trace": False}),
+    ("run_blocks", {}),
+    ("run_fast", {}),
+]
+
+
+def bench(engine: str, instructions: int, **kwargs):
+
+    vm = cvm.VirtualMachineV2(max_instructions=instructions, max_run_time=None, **kwargs)
+    vm.load_program((uint16_t(0x0100), SUB), "sub")
+    vm.load_program((uint16_t(0x0000), MAIN))
+
+    started_at = time.perf_counter()
+    getattr(vm, engine)()
+    elapsed = time.perf_counter() - started_at
+
+    assert vm.instruction_count == instructions
+
+    return elapsed
+
+
+def main(instructions: int = 200000):
+
+    baseline = None
+
+    for (engine, kwargs) in ENGINES:
+        elapsed = bench(engine, instructions, **kwargs)
+        baseline = baseline or elapsed
+
+        options = ", ".join(f"{key}={value}" for key, value in kwargs.items())
+        name = f"{engine}({options})"
+
+        print(f"{name : <30} {instructions / elapsed : >12,.0f} instr/s {baseline / elapsed : >6.1f}x")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,274 @@
+"""Benchmark suite for the interpreter, memory subsystem and VM lifecycle.
+
+    python benchmarks/bench_suite.py [--output results.json]
+                                     [--baseline baseline.json] [--threshold 0.1]
+
+Every workload is run a number of times per engine. Only the engine call
+is timed, building or restoring the VM before it is reported separately as
+setup. The report has the instructions per second of the median run, the
+median and 90th percentile run times, the median setup time and the peak
+memory allocated during one extra, untimed, run. Workloads that are not
+executed time their setup as the run. With --baseline the results are
+compared against an earlier --output file and the exit status is 1 if the
+median latency or peak memory of any workload grew by more than the
+threshold.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t
+from cors_vm.challenge import EXPLOIT, load_challenge
+
+ENGINES = ("run_program", "run_fast", "run_blocks")
+
+# Instructions executed by every run of the looping workloads
+INSTRUCTIONS = 50000
+
+# Jump back to 0x0000, mov 0x0000 -> IP
+LOOP = b'\x08\x00\x00\x00'
+
+
+def push_pop():
+    # 0x0000: push Reg01, pop Reg01, loop
+
+    return cvm.VirtualMachineV2(b'\x06\x03\x07\x03' + LOOP, trace=False,
+                                max_instructions=INSTRUCTIONS, max_run_time=None)
+
+
+def call_chain(depth: int = 256):
+    # 0x0000: call f_0, loop. f_i calls f_i+1, the last one returns
+    # at once, so every loop is depth + 1 calls and as many returns.
+
+    vm = cvm.VirtualMachineV2(trace=False, max_instructions=INSTRUCTIONS, max_run_time=None)
+
+    base = 0x1000
+
+    for i in range(depth):
+        callee = (base + 8 * (i + 1)).to_bytes(2, 'big')
+        vm.load_program((uint16_t(base + 8 * i), b'\x08' + callee + b'\x03\x09\x03\x0a'), f"f_{i}")
+
+    vm.load_program((uint16_t(base + 8 * depth), b'\x0a'), f"f_{depth}")
+    vm.load_program((uint16_t(0x0000), b'\x08' + base.to_bytes(2, 'big') + b'\x03\x09\x03' + LOOP))
+
+    return vm
+
+
+def noop_sled(length: int = 0x4000):
+    # 0x0000: length x noop, loop
+
+    return cvm.VirtualMachineV2(b'\x90' * length + LOOP, trace=False,
+                                max_instructions=INSTRUCTIONS, max_run_time=None)
+
+
+def printing():
+    # 0x0000: out 0x2000, loop
+
+    vm = cvm.VirtualMachineV2(b'\x03\x20\x00' + LOOP, trace=False,
+                              max_instructions=INSTRUCTIONS, max_run_time=None)
+    vm.load_data((uint16_t(0x2000), b"Anslutningen avslutas.\x00", "con_close"))
+
+    return vm
+
+
+def lifecycle():
+    # The exploitation challenge of vm.py, before the payload is loaded
+    return load_challenge(cvm.VirtualMachineV2(trace=False))
+
+
+def input_overflow():
+    # fake_input() overflows the 256 byte buffer and returns into the
+    # payload, which calls secret_func
+
+    vm = lifecycle()
+    vm.load_data((uint16_t(0x2000), EXPLOIT, "user_func"))
+
+    return vm
+
+
+# input_overflow VM and its snapshot, built once by restored_overflow()
+_prewarmed = list()
+
+
+def restored_overflow():
+    # input_overflow returned to its snapshot by restore() instead of
+    # being built again
+
+    if not _prewarmed:
+        vm = input_overflow()
+        _prewarmed.append((vm, vm.snapshot()))
+
+    (vm, snapshot) = _prewarmed[0]
+    vm.restore(snapshot)
+
+    return vm
+
+
+# name -> (function returning a ready VM, whether the engine runs it)
+WORKLOADS = {
+    "push_pop": (push_pop, True),
+    "call_chain": (call_chain, True),
+    "noop_sled": (noop_sled, True),
+    "printing": (printing, True),
+    "input_overflow": (input_overflow, True),
+    "restored_overflow": (restored_overflow, True),
+    "lifecycle": (lifecycle, False),
+}
+
+
+def percentile(samples: list, percent: float):
+    # Nearest rank percentile of sorted samples
+
+    index = max(0, min(len(samples) - 1, round(percent / 100 * len(samples)) - 1))
+
+    return samples[index]
+
+
+def run_once(workload, engine: str, execute: bool):
+    # Returns (setup seconds, run seconds, instructions) of one
+    # construction and run
+
+    started_at = time.perf_counter()
+
+    vm = workload()
+
+    setup = time.perf_counter() - started_at
+
+    if not execute:
+        return (0.0, setup, vm.instruction_count)
+
+    run = getattr(vm, engine)
+
+    started_at = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started_at
+
+    if vm.halt_reason not in (None, cvm.HaltReason.HALT, cvm.HaltReason.INSTRUCTION_LIMIT):
+        raise RuntimeError(f"Workload stopped with {vm.halt_reason.value}.")
+
+    return (setup, elapsed, vm.instruction_count)
+
+
+def bench(name: str, engine: str, repeat: int):
+
+    (workload, execute) = WORKLOADS[name]
+
+    setups = list()
+    timings = list()
+    instructions = 0
+
+    for _ in range(repeat):
+        (setup, elapsed, instructions) = run_once(workload, engine, execute)
+        setups.append(setup)
+        timings.append(elapsed)
+
+    setups.sort()
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        run_once(workload, engine, execute)
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median = percentile(timings, 50)
+
+    return {"instructions": instructions,
+            "instructions_per_second": instructions / median if instructions else None,
+            "p50_ms": 1000 * median,
+            "p90_ms": 1000 * percentile(timings, 90),
+            "setup_ms": 1000 * percentile(setups, 50),
+            "peak_memory_kb": peak / 1024}
+
+
+def run_suite(names=None, engines=ENGINES, repeat: int = 5):
+    # Returns the results keyed by "workload[engine]". Workloads that are
+    # not executed only run once, under the first engine.
+
+    results = dict()
+
+    for name in names or WORKLOADS:
+        (_, execute) = WORKLOADS[name]
+
+        for engine in (engines if execute else engines[:1]):
+            key = f"{name}[{engine}]" if execute else name
+            results[key] = bench(name, engine, repeat)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    # Returns (key, metric, baseline value, value) for every result more
+    # than threshold worse than the baseline
+
+    regressions = list()
+
+    for (key, result) in results.items():
+        if key not in baseline:
+            continue
+
+        before = baseline[key]
+
+        if before["p50_ms"] and result["p50_ms"] > before["p50_ms"] * (1 + threshold):
+            regressions.append((key, "p50_ms", before["p50_ms"], result["p50_ms"]))
+
+        if before["peak_memory_kb"] and result["peak_memory_kb"] > before["peak_memory_kb"] * (1 + threshold):
+            regressions.append((key, "peak_memory_kb", before["peak_memory_kb"], result["peak_memory_kb"]))
+
+    return regressions
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the VM and compare against a baseline.')
+    parser.add_argument('--workload', action='append', choices=list(WORKLOADS),
+                        help='Workload to run, every workload by default')
+    parser.add_argument('--engine', action='append', choices=ENGINES,
+                        help='Engine to run, every engine by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Write the results as JSON')
+    parser.add_argument('--baseline', help='JSON written by --output to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed slowdown against the baseline, 0.1 is 10%%')
+
+    options = parser.parse_args(args)
+
+    results = run_suite(options.workload, tuple(options.engine or ENGINES), options.repeat)
+
+    print(f"{'Workload' : <32}{'instr/s' : >14}{'p50 ms' : >10}{'p90 ms' : >10}"
+          f"{'setup ms' : >10}{'peak KiB' : >10}")
+
+    for (key, result) in results.items():
+        per_second = result["instructions_per_second"]
+        per_second = f"{per_second : >14,.0f}" if per_second else f"{'-' : >14}"
+
+        print(f"{key : <32}{per_second}{result['p50_ms'] : >10.3f}{result['p90_ms'] : >10.3f}"
+              f"{result['setup_ms'] : >10.3f}{result['peak_memory_kb'] : >10.1f}")
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "results": results}, output, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)["results"], options.threshold)
+
+        for (key, metric, before, after) in regressions:
+            print(f"Regression: {key} {metric} {before:.3f} -> {after:.3f}")
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
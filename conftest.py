@@ -0,0 +1,39 @@
+import pytest
+
+import cors_vm.image as image
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.challenge import EXPLOIT, load_challenge
+from cors_vm.devices import InputDevice
+
+@pytest.fixture(params=["run_program", "run_fast", "run_blocks"])
+def engine(request):
+    # Name of the VirtualMachineV2 method running a program
+    return request.param
+
+@pytest.fixture
+def engine_of(engine):
+    # Returns the method of a VM that runs a program with engine
+    return lambda vm: getattr(vm, engine)
+
+@pytest.fixture
+def challenge():
+    # The challenge from vm.py, reading the user supplied data from 0x2000
+    return load_challenge(cvm.VirtualMachineV2())
+
+@pytest.fixture
+def challenge_image(challenge, tmp_path):
+    # The challenge from vm.py without the user supplied data, as an image
+    return image.write_image(challenge, tmp_path / 'challenge.img')
+
+@pytest.fixture
+def input_challenge():
+    # The challenge from vm.py, reading the user supplied data from an
+    # input device
+    return load_challenge(cvm.VirtualMachineV2(trace=False, input_device=InputDevice()))
+
+@pytest.fixture
+def exploit():
+    # Overflows the 256 byte buffer and returns into the code at its end,
+    # which calls secret_func
+    return EXPLOIT
@@ -1,7 +1,13 @@
 class uint8_t:
 
-    def __init__(self, value):
-        self._uint8 = value & 0xff
+    # Immutable, uint8_t(value) returns one of 256 shared instances
+    __slots__ = ('_uint8', )
+
+    def __new__(cls, value):
+        return _uint8_values[value & 0xff]
+
+    def __reduce__(self):
+        return (uint8_t, (self._uint8, ))
 
     def __repr__(self):
 
@@ -13,17 +19,30 @@ class uint8_t:
 
     @property
     def uint8(self):
-        return self._uint8 & 0xff
+        return self._uint8
 
     @property
     def val(self):
-        return self.uint8 & 0xff
-    
+        return self._uint8
+
+
+def _make_uint8(value):
+
+    byte = object.__new__(uint8_t)
+    byte._uint8 = value
+
+    return byte
+
+
+_uint8_values = tuple(_make_uint8(value) for value in range(256))
+
+
 class uint16_t:
 
+    __slots__ = ('_uint16', )
+
     def __init__(self, value):
-        self._lo_byte = (value & 0xff)
-        self._ho_byte = (value & 0xff00) >> 8
+        self._uint16 = value & 0xffff
 
     def __repr__(self):
 
@@ -35,7 +54,11 @@ class uint16_t:
 
 
     def __add__(self, other):
-        val = self.uint16 + other
+
+        if isinstance(other, uint16_t):
+            val = self.uint16 + other.uint16
+        else:
+            val = self.uint16 + other
 
         return uint16_t(val)
 
@@ -48,28 +71,40 @@ class uint16_t:
 
         return uint16_t(val)
 
+    # In-place arithmetic, changes and returns this instance without
+    # allocating a new one.
+
+    def iadd(self, other: int):
+        self.uint16 = self.uint16 + other
+
+        return self
+
+    def isub(self, other: int):
+        self.uint16 = self.uint16 - other
+
+        return self
+
     @property
     def lo_byte(self):
-        return self._lo_byte
-    
+        return self.uint16 & 0xff
+
     @property
     def ho_byte(self):
-        return self._ho_byte
-    
+        return self.uint16 >> 8
+
 
     @property
     def uint16(self):
-        return (self._ho_byte << 8) + self._lo_byte
-    
+        return self._uint16
+
     @uint16.setter
     def uint16(self, value):
 
-        self._lo_byte = value & 0xff
-        self._ho_byte = (value & 0xff00) >> 8
+        self._uint16 = value & 0xffff
 
     @property
     def val(self):
         return self.uint16
-    
+
     def as_tuple(self):
-        return (self._ho_byte, self._lo_byte)
+        return (self.ho_byte, self.lo_byte)
@@ -0,0 +1,185 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import pathlib
+import sys
+import time
+
+import cors_vm.image as image
+
+from cors_vm.devices import InputDevice
+
+# Jobs in flight per worker, bounds memory use with long job streams
+JOBS_PER_WORKER = 4
+
+# Options of the worker process, set by _init_worker()
+_worker_options: dict = dict()
+
+# Image path -> (vm, snapshot) kept warm by the worker process
+_prewarmed: dict = dict()
+
+
+def read_jobs(lines):
+    # Jobs from JSONL lines with an image path, an optional id and the
+    # payload as a hex string. Blank lines are skipped.
+
+    for (number, line) in enumerate(lines):
+        line = line.strip()
+
+        if not line:
+            continue
+
+        job = json.loads(line)
+        job.setdefault('id', number)
+
+        yield job
+
+
+def jobs_from_directory(path, image_path):
+    # One job per file in path, the file contents being the payload
+
+    for payload_path in sorted(pathlib.Path(path).iterdir()):
+        if payload_path.is_file():
+            yield {'id': payload_path.name,
+                   'image': str(image_path),
+                   'payload': payload_path.read_bytes().hex()}
+
+
+def _init_worker(options: dict):
+    _worker_options.update(options)
+
+
+def prewarmed_vm(image_path: str):
+    # The worker's VM for image_path, restored to the state of a freshly
+    # loaded image.
+
+    if image_path not in _prewarmed:
+        vm = image.load_image(image_path,
+                              track_dirty=True,
+                              trace=False,
+                              input_device=InputDevice(),
+                              **_worker_options.get('budgets', {}))
+
+        _prewarmed[image_path] = (vm, vm.snapshot())
+
+    (vm, snapshot) = _prewarmed[image_path]
+    vm.restore(snapshot)
+
+    return vm
+
+
+def run_job(job: dict):
+    # The payload is the guest's whole input, fed to its input device and
+    # closed. Every input instruction reads one line of it, so a 0x0a byte
+    # in the payload ends the line and the rest is left for the next read.
+
+    result = {'id': job.get('id'), 'image': job.get('image')}
+    started_at = time.perf_counter()
+
+    try:
+        vm = prewarmed_vm(job['image'])
+
+        vm.input_device.feed(bytes.fromhex(job.get('payload', '')))
+        vm.input_device.close()
+
+        vm.run(engine=getattr(vm, _worker_options.get('engine', 'run_fast')))
+
+        result.update(stdout=vm.stdout,
+                      halt_reason=vm.halt_reason.value if vm.halt_reason else None,
+                      instruction_count=vm.instruction_count,
+                      memory_writes=vm.memory_writes)
+
+    except Exception as err:
+        result['error'] = f"{type(err).__name__}: {err}"
+
+    result['time'] = time.perf_counter() - started_at
+
+    return result
+
+
+def run_jobs(jobs):
+    return [run_job(job) for job in jobs]
+
+
+def _chunks(jobs, size: int):
+
+    chunk = list()
+
+    for job in jobs:
+        chunk.append(job)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+
+    if chunk:
+        yield chunk
+
+
+def run_batch(jobs, workers: int = None, engine: str = 'run_fast', chunk_size: int = 1,
+              **budgets):
+    # Runs jobs across a process pool and yields the results in completion
+    # order. Jobs are sent to the workers chunk_size at a time. budgets are
+    # passed on to VirtualMachineV2, like max_instructions.
+
+    workers = workers or os.cpu_count() or 1
+    options = {'engine': engine, 'budgets': budgets}
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                initargs=(options, )) as pool:
+        pending = set()
+
+        for chunk in _chunks(jobs, chunk_size):
+            pending.add(pool.submit(run_jobs, chunk))
+
+            if len(pending) < workers * JOBS_PER_WORKER:
+                continue
+
+            (done, pending) = concurrent.futures.wait(pending,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Run VM jobs across a process pool, '
+                                                 'writing results as JSONL.')
+    parser.add_argument('jobs', help='JSONL file of jobs, - for stdin, or a directory of '
+                                     'payload files used with --image')
+    parser.add_argument('--image', help='VM image the payloads in a jobs directory run on')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--chunk-size', type=int, default=1)
+    parser.add_argument('--engine', default='run_fast',
+                        choices=['run_program', 'run_fast', 'run_blocks'])
+    parser.add_argument('--max-instructions', type=int)
+    parser.add_argument('--max-output-bytes', type=int)
+    parser.add_argument('--max-memory-writes', type=int)
+    parser.add_argument('--max-run-time', type=float)
+
+    options = parser.parse_args(args)
+
+    budgets = {name: getattr(options, name)
+               for name in ('max_instructions', 'max_output_bytes', 'max_memory_writes', 'max_run_time')
+               if getattr(options, name) is not None}
+
+    if os.path.isdir(options.jobs):
+        if options.image is None:
+            parser.error('--image is required with a jobs directory')
+
+        jobs = jobs_from_directory(options.jobs, options.image)
+    elif options.jobs == '-':
+        jobs = read_jobs(sys.stdin)
+    else:
+        jobs = read_jobs(pathlib.Path(options.jobs).read_text().splitlines())
+
+    for result in run_batch(jobs, options.workers, options.engine, options.chunk_size, **budgets):
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+import time
+from array import array
+
+import numpy as np
+
+import cors_vm.fast as fast
+
+from cors_vm.virtual_machine import HaltReason, INPUT_SIZE, IP, SP, BP
+
+# Runs many VMs in lockstep, see BatchedVM. Requires numpy, install with
+# the batched extra.
+
+# Halt reasons are stored as their index plus one, 0 is running
+HALT_REASONS = tuple(HaltReason)
+
+(HALT_CODE, INVALID_CODE, INSTRUCTION_LIMIT_CODE, TIME_LIMIT_CODE, OUTPUT_LIMIT_CODE,
+ MEMORY_WRITE_LIMIT_CODE, FAULT_CODE) = (HALT_REASONS.index(reason) + 1 for reason in (
+    HaltReason.HALT, HaltReason.INVALID_INSTRUCTION, HaltReason.INSTRUCTION_LIMIT,
+    HaltReason.TIME_LIMIT, HaltReason.OUTPUT_LIMIT, HaltReason.MEMORY_WRITE_LIMIT,
+    HaltReason.FAULT))
+
+DISPATCH = np.array(fast.DISPATCH, dtype=np.int8)
+
+NEVER = np.iinfo(np.int64).max
+
+
+class BatchedVM:
+    """ Runs N VirtualMachineV2 instances in lockstep.
+
+    Memory is kept as an (N, memory_size) uint8 array and registers as an
+    (N, registers) uint16 array. Every step executes one instruction of
+    each running instance, grouping instances by opcode so that each group
+    is executed with vectorized operations. Instances that halt, fault or
+    wait for input are retired from the batch. Memory and register
+    semantics, including faults, match the scalar engines.
+
+    All instances need the same memory size and number of registers, and a
+    single CPU. The
+    VMs are updated by write_back() at the end of every run(). No execution
+    trace is recorded.
+    """
+
+    def __init__(self, vms):
+
+        self.vms = list(vms)
+
+        if not self.vms:
+            raise ValueError('A batch needs at least one VM.')
+
+        first = self.vms[0]
+
+        for vm in self.vms:
+            if len(vm.ram) != len(first.ram) or vm.cpu.register_slots != first.cpu.register_slots:
+                raise ValueError('All VMs of a batch need the same memory size and registers.')
+
+            if len(vm.cpus) > 1:
+                raise ValueError('VMs with several CPUs cannot be batched.')
+
+            if vm.hooked:
+                raise ValueError('VMs with hooks cannot be batched.')
+
+        self.memory_size = len(first.ram)
+        self.slots = np.array(first.cpu.register_slots, dtype=np.int64)
+
+        self.memory = np.stack([np.frombuffer(bytes(vm.ram.memory), dtype=np.uint8) for vm in self.vms])
+        self.registers = np.array([vm.cpu.register_file.tolist() for vm in self.vms], dtype=np.uint16)
+
+        self.instruction_count = np.array([vm.instruction_count for vm in self.vms], dtype=np.int64)
+        self.memory_writes = np.array([vm.memory_writes for vm in self.vms], dtype=np.int64)
+
+        self.halt_code = np.array([HALT_REASONS.index(vm.halt_reason) + 1 if vm.should_halt() else 0
+                                   for vm in self.vms], dtype=np.int8)
+        self.waiting = np.zeros(len(self.vms), dtype=bool)
+        self.truncated = np.array([vm.output_device.truncated for vm in self.vms], dtype=bool)
+
+        self.instruction_limit = np.array([NEVER if vm.max_instructions is None else vm.max_instructions
+                                           for vm in self.vms], dtype=np.int64)
+        self.write_limit = np.array([NEVER if vm.max_memory_writes is None else vm.max_memory_writes
+                                     for vm in self.vms], dtype=np.int64)
+
+        self.faults: dict = dict()
+
+        self.handlers = {fast.INVALID: self._invalid,
+                         fast.NOOP: self._noop,
+                         fast.PUSH: self._push,
+                         fast.POP: self._pop,
+                         fast.MOV: self._mov,
+                         fast.CALL: self._call,
+                         fast.RET: self._ret,
+                         fast.OUT: self._out,
+                         fast.M_WORD: self._m_word,
+                         fast.M_BYTE: self._m_byte,
+                         fast.INPUT: self._input,
+                         fast.HALT: self._halt}
+
+    def __repr__(self):
+        return f"BatchedVM({len(self.vms)} x {self.memory_size})"
+
+    def __len__(self):
+        return len(self.vms)
+
+    @property
+    def running(self):
+        # Mask of the instances still running
+        return (self.halt_code == 0) & ~self.waiting
+
+    def run(self, max_steps: int = None):
+        # Runs until every instance has halted, faulted or is waiting for
+        # input, or for at most max_steps steps. Returns the status of
+        # every VM.
+
+        vms = self.vms
+
+        self.waiting[:] = False
+        self._stop((self.halt_code == 0) & (self.instruction_count >= self.instruction_limit),
+                   INSTRUCTION_LIMIT_CODE)
+
+        max_run_time = min((vm.max_run_time for vm in vms if vm.max_run_time is not None), default=None)
+        time_check_interval = min(vm.time_check_interval for vm in vms)
+        started_at = time.time()
+
+        steps = 0
+
+        while max_steps is None or steps < max_steps:
+
+            rows = np.flatnonzero(self.running)
+
+            if not len(rows):
+                break
+
+            self.step(rows)
+            steps += 1
+
+            if max_run_time is not None and not steps % time_check_interval:
+                if started_at + max_run_time < time.time():
+                    self._stop(self.running, TIME_LIMIT_CODE)
+
+        self.write_back()
+
+        return [vm.status for vm in vms]
+
+    def step(self, rows):
+        # Executes one instruction of every instance in rows
+
+        ip = self.registers[rows, IP].astype(np.int64)
+
+        # Fetching outside memory
+        ok = ip < self.memory_size
+        if not ok.all():
+            self._fault(rows[~ok])
+            (rows, ip) = (rows[ok], ip[ok])
+
+        kinds = DISPATCH[self.memory[rows, ip]]
+        done = list()
+
+        for kind in np.unique(kinds):
+            selected = kinds == kind
+            done.append(self.handlers[kind](rows[selected], ip[selected]))
+
+        done = np.concatenate(done) if done else rows[:0]
+
+        self.instruction_count[done] += 1
+        self._check_budgets(done)
+
+    def write_back(self):
+        # Updates the VMs with the state of the batch
+
+        for (row, vm) in enumerate(self.vms):
+            vm.ram.restore(self.memory[row].tobytes())
+            vm.cpu.register_file[:] = array('H', self.registers[row].tolist())
+
+            vm.ram.write_count += int(self.memory_writes[row]) - vm.memory_writes
+            vm.instruction_count = int(self.instruction_count[row])
+            vm.memory_writes = int(self.memory_writes[row])
+
+            code = int(self.halt_code[row])
+
+            vm._should_halt = code != 0
+            vm.halt_reason = HALT_REASONS[code - 1] if code else None
+            vm.waiting_input = bool(self.waiting[row])
+            vm.fault = self.faults.get(row)
+
+    # Halting
+
+    def _stop(self, mask, code: int):
+        self.halt_code[mask & (self.halt_code == 0)] = code
+
+    def _fault(self, rows):
+        # Same as an exception stopping VirtualMachineV2.run()
+
+        for row in rows.tolist():
+            self.vms[row].output_device.write_text("Segmentation fault (core dumped)\n")
+            self.faults[row] = IndexError('memory index out of range')
+
+        self.halt_code[rows] = FAULT_CODE
+
+    def _check_budgets(self, rows):
+        # Same checks, in the same order, as VirtualMachineV2._check_budgets()
+
+        rows = rows[self.halt_code[rows] == 0]
+
+        truncated = self.truncated[rows]
+        self.halt_code[rows[truncated]] = OUTPUT_LIMIT_CODE
+        rows = rows[~truncated]
+
+        over = self.memory_writes[rows] > self.write_limit[rows]
+        self.halt_code[rows[over]] = MEMORY_WRITE_LIMIT_CODE
+        rows = rows[~over]
+
+        over = self.instruction_count[rows] >= self.instruction_limit[rows]
+        self.halt_code[rows[over]] = INSTRUCTION_LIMIT_CODE
+
+    # Memory and registers. Reads return the values and a mask of the
+    # instances that did not fault.
+
+    def _read_byte(self, rows, addr):
+
+        ok = addr < self.memory_size
+        values = np.zeros(len(rows), dtype=np.int64)
+        values[ok] = self.memory[rows[ok], addr[ok]]
+
+        return (values, ok)
+
+    def _read_word(self, rows, addr):
+
+        addr = addr % self.memory_size
+        ok = addr + 1 < self.memory_size
+
+        values = np.zeros(len(rows), dtype=np.int64)
+        values[ok] = ((self.memory[rows[ok], addr[ok]].astype(np.int64) << 8)
+                      | self.memory[rows[ok], addr[ok] + 1])
+
+        return (values, ok)
+
+    def _write_word(self, rows, value, addr):
+
+        self.memory[rows, addr % self.memory_size] = value >> 8
+        self.memory[rows, (addr + 1) % self.memory_size] = value & 0xff
+        self.memory_writes[rows] += 1
+
+    def _read_register(self, rows, reg):
+
+        ok = reg < len(self.slots)
+        values = np.zeros(len(rows), dtype=np.int64)
+        values[ok] = self.registers[rows[ok], self.slots[reg[ok]]]
+
+        return (values, ok)
+
+    def _write_register(self, rows, reg, value):
+        # Returns the mask of the instances that did not fault
+
+        ok = reg < len(self.slots)
+        self.registers[rows[ok], self.slots[reg[ok]]] = value[ok] & 0xffff
+
+        return ok
+
+    def _register(self, rows, slot: int):
+        return self.registers[rows, slot].astype(np.int64)
+
+    def _set_ip(self, rows, ip):
+        self.registers[rows, IP] = ip & 0xffff
+
+    def _push_word(self, rows, value):
+
+        addr = (self._register(rows, SP) - 2) & 0xffff
+
+        self._write_word(rows, value, addr)
+        self.registers[rows, SP] = addr
+
+    def _keep(self, ok, rows, *arrays):
+        # Faults the instances not in ok, returns the rest
+
+        if not ok.all():
+            self._fault(rows[~ok])
+
+        return (rows[ok], ) + tuple(values[ok] for values in arrays)
+
+    # Instructions, called with the instances executing them and their
+    # instruction pointers. Return the instances that completed the
+    # instruction.
+
+    def _invalid(self, rows, ip):
+
+        for (row, opcode) in zip(rows.tolist(), self.memory[rows, ip].tolist()):
+            self.vms[row].output_device.write_text(f"Ogiltig instruktion ({hex(opcode)}), avslutar körning.\n")
+
+        self.halt_code[rows] = INVALID_CODE
+
+        return rows[:0]
+
+    def _noop(self, rows, ip):
+
+        self._set_ip(rows, ip + 1)
+
+        return rows
+
+    def _halt(self, rows, ip):
+
+        self._set_ip(rows, ip + 1)
+        self.halt_code[rows] = HALT_CODE
+
+        return rows
+
+    def _mov(self, rows, ip):
+
+        (value, ok) = self._read_word(rows, (ip + 1) & 0xffff)
+        (reg, reg_ok) = self._read_byte(rows, (ip + 3) & 0xffff)
+        (rows, ip, value, reg) = self._keep(ok & reg_ok, rows, ip, value, reg)
+
+        self._set_ip(rows, ip + 4)
+
+        ok = self._write_register(rows, reg, value)
+
+        return self._keep(ok, rows)[0]
+
+    def _push(self, rows, ip):
+
+        (reg, ok) = self._read_byte(rows, (ip + 1) & 0xffff)
+        (rows, ip, reg) = self._keep(ok, rows, ip, reg)
+
+        self._set_ip(rows, ip + 2)
+
+        (value, ok) = self._read_register(rows, reg)
+        (rows, value) = self._keep(ok, rows, value)
+
+        self._push_word(rows, value)
+
+        return rows
+
+    def _pop(self, rows, ip):
+
+        (reg, ok) = self._read_byte(rows, (ip + 1) & 0xffff)
+        (rows, ip, reg) = self._keep(ok, rows, ip, reg)
+
+        self._set_ip(rows, ip + 2)
+
+        (value, ok) = self._read_word(rows, self._register(rows, SP))
+        (rows, reg, value) = self._keep(ok, rows, reg, value)
+
+        ok = self._write_register(rows, reg, value)
+        (rows, ) = self._keep(ok, rows)
+
+        self.registers[rows, SP] = (self._register(rows, SP) + 2) & 0xffff
+
+        return rows
+
+    def _call(self, rows, ip):
+
+        (reg, ok) = self._read_byte(rows, (ip + 1) & 0xffff)
+        (rows, ip, reg) = self._keep(ok, rows, ip, reg)
+
+        self._set_ip(rows, ip + 2)
+
+        self._push_word(rows, self._register(rows, IP))
+        self._push_word(rows, self._register(rows, BP))
+        self.registers[rows, BP] = self.registers[rows, SP]
+
+        (target, ok) = self._read_register(rows, reg)
+        (rows, target) = self._keep(ok, rows, target)
+
+        self._set_ip(rows, target)
+
+        return rows
+
+    def _ret(self, rows, ip):
+
+        self._set_ip(rows, ip + 1)
+
+        # Pop BP, then IP, then return to the caller's stack frame
+        for slot in (BP, IP):
+            (value, ok) = self._read_word(rows, self._register(rows, SP))
+            (rows, value) = self._keep(ok, rows, value)
+
+            self.registers[rows, slot] = value
+            self.registers[rows, SP] = (self._register(rows, SP) + 2) & 0xffff
+
+        self.registers[rows, SP] = self.registers[rows, BP]
+
+        return rows
+
+    def _m_word(self, rows, ip):
+
+        (value, ok) = self._read_word(rows, (ip + 1) & 0xffff)
+        (addr, addr_ok) = self._read_word(rows, (ip + 3) & 0xffff)
+        (rows, ip, value, addr) = self._keep(ok & addr_ok, rows, ip, value, addr)
+
+        self._set_ip(rows, ip + 5)
+        self._write_word(rows, value, addr)
+
+        return rows
+
+    def _m_byte(self, rows, ip):
+
+        (value, ok) = self._read_byte(rows, (ip + 1) & 0xffff)
+        (addr, addr_ok) = self._read_word(rows, (ip + 2) & 0xffff)
+        (rows, ip, value, addr) = self._keep(ok & addr_ok, rows, ip, value, addr)
+
+        self._set_ip(rows, ip + 4)
+
+        self.memory[rows, addr % self.memory_size] = value
+        self.memory_writes[rows] += 1
+
+        return rows
+
+    def _out(self, rows, ip):
+
+        (addr, ok) = self._read_word(rows, (ip + 1) & 0xffff)
+        (rows, ip, addr) = self._keep(ok, rows, ip, addr)
+
+        self._set_ip(rows, ip + 3)
+
+        done = np.ones(len(rows), dtype=bool)
+
+        for (index, (row, start)) in enumerate(zip(rows.tolist(), addr.tolist())):
+            done[index] = self._out_string(row, start)
+
+        return self._keep(done, rows)[0]
+
+    def _out_string(self, row: int, addr: int):
+        # Same as VirtualMachineV2.out() for one instance. Returns False if
+        # the string runs outside memory.
+
+        memory = self.memory[row]
+        device = self.vms[row].output_device
+        remaining = device.remaining
+
+        chunk = bytearray()
+        ok = True
+
+        i = 0
+        while remaining is None or i <= remaining:
+
+            index = (addr + i) & 0xffff
+
+            if index >= self.memory_size:
+                ok = False
+                break
+
+            byte = int(memory[index])
+
+            if byte == 0:
+                break
+
+            chunk.append(byte)
+
+            i += 1
+
+        device.write(chunk)
+        self.truncated[row] = device.truncated
+
+        return ok
+
+    def _input(self, rows, ip):
+
+        (arg, ok) = self._read_byte(rows, (ip + 1) & 0xffff)
+        (rows, ip) = self._keep(ok, rows, ip)
+
+        done = np.ones(len(rows), dtype=bool)
+
+        for (index, row) in enumerate(rows.tolist()):
+            done[index] = self._input_line(row)
+
+        # Instances waiting for input execute the instruction again later
+        self._set_ip(rows[done], ip[done] + 2)
+        self.waiting[rows[~done]] = True
+
+        return rows[done]
+
+    def _input_line(self, row: int):
+        # Same as VirtualMachineV2.read_input() for one instance. Returns
+        # False if the instance has to wait for input.
+
+        input_device = self.vms[row].input_device
+        memory = self.memory[row]
+        sp = int(self.registers[row, SP])
+
+        if input_device is None:
+            # fake_input(), which stops copying at the end of memory
+            for i in range(INPUT_SIZE):
+                if 0x2000 + i >= self.memory_size:
+                    break
+
+                memory[((sp - 256 + i) & 0xffff) % self.memory_size] = memory[0x2000 + i]
+                self.memory_writes[row] += 1
+
+            return True
+
+        line = input_device.readline(INPUT_SIZE)
+
+        if line is None:
+            return False
+
+        for (i, byte) in enumerate(line):
+            memory[((sp - 256 + i) & 0xffff) % self.memory_size] = byte
+
+        self.memory_writes[row] += len(line)
+
+        return True
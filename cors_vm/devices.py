@@ -0,0 +1,170 @@
+import io
+
+# Bytes are mapped one to one onto characters, the same as chr() would
+ENCODING = 'latin-1'
+
+
+class OutputDevice:
+    """ Buffered output of a virtual machine.
+
+    Output is collected in a bytearray and handed to the sink, if any, in
+    chunks as it is produced. The sink can be a callable taking bytes, a
+    binary or text file object, or anything else with a write() method
+    such as an asyncio.StreamWriter. With a limit, output beyond limit bytes
+    is dropped and truncated is set. tap, if set, is called with every chunk
+    as well, see cors_vm.replay.
+    """
+
+    def __init__(self, sink=None, limit: int = None, keep: bool = True):
+
+        self.sink = sink
+        self.limit = limit
+
+        # Set keep to False to only stream output to the sink
+        self.keep = keep
+
+        self.tap = None
+
+        self._buffer = bytearray()
+        self.written = 0
+        self.truncated = False
+
+    def __repr__(self):
+        return f"OutputDevice({self.written} bytes)"
+
+    def __len__(self):
+        return self.written
+
+    @property
+    def remaining(self):
+        # Bytes left before the limit, None without a limit
+
+        if self.limit is None:
+            return None
+
+        return self.limit - self.written
+
+    def write(self, data):
+
+        if self.limit is not None and len(data) > self.limit - self.written:
+            data = data[:self.limit - self.written]
+            self.truncated = True
+
+        if not data:
+            return 0
+
+        if self.keep:
+            self._buffer += data
+
+        self.written += len(data)
+
+        if self.sink is not None:
+            self._emit(bytes(data))
+
+        if self.tap is not None:
+            self.tap(bytes(data))
+
+        return len(data)
+
+    def write_text(self, text: str):
+        return self.write(text.encode(ENCODING, errors='replace'))
+
+    def _emit(self, chunk: bytes):
+
+        if callable(self.sink):
+            self.sink(chunk)
+        elif isinstance(self.sink, io.TextIOBase):
+            self.sink.write(chunk.decode(ENCODING))
+        else:
+            self.sink.write(chunk)
+
+    def getvalue(self):
+        return bytes(self._buffer)
+
+    @property
+    def text(self):
+        return self._buffer.decode(ENCODING)
+
+    def snapshot(self):
+        return (bytes(self._buffer), self.written, self.truncated)
+
+    def restore(self, state: tuple):
+
+        (buffer, self.written, self.truncated) = state
+        self._buffer = bytearray(buffer)
+
+    def clear(self):
+
+        self._buffer = bytearray()
+        self.written = 0
+        self.truncated = False
+
+
+class InputDevice:
+    """ Buffered input of a virtual machine.
+
+    Data fed to the device, as it arrives from a connection for example, is
+    read by the guest a line at a time. Until a whole line is available
+    readline() returns None and the guest waits for input. After close()
+    the remaining data is returned as the last line. tap, if set, is called
+    with every line read.
+    """
+
+    def __init__(self, data=b''):
+
+        self._buffer = bytearray(data)
+        self.closed = False
+
+        self.tap = None
+
+    def __repr__(self):
+        return f"InputDevice({len(self._buffer)} bytes)"
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+
+        if self.closed:
+            raise ValueError('Input device is closed.')
+
+        self._buffer += data
+
+    def close(self):
+        self.closed = True
+
+    def readline(self, limit: int):
+        # Returns at most limit bytes up to, but not including, the next
+        # newline. Longer lines are returned limit bytes at a time.
+
+        buffer = self._buffer
+        end = buffer.find(b'\n', 0, limit + 1)
+
+        if end != -1:
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+
+        elif len(buffer) < limit and not self.closed:
+            return None
+
+        else:
+            line = bytes(buffer[:limit])
+            del buffer[:limit]
+
+        if self.tap is not None:
+            self.tap(line)
+
+        return line
+
+    def snapshot(self):
+        return (bytes(self._buffer), self.closed)
+
+    def restore(self, state: tuple):
+
+        (buffer, self.closed) = state
+        self._buffer = bytearray(buffer)
+
+    def clear(self):
+
+        self._buffer = bytearray()
+        self.closed = False
@@ -0,0 +1,237 @@
+from cors_vm.base_types import uint16_t, uint8_t
+
+# Register file slots, see cors_vm.virtual_machine
+(IP, SP, BP, REG01) = range(4)
+
+# Instruction kinds, 0 marks an invalid opcode
+(INVALID, NOOP, PUSH, POP, MOV, CALL, RET, OUT, M_WORD, M_BYTE, INPUT, HALT) = range(12)
+
+# Opcode -> instruction kind
+DISPATCH = [INVALID] * 256
+DISPATCH[0x0] = HALT
+DISPATCH[0x3] = OUT
+DISPATCH[0x4] = M_WORD
+DISPATCH[0x5] = M_BYTE
+DISPATCH[0x6] = PUSH
+DISPATCH[0x7] = POP
+DISPATCH[0x8] = MOV
+DISPATCH[0x9] = CALL
+DISPATCH[0xa] = RET
+DISPATCH[0xb] = INPUT
+DISPATCH[0x90] = NOOP
+
+
+def write_back(vm, ip: int, sp: int, bp: int, r1: int, writes: int):
+    # Writes the engine's local state back to the VM
+
+    register_file = vm.cpu.register_file
+
+    register_file[IP] = ip
+    register_file[SP] = sp
+    register_file[BP] = bp
+    register_file[REG01] = r1
+
+    vm.ram.write_count = writes
+
+
+def run(vm):
+    # Same semantics as VirtualMachineV2.run_program(), but the registers
+    # are kept in local ints and operands are read straight from the
+    # memory buffer. State is written back to the CPU when the loop exits.
+    # Additional general purpose registers are used straight from the
+    # register file. No execution trace is recorded.
+
+    cpu = vm.cpu
+    ram = vm.ram
+    mem = ram.memory
+    memory_size = len(mem)
+    output_device = vm.output_device
+    observers = ram._write_observers
+    notify = ram._notify_write
+    dispatch = DISPATCH
+
+    (instruction_limit, write_limit) = vm._begin_run()
+    count = vm.instruction_count
+    next_check = min(count + vm.time_check_interval, instruction_limit)
+    writes = ram.write_count
+
+    register_file = cpu.register_file
+    slots = cpu.register_slots
+
+    ip = register_file[IP]
+    sp = register_file[SP]
+    bp = register_file[BP]
+    r1 = register_file[REG01]
+
+    try:
+        while not vm._should_halt and count < instruction_limit:
+
+            kind = dispatch[mem[ip]]
+
+            if kind == NOOP:
+                ip = (ip + 1) & 0xffff
+
+            elif kind == MOV:
+                a = ((ip + 1) & 0xffff) % memory_size
+                value = (mem[a] << 8) | mem[a + 1]
+                reg = mem[(ip + 3) & 0xffff]
+                ip = (ip + 4) & 0xffff
+
+                if reg == 3:
+                    r1 = value
+                elif reg == 1:
+                    sp = value
+                elif reg == 2:
+                    bp = value
+                elif reg == 0 or reg == 4:
+                    ip = value
+                else:
+                    register_file[slots[reg]] = value
+
+            elif kind == PUSH:
+                reg = mem[(ip + 1) & 0xffff]
+                ip = (ip + 2) & 0xffff
+
+                if reg == 3:
+                    value = r1
+                elif reg == 1:
+                    value = sp
+                elif reg == 2:
+                    value = bp
+                elif reg == 0 or reg == 4:
+                    value = ip
+                else:
+                    value = register_file[slots[reg]]
+
+                a = (sp - 2) & 0xffff
+                mem[a % memory_size] = value >> 8
+                mem[(a + 1) % memory_size] = value & 0xff
+                writes += 1
+
+                if observers:
+                    notify(a % memory_size, 2)
+
+                sp = (sp - 2) & 0xffff
+
+            elif kind == POP:
+                reg = mem[(ip + 1) & 0xffff]
+                ip = (ip + 2) & 0xffff
+
+                a = sp % memory_size
+                value = (mem[a] << 8) | mem[a + 1]
+
+                if reg == 3:
+                    r1 = value
+                elif reg == 1:
+                    sp = value
+                elif reg == 2:
+                    bp = value
+                elif reg == 0 or reg == 4:
+                    ip = value
+                else:
+                    register_file[slots[reg]] = value
+
+                sp = (sp + 2) & 0xffff
+
+            elif kind == CALL:
+                reg = mem[(ip + 1) & 0xffff]
+                ip = (ip + 2) & 0xffff
+
+                # Push IP and BP, then set up the new stack frame
+                for value in (ip, bp):
+                    a = (sp - 2) & 0xffff
+                    mem[a % memory_size] = value >> 8
+                    mem[(a + 1) % memory_size] = value & 0xff
+                    writes += 1
+
+                    if observers:
+                        notify(a % memory_size, 2)
+
+                    sp = (sp - 2) & 0xffff
+
+                bp = sp
+
+                if reg == 3:
+                    ip = r1
+                elif reg == 1:
+                    ip = sp
+                elif reg == 2:
+                    ip = bp
+                elif reg != 0 and reg != 4:
+                    ip = register_file[slots[reg]]
+
+            elif kind == RET:
+                ip = (ip + 1) & 0xffff
+
+                a = sp % memory_size
+                bp = (mem[a] << 8) | mem[a + 1]
+                sp = (sp + 2) & 0xffff
+
+                a = sp % memory_size
+                ip = (mem[a] << 8) | mem[a + 1]
+
+                sp = bp
+
+            elif kind == OUT:
+                a = ((ip + 1) & 0xffff) % memory_size
+                addr = (mem[a] << 8) | mem[a + 1]
+                ip = (ip + 3) & 0xffff
+
+                vm.out((uint16_t(addr), ))
+
+            elif kind == M_WORD:
+                a = ((ip + 1) & 0xffff) % memory_size
+                value = (mem[a] << 8) | mem[a + 1]
+                a = ((ip + 3) & 0xffff) % memory_size
+                addr = (mem[a] << 8) | mem[a + 1]
+                ip = (ip + 5) & 0xffff
+
+                mem[addr % memory_size] = value >> 8
+                mem[(addr + 1) % memory_size] = value & 0xff
+                writes += 1
+
+                if observers:
+                    notify(addr % memory_size, 2)
+
+            elif kind == M_BYTE:
+                value = mem[(ip + 1) & 0xffff]
+                a = ((ip + 2) & 0xffff) % memory_size
+                addr = (mem[a] << 8) | mem[a + 1]
+                ip = (ip + 4) & 0xffff
+
+                mem[addr % memory_size] = value
+                writes += 1
+
+                if observers:
+                    notify(addr % memory_size, 1)
+
+            elif kind == INPUT:
+                arg = mem[(ip + 1) & 0xffff]
+                ip = (ip + 2) & 0xffff
+
+                write_back(vm, ip, sp, bp, r1, writes)
+                vm.opcodes[0xb]['func']((uint8_t(arg), ))
+                writes = ram.write_count
+
+            elif kind == HALT:
+                ip = (ip + 1) & 0xffff
+
+                vm.halt()
+
+            else:
+                # Let the interpreter report the invalid instruction
+                write_back(vm, ip, sp, bp, r1, writes)
+                vm.fetch_instruction()
+                break
+
+            count += 1
+
+            if count >= next_check or output_device.truncated or writes > write_limit:
+
+                write_back(vm, ip, sp, bp, r1, writes)
+                vm._check_budgets(count, write_limit)
+                next_check = min(count + vm.time_check_interval, instruction_limit)
+
+    finally:
+        write_back(vm, ip, sp, bp, r1, writes)
+        vm._end_run(count)
@@ -0,0 +1,140 @@
+import collections
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+
+from cors_vm.base_types import uint16_t
+from cors_vm.virtual_machine import RandomAccessMemory, Segment, VirtualMachineV2
+
+# On-disk VM image
+#
+# Header | Segment table | padding | Memory contents
+#
+# The memory contents start at a multiple of mmap.ALLOCATIONGRANULARITY so
+# that they can be mapped straight into a RandomAccessMemory.
+
+MAGIC = b'CORSIMG\x00'
+VERSION = 1
+
+# magic, version, memory size, instruction pointer, segment count, memory offset
+HEADER = struct.Struct('>8sHIHHI')
+
+# kind, start address, length, name length. Followed by the UTF-8 name.
+SEGMENT = struct.Struct('>BHIB')
+
+(CODE_SEGMENT, DATA_SEGMENT) = range(2)
+
+ALIGNMENT = mmap.ALLOCATIONGRANULARITY
+
+ImageHeader = collections.namedtuple('ImageHeader', ['memory_size', 'ip', 'code_segments',
+                                                     'data_segments', 'offset'])
+
+
+def pack_segments(vm):
+    # Segment table of vm, code segments first
+
+    entries = list()
+
+    for (kind, segments) in ((CODE_SEGMENT, vm.code_segments), (DATA_SEGMENT, vm.data_segments)):
+        for segment in segments:
+            # Names are cut to 255 bytes, on a character boundary
+            name = segment.name.encode('utf-8')[:255].decode('utf-8', 'ignore').encode('utf-8')
+
+            entries.append(SEGMENT.pack(kind, segment.start_addr.uint16, segment.length, len(name)))
+            entries.append(name)
+
+    return b''.join(entries)
+
+
+def unpack_segments(data, offset: int, count: int):
+    # Reads count segment table entries from data at offset. Returns the
+    # code segments, the data segments and the offset following the table.
+
+    segments = (list(), list())
+
+    for _ in range(count):
+        (kind, start_addr, length, name_length) = SEGMENT.unpack_from(data, offset)
+        offset += SEGMENT.size
+
+        name = bytes(data[offset:offset + name_length]).decode('utf-8')
+        offset += name_length
+
+        segments[kind].append(Segment(name, uint16_t(start_addr), length))
+
+    return (segments[CODE_SEGMENT], segments[DATA_SEGMENT], offset)
+
+
+def image_bytes(vm):
+    # Header and segment table of the image, padded to where the memory
+    # contents start.
+
+    table = pack_segments(vm)
+    count = len(vm.code_segments) + len(vm.data_segments)
+
+    offset = -(-(HEADER.size + len(table)) // ALIGNMENT) * ALIGNMENT
+    header = HEADER.pack(MAGIC, VERSION, len(vm.ram), vm.cpu.ip.uint16, count, offset)
+
+    return (header + table).ljust(offset, b'\x00')
+
+
+def write_image(vm, path):
+    # Writes memory and segment tables of vm to path. The file is replaced
+    # atomically, so processes mapping the old image are not affected.
+
+    path = pathlib.Path(path)
+    (fd, tmp_path) = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(image_bytes(vm))
+            file.write(bytes(vm.ram.memory))
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return path
+
+
+def read_header(path):
+
+    with open(path, 'rb') as file:
+        data = file.read(HEADER.size)
+
+        if len(data) != HEADER.size:
+            raise ValueError('Not a VM image, file is too short.')
+
+        (magic, version, memory_size, ip, count, offset) = HEADER.unpack(data)
+
+        if magic != MAGIC:
+            raise ValueError('Not a VM image.')
+
+        if version != VERSION:
+            raise ValueError(f'Unsupported VM image version {version}.')
+
+        table = file.read(offset - HEADER.size)
+
+    (code_segments, data_segments, _) = unpack_segments(table, 0, count)
+
+    return ImageHeader(memory_size, ip, code_segments, data_segments, offset)
+
+
+def load_image(path, shared: bool = False, **kwargs):
+    # Returns a VirtualMachineV2 whose memory is mapped from the image at
+    # path instead of being copied. Unless shared is set, the guest's
+    # writes stay private to the VM. Other keyword arguments are passed on
+    # to VirtualMachineV2.
+
+    header = read_header(path)
+    ram = RandomAccessMemory.map_file(path, header.memory_size, header.offset, shared)
+
+    vm = VirtualMachineV2(ram=ram, **kwargs)
+
+    vm.code_segments.extend(header.code_segments)
+    vm.data_segments.extend(header.data_segments)
+    vm.cpu.ip.uint16 = header.ip
+
+    return vm
@@ -0,0 +1,286 @@
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.virtual_machine import PAGE_SIZE, RandomAccessMemory
+
+
+class SharedImage:
+    """ Read-only memory image split into pages that CopyOnWriteMemory
+    instances share. Identical pages, like all the zero pages, are stored
+    once.
+    """
+
+    def __init__(self, data, page_size: int = PAGE_SIZE):
+
+        if page_size <= 0 or page_size & (page_size - 1):
+            raise ValueError('Page size must be a power of two.')
+
+        data = bytes(data)
+
+        if len(data) % page_size:
+            raise ValueError('Image size must be a multiple of the page size.')
+
+        self.size = len(data)
+        self.page_size = page_size
+
+        unique: dict = dict()
+        pages = list()
+
+        for addr in range(0, self.size, page_size):
+            page = data[addr:addr + page_size]
+            pages.append(unique.setdefault(page, page))
+
+        self.pages = tuple(pages)
+
+    def __repr__(self):
+        return f"SharedImage({self.size}, {len(set(map(id, self.pages)))} unique pages)"
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_memory(cls, ram: RandomAccessMemory, page_size: int = PAGE_SIZE):
+        return cls(ram.memory, page_size)
+
+
+class PagedMemoryView:
+
+    # Indexable, bytearray like view of a CopyOnWriteMemory
+
+    __slots__ = ('_ram', )
+
+    def __init__(self, ram):
+        self._ram = ram
+
+    def __len__(self):
+        return self._ram._memory_size
+
+    def __bytes__(self):
+        return b''.join(self._ram._pages)
+
+    def __iter__(self):
+        return iter(bytes(self))
+
+    def __eq__(self, other):
+        return bytes(self) == bytes(other)
+
+    def _index(self, index: int):
+
+        if index < 0:
+            index += self._ram._memory_size
+
+        if not 0 <= index < self._ram._memory_size:
+            raise IndexError('memory index out of range')
+
+        return index
+
+    def __getitem__(self, index):
+
+        ram = self._ram
+
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(ram._memory_size)
+
+            if step != 1:
+                return bytes(self)[index]
+
+            chunks = list()
+            addr = start
+
+            while addr < stop:
+                offset = addr & ram._image_mask
+                end = min(stop, addr - offset + ram._image_page_size)
+
+                chunks.append(ram._pages[addr >> ram._image_shift][offset:offset + end - addr])
+                addr = end
+
+            return b''.join(chunks)
+
+        index = self._index(index)
+
+        return ram._pages[index >> ram._image_shift][index & ram._image_mask]
+
+    def find(self, sub: bytes, start: int = 0, end: int = None):
+        # bytearray.find() for a single byte, a page at a time
+
+        ram = self._ram
+        (start, end, _) = slice(start, end).indices(ram._memory_size)
+
+        addr = start
+        while addr < end:
+            offset = addr & ram._image_mask
+            stop = min(end, addr - offset + ram._image_page_size)
+
+            found = ram._pages[addr >> ram._image_shift].find(sub, offset, offset + stop - addr)
+
+            if found != -1:
+                return addr - offset + found
+
+            addr = stop
+
+        return -1
+
+    def __setitem__(self, index, value):
+
+        ram = self._ram
+
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(ram._memory_size)
+            data = memoryview(bytes(value))
+
+            if step != 1 or len(data) != stop - start:
+                raise ValueError('Paged memory only supports same sized, contiguous slices.')
+
+            addr = start
+            while addr < stop:
+                offset = addr & ram._image_mask
+                end = min(stop, addr - offset + ram._image_page_size)
+
+                page = ram._writable_page(addr >> ram._image_shift)
+                page[offset:offset + end - addr] = data[addr - start:end - start]
+                addr = end
+
+            return
+
+        index = self._index(index)
+
+        ram._writable_page(index >> ram._image_shift)[index & ram._image_mask] = value
+
+
+class CopyOnWriteMemory(RandomAccessMemory):
+    """ Drop in replacement for RandomAccessMemory whose pages are shared
+    with a SharedImage until written. The first write to a page gives this
+    memory a private copy of it.
+    """
+
+    def __init__(self, image: SharedImage):
+
+        super().__init__(0)
+
+        self.image = image
+
+        self._memory_size = image.size
+        self._image_page_size = image.page_size
+        self._image_shift = image.page_size.bit_length() - 1
+        self._image_mask = image.page_size - 1
+
+        # bytes for shared pages, bytearray for private copies
+        self._pages = list(image.pages)
+        self._view = PagedMemoryView(self)
+
+    def __repr__(self):
+        return f"COW-RAM({self._memory_size}, {len(self.private_pages())} private pages)"
+
+    def __len__(self):
+        return self._memory_size
+
+    @property
+    def memory(self):
+        return self._view
+
+    def _writable_page(self, index: int):
+
+        page = self._pages[index]
+
+        if type(page) is bytes:
+            page = bytearray(page)
+            self._pages[index] = page
+
+        return page
+
+    def private_pages(self):
+        # Indices of the pages this memory has its own copy of
+        return [index for (index, page) in enumerate(self._pages) if type(page) is not bytes]
+
+    def reset(self):
+        # Drops all private pages, returning to the shared image
+
+        self._pages = list(self.image.pages)
+        self._notify_write(0, self._memory_size)
+
+    def restore(self, snapshot: bytes, page_size: int = PAGE_SIZE):
+        # Like RandomAccessMemory.restore(), but pages equal to the shared
+        # image are shared again instead of copied.
+
+        if len(snapshot) != self._memory_size:
+            raise ValueError('Snapshot does not match memory size.')
+
+        page_size = self._image_page_size
+        shared = self.image.pages
+
+        if self._dirty is not None and self._page_size == page_size:
+            pages = self._pages_to_compare(snapshot)
+        else:
+            pages = range(len(self._pages))
+
+        restored = 0
+
+        for index in pages:
+            addr = index * page_size
+            wanted = snapshot[addr:addr + page_size]
+
+            if self._pages[index] == wanted:
+                continue
+
+            if shared[index] == wanted:
+                self._pages[index] = shared[index]
+            else:
+                self._pages[index] = bytearray(wanted)
+
+            restored += 1
+
+            if self._write_observers:
+                self._notify_write(addr, page_size)
+
+        if self._dirty is not None:
+            self.clear_dirty()
+            self._dirty_baseline = snapshot
+
+        return restored
+
+    def read_byte(self, addr: uint16_t):
+
+        index = addr.uint16
+
+        if index >= self._memory_size:
+            raise IndexError('bytearray index out of range')
+
+        return uint8_t(self._pages[index >> self._image_shift][index & self._image_mask])
+
+    def read_word(self, addr: uint16_t):
+
+        src_addr = addr.uint16 % self._memory_size
+
+        if src_addr + 1 >= self._memory_size:
+            raise IndexError('bytearray index out of range')
+
+        pages = self._pages
+        shift = self._image_shift
+        mask = self._image_mask
+
+        ho_byte = pages[src_addr >> shift][src_addr & mask]
+        lo_byte = pages[(src_addr + 1) >> shift][(src_addr + 1) & mask]
+
+        return uint16_t((ho_byte << 8) + lo_byte)
+
+    def write_word(self, args):
+        (value, addr) = args
+
+        dst_addr = addr.uint16 % self._memory_size
+        next_addr = (addr.uint16 + 1) % self._memory_size
+
+        self._writable_page(dst_addr >> self._image_shift)[dst_addr & self._image_mask] = value.ho_byte
+        self._writable_page(next_addr >> self._image_shift)[next_addr & self._image_mask] = value.lo_byte
+        self.write_count += 1
+
+        if self._write_observers:
+            self._notify_write(dst_addr, 2)
+
+    def write_byte(self, args):
+        (value, addr) = args
+
+        dst_addr = addr.uint16 % self._memory_size
+
+        self._writable_page(dst_addr >> self._image_shift)[dst_addr & self._image_mask] = value.uint8
+        self.write_count += 1
+
+        if self._write_observers:
+            self._notify_write(dst_addr, 1)
@@ -0,0 +1,107 @@
+import concurrent.futures
+from array import array
+from multiprocessing import shared_memory
+
+from cors_vm.virtual_machine import HaltReason, RandomAccessMemory, VirtualMachineV2
+
+# Runs the CPUs of a VM truly in parallel, one process per CPU sharing the
+# VM's memory through multiprocessing.shared_memory. Unlike run(), the
+# interleaving of the CPUs is up to the OS and not reproducible.
+
+
+def run_cpu(name: str, memory_size: int, registers: bytes, num_registers: int, budgets: dict):
+    # Runs one CPU on the shared memory until it halts. Returns its
+    # registers, output, counters and halt reason.
+
+    shm = shared_memory.SharedMemory(name)
+    buffer = shm.buf[:memory_size]
+
+    try:
+        # run_fast reads the memory itself on every instruction, so it sees
+        # writes from the other processes. Decoded instructions would not.
+        vm = VirtualMachineV2(ram=RandomAccessMemory(memory_size, buffer),
+                              num_registers=num_registers,
+                              decode_cache=False,
+                              trace=False,
+                              **budgets)
+
+        vm.cpu.register_file[:] = array('H', registers)
+        vm.run(engine=vm.run_fast)
+
+        return (bytes(vm.cpu.register_file),
+                vm.output_device.getvalue(),
+                vm.output_device.truncated,
+                vm.instruction_count,
+                vm.memory_writes,
+                vm.halt_reason.value,
+                vm.fault)
+
+    finally:
+        vm = None
+        buffer.release()
+        shm.close()
+
+
+def run_parallel(vm: VirtualMachineV2, workers: int = None):
+    # Runs every CPU of vm that has not halted in its own process until
+    # they all halt, and updates vm with the result. Output is collected
+    # per CPU and written in CPU order. The VM halts with the first halt
+    # reason, in CPU order, other than HaltReason.HALT, or HALT. Budgets
+    # apply to every CPU separately, input devices and hooks are not
+    # supported.
+
+    if vm.input_device is not None:
+        raise ValueError('Input devices are not supported when running CPUs in parallel.')
+
+    if vm.hooked:
+        raise ValueError('Hooks are not supported when running CPUs in parallel.')
+
+    cpus = [cpu for cpu in vm.cpus if not cpu.halted]
+    memory_size = len(vm.ram)
+
+    budgets = {'max_instructions': vm.max_instructions,
+               'max_run_time': vm.max_run_time,
+               'max_memory_writes': vm.max_memory_writes,
+               'max_output_bytes': vm.max_output_bytes}
+
+    shm = shared_memory.SharedMemory(create=True, size=memory_size)
+
+    try:
+        shm.buf[:memory_size] = bytes(vm.ram.memory)
+
+        with concurrent.futures.ProcessPoolExecutor(workers or len(cpus) or 1) as pool:
+            futures = [pool.submit(run_cpu, shm.name, memory_size, bytes(cpu.register_file),
+                                   len(cpu.register_file) - 3, budgets) for cpu in cpus]
+
+            results = [future.result() for future in futures]
+
+        vm.ram.restore(bytes(shm.buf[:memory_size]))
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+    reasons = list()
+
+    for (cpu, result) in zip(cpus, results):
+        (registers, output, truncated, instructions, writes, reason, fault) = result
+
+        cpu.register_file[:] = array('H', registers)
+        cpu.halted = True
+
+        vm.output_device.write(output)
+        vm.instruction_count += instructions
+        vm.memory_writes += writes
+        vm.ram.write_count += writes
+
+        reasons.append((HaltReason(reason), fault))
+
+    for (reason, fault) in reasons:
+        if reason != HaltReason.HALT:
+            vm.fault = fault
+            vm.stop(reason)
+            break
+    else:
+        vm.stop(HaltReason.HALT)
+
+    return vm.status
@@ -0,0 +1,222 @@
+import collections
+import time
+
+from cors_vm.virtual_machine import HookEvent
+
+# Names used for addresses outside every segment
+UNKNOWN_SEGMENT = '[unknown]'
+
+
+class Profiler:
+    """ Counts executions and time per instruction address and opcode.
+
+    Hooks into a VirtualMachineV2 with add_hook(), so it works with every
+    engine. Addresses are attributed to the code or data segment holding
+    them, data segments included since injected code runs from them. The
+    frames pushed by call and popped by ret give the call stacks written
+    by write_collapsed().
+
+        with Profiler(vm) as profiler:
+            vm.run()
+
+        print(profiler.report())
+    """
+
+    def __init__(self, vm, timer=time.perf_counter):
+
+        self.vm = vm
+        self.timer = timer
+
+        self.clear()
+
+    def __repr__(self):
+        return f"Profiler({sum(self.ip_counts.values())} instructions)"
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def clear(self):
+
+        self.ip_counts = collections.Counter()
+        self.ip_times = collections.Counter()
+        self.opcode_counts = collections.Counter()
+        self.opcode_times = collections.Counter()
+
+        # Call stack, as a tuple of frame names -> instructions and time
+        self.stack_counts = collections.Counter()
+        self.stack_times = collections.Counter()
+
+        # CPU -> list of frame names
+        self._stacks: dict = dict()
+        self._segment_names: dict = dict()
+        self._current_stack = ()
+        self._started_at = None
+
+    def attach(self):
+
+        vm = self.vm
+
+        vm.add_hook(HookEvent.BEFORE_INSTRUCTION, self._before)
+        vm.add_hook(HookEvent.AFTER_INSTRUCTION, self._after)
+        vm.add_hook(HookEvent.CALL, self._call)
+        vm.add_hook(HookEvent.RET, self._ret)
+
+    def detach(self):
+
+        vm = self.vm
+
+        vm.remove_hook(HookEvent.BEFORE_INSTRUCTION, self._before)
+        vm.remove_hook(HookEvent.AFTER_INSTRUCTION, self._after)
+        vm.remove_hook(HookEvent.CALL, self._call)
+        vm.remove_hook(HookEvent.RET, self._ret)
+
+    def segment_of(self, ip: int):
+        # Name of the segment holding ip, segments are looked up once per
+        # address.
+
+        if ip not in self._segment_names:
+            name = UNKNOWN_SEGMENT
+
+            for segment in self.vm.code_segments + self.vm.data_segments:
+                start = segment.start_addr.uint16
+
+                if start <= ip < start + segment.length:
+                    name = segment.name
+                    break
+
+            self._segment_names[ip] = name
+
+        return self._segment_names[ip]
+
+    def frame_name(self, ip: int):
+        # A function is named after its segment, plus its offset when it
+        # does not start it
+
+        for segment in self.vm.code_segments + self.vm.data_segments:
+            start = segment.start_addr.uint16
+
+            if start <= ip < start + segment.length:
+                if ip == start:
+                    return segment.name
+
+                return f"{segment.name}+{hex(ip - start)}"
+
+        return hex(ip)
+
+    def _stack(self, ip: int):
+
+        cpu = self.vm.cpu
+
+        if cpu not in self._stacks:
+            self._stacks[cpu] = [self.segment_of(ip)]
+
+        return self._stacks[cpu]
+
+    def _before(self, vm, ip: int, opcode: int, args):
+
+        # Taken before call and ret change it
+        self._current_stack = tuple(self._stack(ip))
+        self._started_at = self.timer()
+
+    def _after(self, vm, ip: int, opcode: int, args):
+
+        elapsed = self.timer() - self._started_at
+
+        self.ip_counts[ip] += 1
+        self.ip_times[ip] += elapsed
+        self.opcode_counts[opcode] += 1
+        self.opcode_times[opcode] += elapsed
+
+        stack = self._current_stack
+
+        self.stack_counts[stack] += 1
+        self.stack_times[stack] += elapsed
+
+    def _call(self, vm, ip: int, new_ip: int):
+        self._stack(ip).append(self.frame_name(new_ip))
+
+    def _ret(self, vm, ip: int, new_ip: int):
+
+        stack = self._stack(ip)
+
+        # A ret without a matching call, like one returning into injected
+        # code, keeps the bottom frame
+        if len(stack) > 1:
+            stack.pop()
+
+    def segment_totals(self):
+        # segment name -> (instructions, seconds)
+
+        totals: dict = dict()
+
+        for (ip, count) in self.ip_counts.items():
+            name = self.segment_of(ip)
+            (total_count, total_time) = totals.get(name, (0, 0.0))
+
+            totals[name] = (total_count + count, total_time + self.ip_times[ip])
+
+        return totals
+
+    def report(self, limit: int = 10):
+        # Text report of the hottest segments, opcodes and addresses,
+        # sorted by time
+
+        opcodes = self.vm.opcodes
+        total_time = sum(self.ip_times.values()) or 1.0
+
+        def percent(seconds):
+            return f"{100 * seconds / total_time : >6.1f}%"
+
+        lines = [f"{'Segment' : <24}{'Count' : >10}{'Time (ms)' : >12}{'Time' : >8}\n"]
+
+        totals = sorted(self.segment_totals().items(), key=lambda item: item[1][1], reverse=True)
+        for (name, (count, seconds)) in totals[:limit]:
+            lines.append(f"{name : <24}{count : >10}{1000 * seconds : >12.3f}{percent(seconds) : >8}\n")
+
+        lines.append(f"\n{'Opcode' : <24}{'Count' : >10}{'Time (ms)' : >12}{'Time' : >8}\n")
+
+        for (opcode, seconds) in self.opcode_times.most_common(limit):
+            name = opcodes[opcode]['name'] if opcode in opcodes else hex(opcode)
+            count = self.opcode_counts[opcode]
+
+            lines.append(f"{name : <24}{count : >10}{1000 * seconds : >12.3f}{percent(seconds) : >8}\n")
+
+        lines.append(f"\n{'IP' : <24}{'Count' : >10}{'Time (ms)' : >12}{'Time' : >8}\n")
+
+        for (ip, seconds) in self.ip_times.most_common(limit):
+            where = f"{hex(ip)} {self.segment_of(ip)}"
+            count = self.ip_counts[ip]
+
+            lines.append(f"{where : <24}{count : >10}{1000 * seconds : >12.3f}{percent(seconds) : >8}\n")
+
+        return "".join(lines)
+
+    def collapsed(self, weight: str = 'count'):
+        # Collapsed stacks, one "frame;frame;frame weight" line per call
+        # stack, as read by flamegraph.pl and speedscope. weight is either
+        # 'count', instructions executed, or 'time', microseconds.
+
+        if weight == 'count':
+            weights = self.stack_counts
+        elif weight == 'time':
+            weights = collections.Counter({stack: round(1e6 * seconds)
+                                           for (stack, seconds) in self.stack_times.items()})
+        else:
+            raise ValueError(f"Unknown weight {weight}, use 'count' or 'time'.")
+
+        lines = list()
+
+        for (stack, value) in sorted(weights.items()):
+            frames = ";".join(frame.replace(' ', '_').replace(';', '_') for frame in stack)
+            lines.append(f"{frames} {value}\n")
+
+        return "".join(lines)
+
+    def write_collapsed(self, path, weight: str = 'count'):
+
+        with open(path, 'w') as collapsed:
+            collapsed.write(self.collapsed(weight))
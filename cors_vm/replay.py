@@ -0,0 +1,366 @@
+import bisect
+import collections
+import json
+import struct
+import time
+
+import cors_vm.state as state
+
+from cors_vm.devices import InputDevice
+from cors_vm.virtual_machine import VMStatus
+
+# Record and replay of VM sessions
+#
+# A recording is a binary log of the events that cannot be derived from the
+# VM itself, input lines read and budget stops, along with the output for
+# checking a replay against and a checkpoint every checkpoint_interval
+# instructions. Replaying a log runs the same session again, and seeking
+# to an instruction count starts from the nearest checkpoint before it.
+#
+# Header | Config | Record | Record | ...
+#
+# Every record is (kind, instruction count, payload length) followed by the
+# payload. Events are stamped with the instruction count at the end of the
+# run() slice they happened in, their order in the log is exact.
+
+MAGIC = b'CVMR'
+VERSION = 1
+
+# magic, version, config length. The config is JSON.
+HEADER = struct.Struct('>4sBI')
+
+# kind, instruction count, payload length
+RECORD = struct.Struct('>BQI')
+
+# Record kinds
+INPUT = 1
+OUTPUT = 2
+STOP = 3
+CHECKPOINT = 4
+
+CHECKPOINT_INTERVAL = 100000
+
+# Budgets saved in the config, the replay VM uses the same ones. The run
+# time limit is not deterministic and is replayed from STOP records.
+BUDGETS = ('max_instructions', 'max_output_bytes', 'max_memory_writes')
+
+Record = collections.namedtuple('Record', ['kind', 'instruction_count', 'payload'])
+
+
+class Recorder:
+    """ Streams a record of a VM session to a binary file.
+
+    Run the VM through the recorder's run(), which takes the same arguments
+    and returns the same status as VirtualMachineV2.run(). Checkpoints are
+    state.dumps() of the VM, compressed and, after the first, stored as the
+    difference from the memory of the first. Output is kept out of the
+    checkpoints since the log has it already.
+    """
+
+    def __init__(self, vm, file, checkpoint_interval: int = CHECKPOINT_INTERVAL):
+
+        if checkpoint_interval <= 0:
+            raise ValueError('The checkpoint interval must be a positive number of instructions.')
+
+        self.vm = vm
+        self.checkpoint_interval = checkpoint_interval
+
+        if hasattr(file, 'write'):
+            self.file = file
+            self._owns_file = False
+        else:
+            self.file = open(file, 'wb')
+            self._owns_file = True
+
+        # Events of the running slice, written once it ends
+        self._events = list()
+
+        config = {'checkpoint_interval': checkpoint_interval}
+        config.update((name, getattr(vm, name)) for name in BUDGETS)
+        config = json.dumps(config).encode()
+
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(config)) + config)
+
+        vm.output_device.tap = lambda data: self._events.append((OUTPUT, data))
+
+        if vm.input_device is not None:
+            vm.input_device.tap = lambda line: self._events.append((INPUT, line))
+
+        # The first checkpoint has all of the memory, the others only what
+        # differs from it
+        self._baseline = None
+        self._next_checkpoint = vm.instruction_count
+        self._stopped = vm.should_halt()
+
+        self.checkpoint()
+
+    def __repr__(self):
+        return f"Recorder({self.vm.instruction_count} instructions)"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_record(self, kind: int, payload: bytes = b''):
+        self.file.write(RECORD.pack(kind, self.vm.instruction_count, len(payload)) + payload)
+
+    def checkpoint(self):
+
+        vm = self.vm
+        output_device = vm.output_device
+
+        # Output is replayed from the OUTPUT records
+        output = output_device.snapshot()
+        output_device.restore((b'', output[1], output[2]))
+
+        try:
+            self.write_record(CHECKPOINT, state.dumps(vm, baseline=self._baseline))
+        finally:
+            output_device.restore(output)
+
+        if self._baseline is None:
+            self._baseline = bytes(vm.ram.memory)
+
+        self._next_checkpoint = vm.instruction_count + self.checkpoint_interval
+        self.file.flush()
+
+    def _write_events(self):
+
+        for (kind, data) in self._events:
+            self.write_record(kind, data)
+
+        self._events.clear()
+
+        vm = self.vm
+
+        if vm.should_halt() and not self._stopped:
+            self.write_record(STOP, bytes([state.HALT_REASONS.index(vm.halt_reason) + 1]))
+            self._stopped = True
+
+        # A crash loses at most the running slice
+        self.file.flush()
+
+    def run(self, max_steps: int = None, engine=None):
+        # VirtualMachineV2.run(), in slices ending at the checkpoints. The
+        # run time limit applies to the whole call, not to every slice.
+
+        vm = self.vm
+        end = None if max_steps is None else vm.instruction_count + max_steps
+
+        vm._run_started_at = time.time()
+
+        try:
+            while True:
+                steps = self._next_checkpoint - vm.instruction_count
+                if end is not None:
+                    steps = min(steps, end - vm.instruction_count)
+
+                status = vm.run(steps, engine)
+                self._write_events()
+
+                if vm.instruction_count >= self._next_checkpoint and not vm.should_halt():
+                    self.checkpoint()
+
+                if status != VMStatus.RUNNING or (end is not None and vm.instruction_count >= end):
+                    return status
+
+        finally:
+            vm._run_started_at = None
+
+    def close(self):
+
+        self._write_events()
+        self.file.flush()
+
+        self.vm.output_device.tap = None
+
+        if self.vm.input_device is not None:
+            self.vm.input_device.tap = None
+
+        if self._owns_file:
+            self.file.close()
+
+
+class ReplayInput(InputDevice):
+    """ Input device returning the lines read in a recorded session.
+
+    Every line is fed followed by a newline, so the guest reads the same
+    lines in the same pieces. Once they run out the guest waits for input,
+    just as it would have when the recording ended.
+    """
+
+    def __init__(self, lines=()):
+        super().__init__(b''.join(line + b'\n' for line in lines))
+
+    def __repr__(self):
+        return f"ReplayInput({len(self)} bytes)"
+
+
+def stop_reason(record: Record):
+    return state.HALT_REASONS[record.payload[0] - 1]
+
+
+def read_log(data):
+    # Returns (config, records) of a log written by Recorder
+
+    data = memoryview(data)
+
+    if len(data) < HEADER.size:
+        raise ValueError('Not a VM recording, data is too short.')
+
+    (magic, version, config_length) = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise ValueError('Not a VM recording.')
+
+    if version != VERSION:
+        raise ValueError(f'Unsupported VM recording version {version}.')
+
+    offset = HEADER.size
+    config = json.loads(bytes(data[offset:offset + config_length]))
+    offset += config_length
+
+    records = list()
+
+    # A log cut short by a crash is read up to its last whole record
+    while offset + RECORD.size <= len(data):
+        (kind, instruction_count, length) = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+
+        if offset + length > len(data):
+            break
+
+        records.append(Record(kind, instruction_count, bytes(data[offset:offset + length])))
+        offset += length
+
+    return (config, records)
+
+
+class Replay:
+    """ Re-executes a session recorded by Recorder.
+
+        replay = Replay.open('session.cvmr')
+        vm = replay.seek(250000)
+
+    seek() returns a new VM at the given instruction count, run from the
+    nearest checkpoint with the recorded input and stops. replay() runs the
+    whole session and checks its output against the recorded output.
+    """
+
+    def __init__(self, config: dict, records: list):
+
+        self.config = config
+        self.records = records
+
+        # Indices of the checkpoint records and their instruction counts
+        self._checkpoints = [i for (i, record) in enumerate(records) if record.kind == CHECKPOINT]
+        self._checkpoint_counts = [records[i].instruction_count for i in self._checkpoints]
+
+        if not self._checkpoints:
+            raise ValueError('The recording has no checkpoint.')
+
+        self._baseline = None
+
+    def __repr__(self):
+        return f"Replay({len(self.records)} records, {self.instruction_count} instructions)"
+
+    @classmethod
+    def open(cls, path):
+
+        with open(path, 'rb') as log:
+            return cls(*read_log(log.read()))
+
+    @property
+    def instruction_count(self):
+        # Instructions executed when the recording ended
+        return self.records[-1].instruction_count
+
+    @property
+    def output(self):
+        return b''.join(record.payload for record in self.records if record.kind == OUTPUT)
+
+    @property
+    def halt_reason(self):
+
+        for record in self.records:
+            if record.kind == STOP:
+                return stop_reason(record)
+
+        return None
+
+    @property
+    def baseline(self):
+        # Memory of the first checkpoint, later checkpoints are stored
+        # against it
+
+        if self._baseline is None:
+            first = self.records[self._checkpoints[0]]
+            self._baseline = bytes(state.loads(first.payload, trace=False).ram.memory)
+
+        return self._baseline
+
+    def load_checkpoint(self, index: int, **kwargs):
+        # VM restored from the checkpoint record at index, with its output
+        # and the input read after it
+
+        records = self.records
+
+        kwargs.setdefault('trace', False)
+        kwargs.setdefault('max_run_time', None)
+
+        for name in BUDGETS:
+            kwargs.setdefault(name, self.config.get(name))
+
+        vm = state.loads(records[index].payload, baseline=self.baseline, **kwargs)
+
+        (_, written, truncated) = vm.output_device.snapshot()
+        output = b''.join(record.payload for record in records[:index] if record.kind == OUTPUT)
+        vm.output_device.restore((output, written, truncated))
+
+        vm.input_device = ReplayInput(record.payload for record in records[index:]
+                                      if record.kind == INPUT)
+
+        return vm
+
+    def seek(self, instruction_count: int, engine: str = 'run_program', **kwargs):
+        # New VM at instruction_count, or where the session stopped or ran
+        # out of input if that comes first. kwargs are passed on to
+        # VirtualMachineV2.
+
+        position = bisect.bisect_right(self._checkpoint_counts, instruction_count) - 1
+        index = self._checkpoints[max(position, 0)]
+
+        vm = self.load_checkpoint(index, **kwargs)
+        run = getattr(vm, engine)
+
+        stop = None
+        for record in self.records[index:]:
+            if record.kind == STOP:
+                stop = record
+                break
+
+        if stop is not None and stop.instruction_count <= instruction_count:
+            # Budgets like the run time limit are not deterministic, the
+            # VM stops where the recorded one did
+            vm.run(stop.instruction_count - vm.instruction_count, run)
+
+            if not vm.should_halt():
+                vm.stop(stop_reason(stop))
+
+        elif instruction_count > vm.instruction_count:
+            vm.run(instruction_count - vm.instruction_count, run)
+
+        return vm
+
+    def replay(self, engine: str = 'run_program', **kwargs):
+        # Runs the whole session, raises ValueError if the output differs
+        # from the recorded output
+
+        vm = self.seek(self.instruction_count, engine, **kwargs)
+
+        if vm.output_device.getvalue() != self.output or vm.instruction_count != self.instruction_count:
+            raise ValueError(f'Replay diverged from the recording at {vm.instruction_count} instructions.')
+
+        return vm
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+
+import cors_vm.image as image
+
+from cors_vm.devices import InputDevice, OutputDevice
+from cors_vm.virtual_machine import HaltReason, TIME_CHECK_INTERVAL, VMStatus
+
+DEFAULT_PORT = 7337
+
+# Bytes read from a connection at a time
+READ_SIZE = 4096
+
+# Seconds a session may last unless the server is given another limit
+MAX_SESSION_TIME = 60.0
+
+
+class Session:
+    # One connection and the VM serving it
+
+    def __init__(self, vm, reader, writer):
+
+        self.vm = vm
+        self.reader = reader
+        self.writer = writer
+
+        # Set whenever input arrives or the connection is closed
+        self.input_ready = asyncio.Event()
+
+        # Set once the client has closed its side of the connection
+        self.disconnected = False
+
+    def __repr__(self):
+        return f"Session({self.writer.get_extra_info('peername')}, {self.vm.status.value})"
+
+    async def feed_input(self):
+
+        input_device = self.vm.input_device
+
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+
+                if not data:
+                    break
+
+                input_device.feed(data)
+                self.input_ready.set()
+        finally:
+            self.disconnected = True
+
+            input_device.close()
+            self.input_ready.set()
+
+    def client_gone(self, status: VMStatus):
+        # Nobody is left to read the output once the connection is closing,
+        # or the client closed its side and the guest is not reading the
+        # input it left behind
+
+        return self.writer.is_closing() or (self.disconnected and status != VMStatus.WAITING_INPUT)
+
+
+class VMServer:
+    """ Serves a VM image over TCP, one VirtualMachineV2 per connection.
+
+    Output is streamed to the client as the guest writes it and data from
+    the client is fed to the guest's input device. Every session runs in
+    slices of slice_steps instructions, after which the other sessions get
+    to run. Budgets apply per session, max_run_time to every slice and
+    max_session_time to the whole session in seconds. A session also ends
+    once the client has disconnected.
+    """
+
+    def __init__(self, image_path, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                 slice_steps: int = TIME_CHECK_INTERVAL, engine: str = 'run_fast',
+                 max_instructions: int = None, max_output_bytes: int = None,
+                 max_memory_writes: int = None, max_session_time: float = MAX_SESSION_TIME):
+
+        self.image_path = image_path
+        self.host = host
+        self.port = port
+        self.slice_steps = slice_steps
+        self.engine = engine
+
+        self.max_instructions = max_instructions
+        self.max_output_bytes = max_output_bytes
+        self.max_memory_writes = max_memory_writes
+        self.max_session_time = max_session_time
+
+        self.sessions = set()
+        self._server = None
+
+    def __repr__(self):
+        return f"VMServer({self.image_path}, {len(self.sessions)} sessions)"
+
+    def new_vm(self, writer):
+
+        return image.load_image(self.image_path,
+                                trace=False,
+                                output_device=OutputDevice(sink=writer.write, keep=False),
+                                input_device=InputDevice(),
+                                max_instructions=self.max_instructions,
+                                max_output_bytes=self.max_output_bytes,
+                                max_memory_writes=self.max_memory_writes)
+
+    async def start(self):
+        # Starts listening, returns the asyncio.Server. With port 0 the
+        # port picked by the OS is stored in port.
+
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        return self._server
+
+    async def serve_forever(self):
+
+        if self._server is None:
+            await self.start()
+
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def handle(self, reader, writer):
+
+        session = Session(self.new_vm(writer), reader, writer)
+        feeder = asyncio.create_task(session.feed_input())
+
+        self.sessions.add(session)
+
+        try:
+            await self.run_session(session)
+        finally:
+            self.sessions.discard(session)
+            feeder.cancel()
+
+            # Unmap the session's copy of the image
+            session.vm.ram.close()
+
+            writer.close()
+
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def run_session(self, session: Session):
+
+        vm = session.vm
+        engine = getattr(vm, self.engine)
+        loop = asyncio.get_running_loop()
+
+        deadline = None
+        if self.max_session_time is not None:
+            deadline = loop.time() + self.max_session_time
+
+        while True:
+            session.input_ready.clear()
+            status = vm.run(self.slice_steps, engine)
+
+            try:
+                await session.writer.drain()
+            except ConnectionError:
+                return status
+
+            if status in (VMStatus.HALTED, VMStatus.FAULT):
+                return status
+
+            if session.client_gone(status):
+                return status
+
+            if deadline is not None and loop.time() >= deadline:
+                vm.stop(HaltReason.TIME_LIMIT)
+                return vm.status
+
+            if status == VMStatus.WAITING_INPUT:
+                timeout = None if deadline is None else deadline - loop.time()
+
+                try:
+                    await asyncio.wait_for(session.input_ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # Let the other sessions run
+                await asyncio.sleep(0)
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Serve a VM image over TCP.')
+    parser.add_argument('image', help='VM image written by cors_vm.image.write_image()')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--slice-steps', type=int, default=TIME_CHECK_INTERVAL)
+    parser.add_argument('--engine', default='run_fast',
+                        choices=['run_program', 'run_fast', 'run_blocks'])
+    parser.add_argument('--max-instructions', type=int)
+    parser.add_argument('--max-output-bytes', type=int)
+    parser.add_argument('--max-memory-writes', type=int)
+    parser.add_argument('--max-session-time', type=float, default=MAX_SESSION_TIME)
+
+    options = parser.parse_args(args)
+
+    server = VMServer(options.image, options.host, options.port,
+                      slice_steps=options.slice_steps,
+                      engine=options.engine,
+                      max_instructions=options.max_instructions,
+                      max_output_bytes=options.max_output_bytes,
+                      max_memory_writes=options.max_memory_writes,
+                      max_session_time=options.max_session_time)
+
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
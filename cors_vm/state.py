@@ -0,0 +1,184 @@
+import struct
+import zlib
+from array import array
+
+from cors_vm.devices import InputDevice
+from cors_vm.image import pack_segments, unpack_segments
+from cors_vm.virtual_machine import HaltReason, VirtualMachineV2
+
+# Binary VM state, used to move paused VMs between processes
+#
+# Header | Registers | CPU flags | Segment table | Output | Input | Memory
+#
+# The memory is either the full contents or, when dumped against a
+# baseline, (addr, length, data) runs of the bytes that differ from it.
+# Either can be zlib compressed.
+
+MAGIC = b'CVMS'
+VERSION = 2
+
+# magic, version, flags, halt reason, register file size, CPU count,
+# running CPU, next CPU, memory size, instruction count, memory writes,
+# output bytes written, segment count, output length, input length, memory
+# length. The registers of every CPU follow, then a byte per CPU which is
+# 1 if it has halted.
+HEADER = struct.Struct('>4sBBBBBBBIQQQHIII')
+
+# addr, length. Followed by the data.
+RUN = struct.Struct('>II')
+
+# Flags
+SHOULD_HALT = 0x01
+OUTPUT_TRUNCATED = 0x02
+MEMORY_DIFF = 0x04
+MEMORY_COMPRESSED = 0x08
+HAS_INPUT = 0x10
+INPUT_CLOSED = 0x20
+
+# Halt reasons are stored as their index plus one, 0 is None
+HALT_REASONS = tuple(HaltReason)
+
+
+def dumps(vm, baseline: bytes = None, compress: bool = True):
+    # Serializes memory, registers, halt state, segment tables, counters
+    # and pending input and output of vm. With a baseline only memory differing from
+    # it is stored, and loads() needs the same baseline.
+
+    flags = 0
+
+    if vm.should_halt():
+        flags |= SHOULD_HALT
+
+    if vm.output_device.truncated:
+        flags |= OUTPUT_TRUNCATED
+
+    pending_input = b''
+
+    if vm.input_device is not None:
+        (pending_input, closed) = vm.input_device.snapshot()
+        flags |= HAS_INPUT | (INPUT_CLOSED if closed else 0)
+
+    if baseline is None:
+        # Paged memory does not export a buffer
+        memory = bytes(vm.ram.memory)
+    else:
+        flags |= MEMORY_DIFF
+        memory = b''.join(RUN.pack(addr, len(data)) + data for (addr, data) in vm.ram.diff(baseline))
+
+    if compress:
+        flags |= MEMORY_COMPRESSED
+        memory = zlib.compress(memory, 1)
+
+    registers = [value for cpu in vm.cpus for value in cpu.register_file]
+    halt_reason = 0 if vm.halt_reason is None else HALT_REASONS.index(vm.halt_reason) + 1
+    output = vm.output_device.getvalue()
+
+    header = HEADER.pack(MAGIC, VERSION, flags, halt_reason, len(vm.cpu.register_file),
+                         len(vm.cpus), vm.cpus.index(vm.cpu), vm._next_cpu, len(vm.ram),
+                         vm.instruction_count, vm.memory_writes, vm.output_device.written,
+                         len(vm.code_segments) + len(vm.data_segments), len(output),
+                         len(pending_input), len(memory))
+
+    return b''.join((header,
+                     struct.pack(f'>{len(registers)}H', *registers),
+                     bytes(cpu.halted for cpu in vm.cpus),
+                     pack_segments(vm),
+                     output,
+                     pending_input,
+                     memory))
+
+
+def loads(data, vm: VirtualMachineV2 = None, baseline: bytes = None, **kwargs):
+    # Restores state written by dumps() into vm, or into a new
+    # VirtualMachineV2 created with kwargs. Returns the VM.
+
+    data = memoryview(data)
+
+    if len(data) < HEADER.size:
+        raise ValueError('Not a VM state, data is too short.')
+
+    (magic, version, flags, halt_reason, num_slots, num_cpus, current_cpu, next_cpu, memory_size,
+     instruction_count, memory_writes, written, num_segments, output_length, input_length,
+     memory_length) = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise ValueError('Not a VM state.')
+
+    if version != VERSION:
+        raise ValueError(f'Unsupported VM state version {version}.')
+
+    offset = HEADER.size
+    registers = struct.unpack_from(f'>{num_cpus * num_slots}H', data, offset)
+    offset += 2 * num_cpus * num_slots
+
+    halted = bytes(data[offset:offset + num_cpus])
+    offset += num_cpus
+
+    (code_segments, data_segments, offset) = unpack_segments(data, offset, num_segments)
+
+    output = bytes(data[offset:offset + output_length])
+    offset += output_length
+
+    pending_input = bytes(data[offset:offset + input_length])
+    offset += input_length
+
+    memory = data[offset:offset + memory_length]
+
+    if flags & MEMORY_COMPRESSED:
+        memory = memoryview(zlib.decompress(memory))
+
+    if flags & MEMORY_DIFF:
+        if baseline is None or len(baseline) != memory_size:
+            raise ValueError('State was dumped against a baseline, the same baseline is needed.')
+
+        contents = bytearray(baseline)
+        position = 0
+
+        while position < len(memory):
+            (addr, length) = RUN.unpack_from(memory, position)
+            position += RUN.size
+
+            contents[addr:addr + length] = memory[position:position + length]
+            position += length
+
+        memory = contents
+
+    if vm is None:
+        vm = VirtualMachineV2(memory_size=memory_size, num_cpus=num_cpus,
+                              num_registers=num_slots - 3, **kwargs)
+
+    if (len(vm.ram) != memory_size or len(vm.cpus) != num_cpus
+            or len(vm.cpu.register_file) != num_slots):
+        raise ValueError('State does not match the memory size, CPUs or registers of the VM.')
+
+    vm.ram.restore(bytes(memory))
+
+    for (i, cpu) in enumerate(vm.cpus):
+        cpu.register_file[:] = array('H', registers[i * num_slots:(i + 1) * num_slots])
+        cpu.halted = bool(halted[i])
+        cpu.waiting_input = False
+
+    vm.cpu = vm.cpus[current_cpu]
+    vm._next_cpu = next_cpu
+
+    vm.code_segments[:] = code_segments
+    vm.data_segments[:] = data_segments
+
+    vm._should_halt = bool(flags & SHOULD_HALT)
+    vm.halt_reason = HALT_REASONS[halt_reason - 1] if halt_reason else None
+
+    vm.output_device.restore((output, written, bool(flags & OUTPUT_TRUNCATED)))
+
+    if flags & HAS_INPUT:
+        if vm.input_device is None:
+            vm.input_device = InputDevice()
+
+        vm.input_device.restore((pending_input, bool(flags & INPUT_CLOSED)))
+
+    vm.instruction_count = instruction_count
+    vm.memory_writes = memory_writes
+
+    if vm.trace is not None:
+        vm.trace.clear()
+
+    return vm
@@ -0,0 +1,105 @@
+from array import array
+
+TRACE_HEADER = (f"{'IP' : <8}|{' Instruction' : <15} | {'Arguments' : >15}\n"
+                f"-------------------------------------------------\n")
+
+
+class ExecutionTrace:
+    """ Compact record of executed instructions.
+
+    Every entry is stored as four numbers, the instruction pointer, the
+    opcode and up to two arguments, in array backed columns. The human
+    readable table is only rendered when asked for. With a limit the trace
+    keeps the last limit entries in a ring buffer.
+    """
+
+    def __init__(self, opcodes: dict, limit: int = None):
+
+        if limit is not None and limit <= 0:
+            raise ValueError('Trace limit must be a positive number of entries.')
+
+        self.opcodes = opcodes
+        self.limit = limit
+
+        self.clear()
+
+    def __repr__(self):
+        return f"ExecutionTrace({len(self)} entries)"
+
+    def __len__(self):
+
+        if self.limit is None:
+            return self._count
+
+        return min(self._count, self.limit)
+
+    @property
+    def dropped(self):
+        # Number of entries pushed out of the ring buffer
+        return self._count - len(self)
+
+    def clear(self):
+
+        size = self.limit or 0
+
+        self._ip = array('H', bytes(2 * size))
+        self._opcode = array('B', bytes(size))
+        self._arg0 = array('H', bytes(2 * size))
+        self._arg1 = array('H', bytes(2 * size))
+
+        self._count = 0
+
+    def record(self, ip: int, opcode: int, arg0: int = 0, arg1: int = 0):
+
+        if self.limit is None:
+            self._ip.append(ip)
+            self._opcode.append(opcode)
+            self._arg0.append(arg0)
+            self._arg1.append(arg1)
+
+        else:
+            index = self._count % self.limit
+
+            self._ip[index] = ip
+            self._opcode[index] = opcode
+            self._arg0[index] = arg0
+            self._arg1[index] = arg1
+
+        self._count += 1
+
+    def entries(self):
+        # Yields (ip, opcode, arg0, arg1) from the oldest to the newest entry
+
+        if self.limit is None or self._count <= self.limit:
+            indices = range(self._count)
+        else:
+            first = self._count % self.limit
+            indices = [(first + i) % self.limit for i in range(self.limit)]
+
+        for index in indices:
+            yield (self._ip[index], self._opcode[index], self._arg0[index], self._arg1[index])
+
+    def format_entry(self, ip: int, opcode: int, arg0: int, arg1: int):
+
+        ip_print = f"{hex(ip) : <10}"
+        op_name = self.opcodes[opcode]['name']
+        isize = self.opcodes[opcode]['size']
+
+        if isize == 0:
+            return f"{ip_print : <8} {op_name : <15}\n"
+
+        if isize <= 2:
+            args_print = f"{hex(arg0)} "
+        else:
+            args_print = f"{hex(arg0)} {hex(arg1)} "
+
+        return f"{ip_print : <8} {op_name : <15}{args_print : <15}\n"
+
+    def render(self):
+
+        lines = [TRACE_HEADER]
+
+        for entry in self.entries():
+            lines.append(self.format_entry(*entry))
+
+        return "".join(lines)
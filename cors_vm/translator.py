@@ -0,0 +1,510 @@
+import collections
+import sys
+from typing import List
+
+from cors_vm.base_types import uint16_t, uint8_t
+
+# Opcodes that end a basic block: halt, call and ret
+BLOCK_END_OPCODES = (0x0, 0x9, 0xa)
+
+# input may raise WaitingForInput, so it runs as a block of its own and
+# no executed instructions go uncounted
+INPUT_OPCODE = 0xb
+
+# mov and pop into one of these registers moves IP, which also ends a block
+IP_REGISTERS = (0x0, 0x4)
+
+# Opcodes that may write memory, after which a block checks whether it has
+# been invalidated underneath itself or exhausted the memory write budget
+MEMORY_WRITE_OPCODES = (0x4, 0x5, 0x6, 0x9, 0xb)
+
+# out, after which a block checks whether the output budget is exhausted
+OUT_OPCODE = 0x3
+
+MAX_BLOCK_INSTRUCTIONS = 64
+
+# Granularity of the map of memory holding cached blocks
+PAGE_SIZE = 256
+
+# Block factories shared by every VM of the process, keyed by where the
+# block starts and the bytes it was decoded from. Cleared when full.
+BLOCK_CACHE_SIZE = 4096
+_block_factories: dict = dict()
+
+Instruction = collections.namedtuple('Instruction', ['addr', 'opcode', 'args', 'size'])
+Block = collections.namedtuple('Block', ['start', 'length', 'instructions'])
+
+
+def decode_block(vm, start: int, max_instructions: int = MAX_BLOCK_INSTRUCTIONS):
+    # Decodes the straight-line run of instructions starting at start. The
+    # run ends after a block terminator, before an invalid opcode or an
+    # instruction running past the end of memory, or after max_instructions
+    # instructions. input always forms a block by itself.
+
+    memory_size = len(vm.ram)
+    instructions: List = list()
+    addr = start
+
+    while len(instructions) < max_instructions:
+
+        try:
+            opcode = vm.ram.fetch_byte(uint16_t(addr)).uint8
+
+            if opcode not in vm.opcodes:
+                break
+
+            if opcode == INPUT_OPCODE and instructions:
+                break
+
+            args = vm.decode_at(uint16_t(addr), opcode)
+
+        except IndexError:
+            # Past the end of memory, the interpreter reports the fault
+            # once execution gets there
+            break
+        isize = vm.opcodes[opcode]['size']
+
+        instructions.append(Instruction(addr, opcode, args, isize))
+
+        addr = (addr + isize + 1) & 0xffff
+
+        if opcode in BLOCK_END_OPCODES or opcode == INPUT_OPCODE:
+            break
+
+        if opcode == 0x8 and args[1].uint8 in IP_REGISTERS:
+            break
+
+        if opcode == 0x7 and args[0].uint8 in IP_REGISTERS:
+            break
+
+    length = sum(instruction.size + 1 for instruction in instructions)
+
+    return Block(start % memory_size, length, instructions)
+
+
+def find_blocks(vm, max_instructions: int = MAX_BLOCK_INSTRUCTIONS):
+    # Splits every loaded code segment into basic blocks
+
+    blocks: List = list()
+
+    for segment in vm.code_segments:
+        addr = segment.start_addr.uint16
+        end = addr + segment.length
+
+        while addr < end:
+            block = decode_block(vm, addr, max_instructions)
+
+            if not block.instructions:
+                # Skip over an invalid opcode
+                addr += 1
+                continue
+
+            blocks.append(block)
+            addr += block.length
+
+    return blocks
+
+
+# Register numbers held in locals by a running block, IP is written back
+# once the block ends
+LOCAL_REGISTERS = {0x1: 'sp', 0x2: 'bp', 0x3: 'r1'}
+
+
+def _read_register(reg: int, ip: int):
+    # Source of the value of register reg while IP is ip
+
+    if reg in IP_REGISTERS:
+        return hex(ip)
+
+    return LOCAL_REGISTERS.get(reg, f"register_file[cpu.register_slots[{reg}]]")
+
+
+def _write_register(reg: int):
+
+    if reg in IP_REGISTERS:
+        return 'ip'
+
+    return LOCAL_REGISTERS.get(reg, f"register_file[cpu.register_slots[{reg}]]")
+
+
+def _push_source(value: str, size: int):
+    # Source pushing value, the same steps as cors_vm.fast
+
+    return [f"a = (sp - 2) & 0xffff",
+            f"mem[a % {size}] = {value} >> 8",
+            f"mem[(a + 1) % {size}] = {value} & 0xff",
+            f"writes += 1",
+            f"if observers:",
+            f"    notify(a % {size}, 2)",
+            f"sp = a"]
+
+
+def _instruction_source(instruction: Instruction, index: int, size: int):
+    # Source executing one instruction on the locals of a block. IP is
+    # only assigned by instructions moving it, which end the block.
+
+    (opcode, args) = (instruction.opcode, instruction.args)
+    next_ip = (instruction.addr + instruction.size + 1) & 0xffff
+
+    if opcode == 0x90:
+        return []
+
+    if opcode == 0x8:
+        (value, reg) = (args[0].uint16, args[1].uint8)
+        return [f"{_write_register(reg)} = {hex(value)}"]
+
+    if opcode == 0x6:
+        return [f"v = {_read_register(args[0].uint8, next_ip)}"] + _push_source('v', size)
+
+    if opcode == 0x7:
+        return [f"a = sp % {size}",
+                f"v = (mem[a] << 8) | mem[a + 1]",
+                f"{_write_register(args[0].uint8)} = v",
+                f"sp = (sp + 2) & 0xffff"]
+
+    if opcode == 0x9:
+        reg = args[0].uint8
+        target = hex(next_ip) if reg in IP_REGISTERS else LOCAL_REGISTERS.get(
+            reg, f"register_file[cpu.register_slots[{reg}]]")
+
+        return (_push_source(hex(next_ip), size) + _push_source('bp', size) +
+                [f"bp = sp", f"ip = {target}"])
+
+    if opcode == 0xa:
+        return [f"a = sp % {size}",
+                f"bp = (mem[a] << 8) | mem[a + 1]",
+                f"sp = (sp + 2) & 0xffff",
+                f"a = sp % {size}",
+                f"ip = (mem[a] << 8) | mem[a + 1]",
+                f"sp = bp"]
+
+    if opcode == 0x3:
+        return [f"f{index}(a{index})"]
+
+    if opcode == 0x4:
+        (value, addr) = (args[0].uint16, args[1].uint16)
+        return [f"mem[{hex(addr % size)}] = {hex(value >> 8)}",
+                f"mem[{hex((addr + 1) % size)}] = {hex(value & 0xff)}",
+                f"writes += 1",
+                f"if observers:",
+                f"    notify({hex(addr % size)}, 2)"]
+
+    if opcode == 0x5:
+        (addr, value) = (args[0].uint16, args[1].uint8)
+        return [f"mem[{hex(addr % size)}] = {hex(value)}",
+                f"writes += 1",
+                f"if observers:",
+                f"    notify({hex(addr % size)}, 1)"]
+
+    if opcode == 0x0:
+        return [f"f{index}()"]
+
+    # input and anything else runs the interpreter's handler on the
+    # registers written back
+    call = f"f{index}()" if instruction.size == 0 else f"f{index}(a{index})"
+
+    return [f"register_file[0] = {hex(next_ip)}",
+            f"register_file[1] = sp",
+            f"register_file[2] = bp",
+            f"register_file[3] = r1",
+            f"ram.write_count = writes",
+            f"try:",
+            f"    {call}",
+            f"finally:",
+            f"    ip = register_file[0]",
+            f"    sp = register_file[1]",
+            f"    bp = register_file[2]",
+            f"    r1 = register_file[3]",
+            f"    writes = ram.write_count"]
+
+
+def _operand_source(arg):
+
+    if isinstance(arg, uint8_t):
+        return f"uint8_t({hex(arg.uint8)})"
+
+    return f"uint16_t({hex(arg.uint16)})"
+
+
+def block_source(block: Block, memory_size: int):
+    # Generates the source of a factory function which, given a VM, returns
+    # a function executing the whole block. Like cors_vm.fast the block
+    # keeps SP, BP, Reg01 and the write count in locals, operands are
+    # constants and IP is written back once, when the block ends. The
+    # returned function reports how many instructions it executed. When an
+    # instruction raises, the instructions completed before it are left in
+    # translator.executed and the registers are as the interpreter leaves
+    # them.
+
+    name = f"block_{block.start:04x}"
+    instructions = block.instructions
+    count = len(instructions)
+    next_ips = tuple((i.addr + i.size + 1) & 0xffff for i in instructions)
+
+    lines = [f"def make_{name}(vm):",
+             f"    ram = vm.ram",
+             f"    output_device = vm.output_device",
+             f"    observers = ram._write_observers",
+             f"    notify = ram._notify_write",
+             f"    next_ips = {next_ips!r}"]
+
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode in (0x90, 0x8, 0x6, 0x7, 0x9, 0xa, 0x4, 0x5):
+            continue
+
+        operands = "".join(f"{_operand_source(arg)}, " for arg in instruction.args)
+
+        lines.append(f"    f{index} = vm.opcodes[{hex(instruction.opcode)}]['func']")
+        lines.append(f"    a{index} = ({operands})")
+
+    lines += [f"    def {name}(translator):",
+              f"        mem = ram.memory",
+              f"        cpu = vm.cpu",
+              f"        register_file = cpu.register_file",
+              f"        sp = register_file[1]",
+              f"        bp = register_file[2]",
+              f"        r1 = register_file[3]",
+              f"        writes = ram.write_count",
+              f"        ip = {hex(next_ips[-1])}",
+              f"        done = 0",
+              f"        try:",
+              f"            while True:"]
+
+    for index, instruction in enumerate(instructions):
+        body = _instruction_source(instruction, index, memory_size)
+
+        if body and index:
+            lines.append(f"                done = {index}")
+
+        lines.extend(f"                {line}" for line in body)
+
+        if index + 1 == count:
+            break
+
+        # Stop where run_program() would check the budgets
+        if instruction.opcode in MEMORY_WRITE_OPCODES:
+            lines.append(f"                if translator.invalidated or writes > translator.write_limit:")
+            lines.append(f"                    ip = {hex(next_ips[index])}")
+            lines.append(f"                    done = {index + 1}")
+            lines.append(f"                    break")
+
+        elif instruction.opcode == OUT_OPCODE:
+            lines.append(f"                if output_device.truncated:")
+            lines.append(f"                    ip = {hex(next_ips[index])}")
+            lines.append(f"                    done = {index + 1}")
+            lines.append(f"                    break")
+
+    lines += [f"                done = {count}",
+              f"                break",
+              f"        except BaseException:",
+              f"            translator.executed = done",
+              f"            register_file[0] = next_ips[done]",
+              f"            register_file[1] = sp",
+              f"            register_file[2] = bp",
+              f"            register_file[3] = r1",
+              f"            ram.write_count = writes",
+              f"            raise",
+              f"        register_file[0] = ip",
+              f"        register_file[1] = sp",
+              f"        register_file[2] = bp",
+              f"        register_file[3] = r1",
+              f"        ram.write_count = writes",
+              f"        return done",
+              f"    return {name}"]
+
+    return (f"make_{name}", "\n".join(lines) + "\n")
+
+
+def block_code(vm, block: Block):
+    # The bytes of memory a block was decoded from
+
+    memory = vm.ram.memory
+    end = block.start + block.length
+
+    if end <= len(vm.ram):
+        return bytes(memory[block.start:end])
+
+    return bytes(memory[block.start:]) + bytes(memory[:end - len(vm.ram)])
+
+
+def compile_block(vm, block: Block):
+    # Returns the block's function bound to vm. The source is only compiled
+    # the first time the same code is seen at the same address.
+
+    key = (block.instructions[0].addr, len(vm.ram), block_code(vm, block))
+    factory = _block_factories.get(key)
+
+    if factory is None:
+        (factory_name, source) = block_source(block, len(vm.ram))
+
+        namespace = {'uint16_t': uint16_t, 'uint8_t': uint8_t}
+        exec(compile(source, f"<block {hex(block.start)}>", 'exec'), namespace)
+
+        if len(_block_factories) >= BLOCK_CACHE_SIZE:
+            _block_factories.clear()
+
+        factory = _block_factories[key] = namespace[factory_name]
+
+    return factory(vm)
+
+
+class BlockTranslator:
+    """ Translates and caches basic blocks of a VirtualMachineV2 """
+
+    def __init__(self, vm, max_block_instructions: int = MAX_BLOCK_INSTRUCTIONS):
+
+        self.vm = vm
+        self.max_block_instructions = max_block_instructions
+
+        # start address -> (block, compiled function)
+        self.blocks: dict = dict()
+
+        # Flags every page holding part of a cached block, and the start
+        # addresses of the blocks on each flagged page
+        self._block_pages = bytearray(-(-len(vm.ram) // PAGE_SIZE))
+        self._page_blocks: dict = dict()
+
+        # Set when a write drops a cached block, checked by running blocks
+        # after each instruction that may write memory.
+        self.invalidated = False
+
+        # Instructions a block completed before one of them raised
+        self.executed = 0
+
+        # RAM write count past which blocks stop, set by run_blocks()
+        self.write_limit = sys.maxsize
+
+        # Last block made by translate(), which is not cached but has to
+        # notice writes to itself all the same
+        self._transient = None
+
+        vm.ram.add_write_observer(self._invalidate)
+
+    def __repr__(self):
+        return f"BlockTranslator({len(self.blocks)} blocks)"
+
+    def lookup(self, start: int):
+        # Returns the compiled function for the block at start, translating
+        # it if needed, or None if there is no valid instruction at start.
+
+        cached = self.blocks.get(start)
+
+        if cached is not None:
+            return cached[1]
+
+        block = decode_block(self.vm, start, self.max_block_instructions)
+
+        if not block.instructions:
+            return None
+
+        return self.install(block, compile_block(self.vm, block))
+
+    def translate(self, start: int, max_instructions: int):
+        # Translates a block of at most max_instructions instructions
+        # without caching it.
+
+        block = decode_block(self.vm, start, max_instructions)
+
+        if not block.instructions:
+            return None
+
+        self._transient = block
+
+        return compile_block(self.vm, block)
+
+    def install(self, block: Block, func):
+
+        self.blocks[block.start] = (block, func)
+
+        for page in self._pages(block.start, block.length):
+            self._block_pages[page] = 1
+            self._page_blocks.setdefault(page, set()).add(block.start)
+
+        return func
+
+    def _pages(self, addr: int, length: int):
+        # Pages holding addr up to addr + length, which may wrap around the
+        # end of memory
+
+        num_pages = len(self._block_pages)
+        first = addr // PAGE_SIZE
+
+        return {page % num_pages for page in range(first, (addr + max(length, 1) - 1) // PAGE_SIZE + 1)}
+
+    def find_blocks(self):
+
+        return find_blocks(self.vm, self.max_block_instructions)
+
+    def translate_segments(self):
+
+        for block in self.find_blocks():
+            if block.start not in self.blocks:
+                self.install(block, compile_block(self.vm, block))
+
+    def flush(self):
+
+        self.blocks.clear()
+        self._block_pages = bytearray(len(self._block_pages))
+        self._page_blocks.clear()
+        self._transient = None
+
+    def _invalidate(self, addr: int, length: int):
+
+        memory_size = len(self.vm.ram)
+
+        # All of memory, like a restore() or reset()
+        if length >= memory_size:
+            if self.blocks or self._transient is not None:
+                self.invalidated = True
+
+            self.flush()
+            return
+
+        transient = self._transient
+        if transient is not None:
+            for offset in range(length):
+                if (addr + offset - transient.start) % memory_size < transient.length:
+                    self.invalidated = True
+                    break
+
+        block_pages = self._block_pages
+
+        if length <= PAGE_SIZE:
+            # Guest writes, at most two pages
+            first = addr // PAGE_SIZE
+            last = ((addr + length - 1) // PAGE_SIZE) % len(block_pages)
+
+            if not (block_pages[first] or block_pages[last]):
+                return
+
+        pages = [page for page in self._pages(addr, length) if block_pages[page]]
+
+        starts = set()
+        for page in pages:
+            starts.update(self._page_blocks[page])
+
+        for start in starts:
+            cached = self.blocks.get(start)
+
+            if cached is None:
+                continue
+
+            block = cached[0]
+
+            for offset in range(length):
+                if (addr + offset - start) % memory_size < block.length:
+                    self._drop(start, block)
+                    break
+
+    def _drop(self, start: int, block: Block):
+
+        del self.blocks[start]
+        self.invalidated = True
+
+        for page in self._pages(start, block.length):
+            blocks = self._page_blocks.get(page, set())
+            blocks.discard(start)
+
+            if not blocks and page in self._page_blocks:
+                del self._page_blocks[page]
+                self._block_pages[page] = 0
@@ -2,20 +2,124 @@ import random
 import time
 
 import collections
+import enum
+import mmap
+import sys
+from array import array
 from typing import List
 
+import cors_vm.fast
+
 from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.devices import InputDevice, OutputDevice
+from cors_vm.trace import ExecutionTrace
+from cors_vm.translator import BlockTranslator
 
 Segment = collections.namedtuple('Segment', ['name', 'start_addr', 'length'])
 
+# State captured by VirtualMachineV2.snapshot()
+VMSnapshot = collections.namedtuple('VMSnapshot', ['memory', 'registers', 'code_segments',
+                                                   'data_segments', 'should_halt', 'halt_reason',
+                                                   'output', 'instruction_count', 'memory_writes',
+                                                   'input', 'cpus'])
+
 MAX_RUN_TIME = 2.0  # Two seconds
 
+# Opcode plus at most four bytes of arguments
+MAX_INSTRUCTION_SIZE = 5
+
+# Granularity used when restoring memory from a snapshot
+PAGE_SIZE = 256
+
+# Instructions executed between checks of the wall clock
+TIME_CHECK_INTERVAL = 1024
+
+# Instructions a CPU runs before the next one gets its turn
+QUANTUM = 64
+
+# Bytes between the initial stack pointers of consecutive CPUs
+STACK_SIZE = 0x1000
+
+# Bytes the input instruction reads, a 256 byte buffer plus the saved BP
+# and IP
+INPUT_SIZE = 260
+
+class HaltReason(enum.Enum):
+
+    HALT = 'halt'
+    INVALID_INSTRUCTION = 'invalid instruction'
+    INSTRUCTION_LIMIT = 'instruction limit'
+    TIME_LIMIT = 'time limit'
+    OUTPUT_LIMIT = 'output limit'
+    MEMORY_WRITE_LIMIT = 'memory write limit'
+    FAULT = 'fault'
+
+class VMStatus(enum.Enum):
+
+    RUNNING = 'running'
+    HALTED = 'halted'
+    FAULT = 'fault'
+    WAITING_INPUT = 'waiting for input'
+
+# Halt reasons reported as VMStatus.FAULT, any other reason is HALTED
+FAULT_REASONS = (HaltReason.INVALID_INSTRUCTION, HaltReason.FAULT)
+
+class HookEvent(enum.Enum):
+    # Callbacks registered with VirtualMachineV2.add_hook() are called as
+    #
+    # BEFORE_INSTRUCTION, AFTER_INSTRUCTION   (vm, ip, opcode, args)
+    # MEMORY_READ, MEMORY_WRITE               (vm, addr, length)
+    # CALL, RET                               (vm, ip, new_ip)
+    # HALT                                    (vm, reason)
+
+    BEFORE_INSTRUCTION = 'before instruction'
+    AFTER_INSTRUCTION = 'after instruction'
+    MEMORY_READ = 'memory read'
+    MEMORY_WRITE = 'memory write'
+    CALL = 'call'
+    RET = 'ret'
+    HALT = 'halt'
+
+# Opcodes reported as HookEvent.CALL and HookEvent.RET
+CALL_OPCODE = 0x9
+RET_OPCODE = 0xa
+
+class WaitingForInput(Exception):
+    # Raised by the input instruction when its input device has no line
+    # to read yet. The instruction has not changed any state.
+    pass
+
 class RandomAccessMemory:
 
-    def __init__(self, size: int = 32768):
+    def __init__(self, size: int = 32768, buffer=None):
+
+        # Memory is a private bytearray unless another writable buffer of
+        # size bytes, like an mmap, is given.
+        if buffer is None:
+            buffer = bytearray(size)
+        elif len(buffer) != size:
+            raise ValueError('Buffer does not match memory size.')
 
         self._memory_size = size
-        self._memory: bytearray = bytearray(size)
+        self._memory = buffer
+
+        # Number of write_byte/write_word calls
+        self.write_count = 0
+
+        # Callables notified with (addr, length) after every write, used to
+        # drop cached decodes of memory that has changed.
+        self._write_observers: List = list()
+
+        # Callables notified with (addr, length) after every read_byte and
+        # read_word, see add_read_observer()
+        self._read_observers: List = list()
+
+        # One byte per page, set when the page is written. None unless
+        # track_dirty() has been called.
+        self._dirty = None
+        self._dirty_baseline = None
+        self._page_size = PAGE_SIZE
+        self._page_shift = PAGE_SIZE.bit_length() - 1
 
     def __repr__(self):
         return f"RAM({self._memory_size})"
@@ -23,13 +127,322 @@ class RandomAccessMemory:
     def __len__(self):
         return len(self._memory)
 
+    @classmethod
+    def anonymous(cls, size: int = 32768):
+        # Memory backed by an anonymous mmap
+        return cls(size, mmap.mmap(-1, size))
+
+    @classmethod
+    def map_file(cls, path, size: int, offset: int = 0, shared: bool = False):
+        # Maps size bytes of a file, starting at offset, as memory. offset
+        # must be a multiple of mmap.ALLOCATIONGRANULARITY. Unless shared 
+        # is set, writes stay private to this memory and pages that are 
+        # only read are shared with every other mapping of the file.
+
+        access = mmap.ACCESS_WRITE if shared else mmap.ACCESS_COPY
+
+        with open(path, 'r+b' if shared else 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), size, access=access, offset=offset)
+
+        return cls(size, buffer)
+
+    @property
+    def mapped(self):
+        return isinstance(self._memory, mmap.mmap)
+
+    def close(self):
+        # Unmaps mmap backed memory, a no-op otherwise
+
+        if self.mapped:
+            self._memory.close()
+
     def reset(self):
-        self._memory = bytearray(self._memory_size)
+
+        if self.mapped:
+            self._memory[:] = bytes(self._memory_size)
+        else:
+            self._memory = bytearray(self._memory_size)
+
+        self._notify_write(0, self._memory_size)
+
+    def load(self, addr: int, data):
+        # Copies any buffer (bytes, bytearray, mmap, ...) into memory at
+        # addr with a single slice assignment. Returns the number of bytes
+        # loaded. Loading does not count as writes by the guest.
+
+        view = memoryview(data).cast('B')
+        length = len(view)
+
+        if addr < 0 or addr + length > self._memory_size:
+            raise ValueError('Segmentation fault, loading outside MAX memory_size.')
+
+        self.memory[addr:addr + length] = view
+
+        if self._write_observers:
+            self._notify_write(addr, length)
+
+        return length
+
+    # Dirty page tracking
+
+    def track_dirty(self, page_size: int = PAGE_SIZE):
+        # Starts recording which pages are written, in a bitmap with one
+        # byte per page. page_size must be a power of two.
+
+        if page_size <= 0 or page_size & (page_size - 1):
+            raise ValueError('Page size must be a power of two.')
+
+        if self._dirty is None:
+            self.add_write_observer(self._mark_dirty)
+
+        self._page_size = page_size
+        self._page_shift = page_size.bit_length() - 1
+        self._dirty = bytearray(-(-self._memory_size // page_size))
+        self._dirty_baseline = None
+
+    @property
+    def tracking_dirty(self):
+        return self._dirty is not None
+
+    @property
+    def page_size(self):
+        return self._page_size
+
+    def _mark_dirty(self, addr: int, length: int):
+
+        dirty = self._dirty
+
+        if length <= self._page_size:
+            # Guest writes, at most two pages
+            dirty[addr >> self._page_shift] = 1
+            dirty[((addr + length - 1) >> self._page_shift) % len(dirty)] = 1
+            return
+
+        first = addr >> self._page_shift
+        last = (addr + length - 1) >> self._page_shift
+
+        if last < len(dirty):
+            for page in range(first, last + 1):
+                dirty[page] = 1
+        else:
+            # The write wrapped around the end of memory
+            for page in range(first, last + 1):
+                dirty[page % len(dirty)] = 1
+
+    def dirty_pages(self):
+        # Indices of the pages written since tracking started or was cleared
+
+        if self._dirty is None:
+            raise ValueError('Dirty page tracking is not enabled.')
+
+        dirty = self._dirty
+        pages = list()
+
+        page = dirty.find(1)
+        while page != -1:
+            pages.append(page)
+            page = dirty.find(1, page + 1)
+
+        return pages
+
+    def clear_dirty(self):
+
+        if self._dirty is not None:
+            self._dirty = bytearray(len(self._dirty))
+            self._dirty_baseline = None
+
+    def _pages_to_compare(self, baseline: bytes):
+        # Pages that may differ from baseline. Without tracking, or if
+        # baseline is not the snapshot the dirty pages are relative to,
+        # that is all of them.
+
+        if self._dirty is not None and baseline is self._dirty_baseline:
+            return self.dirty_pages()
+
+        return range(-(-self._memory_size // self._page_size))
+
+    def diff(self, baseline: bytes):
+        # Returns the bytes that differ from baseline as a list of 
+        # (addr, data) runs. If baseline is the last snapshot() taken with
+        # dirty page tracking, only dirty pages are compared.
+
+        if len(baseline) != self._memory_size:
+            raise ValueError('Baseline does not match memory size.')
+
+        memory = self.memory
+        runs = list()
+        page_size = self._page_size
+
+        for page in self._pages_to_compare(baseline):
+            start = page * page_size
+            end = min(start + page_size, self._memory_size)
+
+            if memory[start:end] == baseline[start:end]:
+                continue
+
+            addr = start
+            while addr < end:
+                if memory[addr] == baseline[addr]:
+                    addr += 1
+                    continue
+
+                run_start = addr
+                while addr < end and memory[addr] != baseline[addr]:
+                    addr += 1
+
+                # Runs continuing from the previous page are merged
+                if runs and runs[-1][0] + len(runs[-1][1]) == run_start:
+                    runs[-1] = (runs[-1][0], runs[-1][1] + bytes(memory[run_start:addr]))
+                else:
+                    runs.append((run_start, bytes(memory[run_start:addr])))
+
+        return runs
+
+    def apply_diff(self, runs):
+
+        for (addr, data) in runs:
+            self.load(addr, data)
+
+    def snapshot(self):
+        # With dirty page tracking the snapshot becomes the baseline that
+        # the dirty pages are relative to.
+
+        snapshot = bytes(self.memory)
+
+        if self._dirty is not None:
+            self.clear_dirty()
+            self._dirty_baseline = snapshot
+
+        return snapshot
+
+    def restore(self, snapshot: bytes, page_size: int = PAGE_SIZE):
+        # If the snapshot is the dirty page baseline only dirty pages that
+        # differ from it are copied back, so that cached decodes of
+        # unchanged memory survive. Otherwise all of memory is copied at
+        # once and every cached decode dropped. Returns the number of pages
+        # restored.
+
+        if len(snapshot) != self._memory_size:
+            raise ValueError('Snapshot does not match memory size.')
+
+        memory = self.memory
+
+        if self._dirty is None or snapshot is not self._dirty_baseline:
+            if memory == snapshot:
+                return 0
+
+            memory[:] = snapshot
+
+            if self._write_observers:
+                self._notify_write(0, self._memory_size)
+
+            if self._dirty is not None:
+                self.clear_dirty()
+                self._dirty_baseline = snapshot
+
+            return -(-self._memory_size // page_size)
+
+        page_size = self._page_size
+        pages = self.dirty_pages()
+
+        restored = 0
+
+        for page in pages:
+            addr = page * page_size
+            end = min(addr + page_size, self._memory_size)
+
+            if memory[addr:end] != snapshot[addr:end]:
+                memory[addr:end] = snapshot[addr:end]
+                restored += 1
+
+                if self._write_observers:
+                    self._notify_write(addr, end - addr)
+
+        if self._dirty is not None:
+            self.clear_dirty()
+            self._dirty_baseline = snapshot
+
+        return restored
+
+    def add_write_observer(self, callback):
+        self._write_observers.append(callback)
+
+    def remove_write_observer(self, callback):
+        self._write_observers.remove(callback)
+
+    def _notify_write(self, addr: int, length: int):
+        for callback in self._write_observers:
+            callback(addr, length)
+
+    def add_read_observer(self, callback):
+        # read_byte and read_word are only replaced by observed versions
+        # while there are read observers, reads cost nothing extra otherwise.
+
+        if not self._read_observers:
+            self.read_byte = self._observed_read_byte
+            self.read_word = self._observed_read_word
+
+        self._read_observers.append(callback)
+
+    def remove_read_observer(self, callback):
+
+        self._read_observers.remove(callback)
+
+        if not self._read_observers:
+            del self.read_byte
+            del self.read_word
+
+    def _observed_read_byte(self, addr: uint16_t):
+
+        value = type(self).read_byte(self, addr)
+
+        for callback in self._read_observers:
+            callback(addr.uint16, 1)
+
+        return value
+
+    def _observed_read_word(self, addr: uint16_t):
+
+        value = type(self).read_word(self, addr)
+
+        for callback in self._read_observers:
+            callback(addr.uint16 % self._memory_size, 2)
+
+        return value
+
+    # Reads made to fetch and decode instructions, read observers are not
+    # notified of them.
+
+    def fetch_byte(self, addr: uint16_t):
+        return type(self).read_byte(self, addr)
+
+    def fetch_word(self, addr: uint16_t):
+        return type(self).read_word(self, addr)
 
     @property
     def memory(self):
         return self._memory
 
+    def find(self, sub: bytes, start: int, end: int):
+        # memory.find() of a single byte, also for memory in a buffer
+        # without one. Read observers are notified of the bytes searched.
+
+        memory = self.memory
+
+        if isinstance(memory, memoryview):
+            found = bytes(memory[start:end]).find(sub)
+            found = found if found == -1 else start + found
+        else:
+            found = memory.find(sub, start, end)
+
+        if self._read_observers and start < end:
+            length = end - start if found == -1 else found + 1 - start
+
+            for callback in self._read_observers:
+                callback(start, length)
+
+        return found
+
     def read_byte(self, addr: uint16_t):
 
         val = self.memory[addr.uint16]
@@ -38,10 +451,11 @@ class RandomAccessMemory:
 
     def read_word(self, addr: uint16_t):
 
-        src_addr = addr.uint16 & self._memory_size  # Truncate to max_memory
+        src_addr = addr.uint16 % self._memory_size  # Truncate to max_memory
 
-        if src_addr + 1 > self._memory_size:
-            raise ValueError('Segmentation fault, reading outside MAX memory_size.')
+        # Addresses past the end wrap, but a word does not
+        if src_addr + 1 >= self._memory_size:
+            raise IndexError('Segmentation fault, reading outside MAX memory_size.')
 
         val = ((self.memory[src_addr]) << 8) + (self.memory[src_addr + 1])
 
@@ -52,51 +466,110 @@ class RandomAccessMemory:
 
         self.memory[addr.uint16 % self._memory_size] = value.ho_byte
         self.memory[(addr.uint16 + 1) % self._memory_size] = value.lo_byte
+        self.write_count += 1
+
+        if self._write_observers:
+            self._notify_write(addr.uint16 % self._memory_size, 2)
 
     def write_byte(self, args):
 
         (value, addr) = args
 
         self.memory[addr.uint16 % self._memory_size] = value.uint8 
+        self.write_count += 1
+
+        if self._write_observers:
+            self._notify_write(addr.uint16 % self._memory_size, 1)
+
+# Slots of the special registers in a CPU's register file
+(IP, SP, BP, REG01) = range(4)
+
+REGISTER_NAMES = ("Instruction Pointer",
+                  "Stack Pointer",
+                  "Base Pointer",
+                  "Register 01")
+
+# Register number -> slot in the register file. Register 4 is an alias of
+# the instruction pointer, additional general purpose registers are 
+# numbered from 5.
+REGISTER_SLOTS = (IP, SP, BP, REG01, IP)
+
+class Register(uint16_t):
+
+    # uint16_t reading and writing one slot of a register file
+    __slots__ = ('_file', '_slot')
+
+    def __init__(self, register_file, slot: int):
+        self._file = register_file
+        self._slot = slot
+
+    @property
+    def uint16(self):
+        return self._file[self._slot]
+
+    @uint16.setter
+    def uint16(self, value):
+        self._file[self._slot] = value & 0xffff
 
 class CentralProcessingUnit:
 
-    def __init__(self, ram):
+    def __init__(self, ram, num_registers: int = 1, stack_top: int = 0x7fff):
         
         self.ram = ram
 
-        self._reg01 = uint16_t(0)
-        self._reg02 = 0
-        self._reg03 = 0
-        self._reg04 = 0
-
-        self._ip = uint16_t(0x0000)
-        self._sp = uint16_t(0x7fff)
-        self._bp = uint16_t(0x7fff)
-
-        self.registers = {
-            0: {"name": "Instruction Pointer",
-                "value": self.ip},
-            1: {"name": "Stack Pointer",
-                "value": self.sp},
-            2: {"name": "Base Pointer",
-                "value": self.bp},
-            3: {"name": "Register 01",
-                "value": self.reg01},
-            4: {"name": "Instruction Pointer",
-                "value": self.ip}
-            }
+        if num_registers < 1:
+            raise ValueError('A CPU needs at least one general purpose register.')
+
+        # IP, SP, BP followed by the general purpose registers
+        self.register_file = array('H', [0x0000, stack_top, stack_top] + [0] * num_registers)
+
+        self.register_slots = REGISTER_SLOTS + tuple(range(REG01 + 1, REG01 + num_registers))
+
+        # One Register per register number
+        self._registers = tuple(Register(self.register_file, slot) for slot in self.register_slots)
+
+        self._ip = self._registers[0]
+        self._sp = self._registers[1]
+        self._bp = self._registers[2]
+        self._reg01 = self._registers[3]
+
+        # Scheduling state, used by VirtualMachineV2 with several CPUs
+        self.halted = False
+        self.waiting_input = False
 
     def __repr__(self):
         return f"CPU({self.ram})"
 
+    @property
+    def num_registers(self):
+        # Number of register numbers, including the IP alias
+        return len(self.register_slots)
+
+    def register(self, index: int):
+        return self._registers[index]
+
+    def register_name(self, index: int):
+
+        slot = self.register_slots[index]
+
+        if slot < len(REGISTER_NAMES):
+            return REGISTER_NAMES[slot]
+
+        return f"Register {slot - REG01 + 1:02}"
+
+    def read_register(self, index: int):
+        return self.register_file[self.register_slots[index]]
+
+    def write_register(self, index: int, value: int):
+        self.register_file[self.register_slots[index]] = value & 0xffff
+
     @property
     def ip(self):
         return self._ip
 
     @ip.setter
     def ip(self, addr: uint16_t):
-        self._ip = addr
+        self._ip.uint16 = addr.uint16
 
     @property
     def sp(self):
@@ -104,7 +577,7 @@ class CentralProcessingUnit:
     
     @sp.setter
     def sp(self, addr: uint16_t):
-        self._sp = addr
+        self._sp.uint16 = addr.uint16
 
     @property
     def bp(self):
@@ -112,7 +585,7 @@ class CentralProcessingUnit:
     
     @bp.setter
     def bp(self, addr: uint16_t):
-        self._bp = addr
+        self._bp.uint16 = addr.uint16
 
     @property
     def reg01(self):
@@ -120,7 +593,7 @@ class CentralProcessingUnit:
 
     @reg01.setter
     def reg01(self, value: uint16_t):
-        self._reg01 = value
+        self._reg01.uint16 = value.uint16
 
     # Instructions
 
@@ -128,33 +601,40 @@ class CentralProcessingUnit:
 
         (value, reg) = args
         
-        self.registers[reg.uint8]['value'].uint16 = value.uint16
+        self.write_register(reg.uint8, value.uint16)
 
     def push_reg(self, args):
 
         (reg) = args
+
+        # Decoded instructions pass a tuple of arguments
+        if isinstance(reg, tuple):
+            (reg, ) = reg
         
         # Stack grows downards, reduce by two bytes and then write value to 
         # the address pointed to by cpu.sp
              
-        value = self.registers[reg.uint8]['value'].uint16
+        value = self._registers[reg.uint8]
 
         # Write it to the stack
-        self.ram.write_word((uint16_t(value), self.sp - 2))
+        self.ram.write_word((value, self.sp - 2))
 
         # Decrement stackpointer to accomodate the new 
 
-        self.sp.uint16 -= 2
+        self.sp.isub(2)
 
     def pop_reg(self, args):
 
         (reg) = args
 
+        if isinstance(reg, tuple):
+            (reg, ) = reg
+
         word = self.ram.read_word(self.sp)
 
-        self.registers[reg.uint8]['value'].uint16 = word.uint16
+        self.write_register(reg.uint8, word.uint16)
 
-        self.sp.uint16 += 2
+        self.sp.iadd(2)
         
     def no_operation(self):
         return
@@ -165,19 +645,103 @@ class VirtualMachineV2:
                  program: bytes = b'', 
                  data: List[tuple] = [], 
                  memory_size: int = 32768, 
-                 num_cpus: int = 1):
-
-        self.ram = RandomAccessMemory(memory_size)
-        self.cpu = CentralProcessingUnit(self.ram)
+                 num_cpus: int = 1,
+                 num_registers: int = 1,
+                 quantum: int = QUANTUM,
+                 stack_size: int = STACK_SIZE,
+                 decode_cache: bool = True,
+                 track_dirty: bool = False,
+                 trace: bool = True,
+                 trace_limit: int = None,
+                 output_device: OutputDevice = None,
+                 input_device: InputDevice = None,
+                 ram: RandomAccessMemory = None,
+                 max_instructions: int = None,
+                 max_run_time: float = MAX_RUN_TIME,
+                 time_check_interval: int = TIME_CHECK_INTERVAL,
+                 max_output_bytes: int = None,
+                 max_memory_writes: int = None):
+
+        # Any RandomAccessMemory, for example a CopyOnWriteMemory sharing
+        # its pages with other VMs. memory_size is ignored if ram is given.
+        self.ram = ram if ram is not None else RandomAccessMemory(memory_size)
+
+        if num_cpus < 1:
+            raise ValueError('A VM needs at least one CPU.')
+
+        if 0x7fff - (num_cpus - 1) * stack_size < 0:
+            raise ValueError('Not room for the stacks of every CPU.')
+
+        # The CPUs share memory, each with its stack stack_size bytes below
+        # the one of the previous CPU. cpu is the CPU executing, the others
+        # are started with start_cpu() and take turns running quantum
+        # instructions, see run().
+        self.cpus = [CentralProcessingUnit(self.ram, num_registers, 0x7fff - i * stack_size)
+                     for i in range(num_cpus)]
+        self.cpu = self.cpus[0]
+
+        for cpu in self.cpus[1:]:
+            cpu.halted = True
+
+        self.quantum = quantum
+        self._next_cpu = 0
+
+        if track_dirty:
+            self.ram.track_dirty()
+
+        # Predecoded instructions keyed by address, see _fetch_decoded(). 
+        # _decoded_pages flags every page holding part of a cached
+        # instruction so that writes elsewhere are ignored cheaply.
+        self._decode_cache_enabled = decode_cache
+        self._decode_cache: dict = dict()
+        self._decoded_pages = bytearray(-(-len(self.ram) // PAGE_SIZE))
+        self.ram.add_write_observer(self._invalidate_decoded)
+
+        # Created on first use by run_blocks()
+        self._translator = None
 
         # Start of code_segment and length
-        self.output = ""
-        self.stdout = ""
+        self.output_device = output_device if output_device is not None else OutputDevice()
+
+        # Without an input device the input instruction copies the data
+        # loaded at 0x2000, see fake_input()
+        self.input_device = input_device
+
+        # Budgets, None means unlimited. Exhausting one halts the VM with
+        # the matching halt_reason. The wall clock is only checked every
+        # time_check_interval instructions.
+        self.max_instructions = max_instructions
+        self.max_run_time = max_run_time
+        self.time_check_interval = time_check_interval
+        self.max_output_bytes = max_output_bytes
+        self.max_memory_writes = max_memory_writes
+
+        if max_output_bytes is not None:
+            self.output_device.limit = max_output_bytes
+
+        # Instructions executed and memory writes made by the guest
+        self.instruction_count = 0
+        self.memory_writes = 0
 
         self._code_segments: List = list()
         self._data_segments: List = list()
 
         self._should_halt = False
+        self.halt_reason = None
+
+        # Exception that stopped the VM with HaltReason.FAULT
+        self.fault = None
+
+        # Set by run() while the VM is waiting for input, the absolute
+        # instruction count a run() slice ends at and, for runs made of
+        # several slices like with several CPUs, when the run started.
+        # max_run_time counts from then rather than from every slice.
+        self.waiting_input = False
+        self._slice_end = None
+        self._run_started_at = None
+
+        # HookEvent -> callbacks, see add_hook()
+        self._hooks: dict = dict()
 
         self.opcodes = {
             0: {"name": "halt",
@@ -190,7 +754,7 @@ class VirtualMachineV2:
                 "func": self.ram.write_word,
                 "size": 4},
             5: {"name": "m_byte",
-                "func": self.ram.write_byte,
+                "func": self.move_byte,
                 "size": 3,
                 "reversed": False},
             6: {"name": "push",
@@ -215,11 +779,11 @@ class VirtualMachineV2:
             # input (addr)
             #
             # Reads input 
-            # Input function, kind of fake right now, but will copy from a buffer
+            # Reads a line from the input device, or fakes it, and copies it
             # to a location relative the stack pointer.
             # Using this to simulate vulnerable function and buffer overflow
             0xb: {"name": "input",
-                  "func": self.fake_input,
+                  "func": self.read_input,
                   "size": 1,
                   "reversed": False},
             0x90: {"name": "noop",
@@ -227,19 +791,39 @@ class VirtualMachineV2:
                 "size": 0},
             }
 
+        if num_cpus > 1:
+            # The instructions above are bound to CPU 0, execute them on
+            # the running CPU instead
+            self.opcodes[6]['func'] = self.push_reg
+            self.opcodes[7]['func'] = self.pop_reg
+            self.opcodes[8]['func'] = self.move_to_reg
+
+        # Execution trace of run_program(), rendered on demand by output
+        self.trace = ExecutionTrace(self.opcodes, trace_limit) if trace else None
+
         # Write program to memory at location 0x0000
 
         if len(program):
-            for index, byte in enumerate(program):
+            length = self.ram.load(0x0000, program)
 
-                args = (uint8_t(byte), uint16_t(0x0000 + index))
+            self._code_segments.append(Segment('main_program', uint16_t(0x0000), length))
 
-                self.ram.write_byte(args)
+            self.cpu.ip.uint16 = 0x0000
+    
+    @property
+    def stdout(self):
+        return self.output_device.text
 
-            self._code_segments.append(Segment('main_program', uint16_t(0x0000), len(program)))
+    @property
+    def output(self):
+        # IP | Instruction | Arguments
+        # ----------------------------
+
+        if self.trace is None:
+            return ""
+
+        return self.trace.render()
 
-            self.cpu.ip = uint16_t(0x0000)
-    
     @property
     def code_segments(self):
         return self._code_segments
@@ -252,13 +836,10 @@ class VirtualMachineV2:
     def load_program(self, program: tuple, name: str = "main_func()"):
 
         (start_addr, data) = program
-        for index, byte in enumerate(data):
 
-            args = (uint8_t(byte), start_addr + index)
+        length = self.ram.load(start_addr.uint16, data)
 
-            self.ram.write_byte(args)
-
-        self._code_segments.append(Segment(name, start_addr, len(data)))
+        self._code_segments.append(Segment(name, start_addr, length))
 
         self.cpu.ip.uint16 = start_addr.uint16
 
@@ -279,49 +860,94 @@ class VirtualMachineV2:
 
             start_addr = start_addr + length
 
-            for index, byte in enumerate(data):
+        # Otherwise the user wants to place data at a given location, let him.
 
-                args = (uint8_t(byte), start_addr + index)
+        length = self.ram.load(start_addr.uint16, data)
 
-                self.ram.write_byte(args)
+        self._data_segments.append(Segment(name, start_addr, length))
 
-            self._data_segments.append(Segment(name, start_addr, len(data)))
 
-        else:
-            # User wants to place data at a given location, let him.
+    def snapshot(self):
+        # Captures memory, registers, segment tables and output so that 
+        # restore() can return the VM to this state.
+
+        return VMSnapshot(self.ram.snapshot(),
+                          b''.join(bytes(cpu.register_file) for cpu in self.cpus),
+                          tuple(self._code_segments),
+                          tuple(self._data_segments),
+                          self._should_halt,
+                          self.halt_reason,
+                          self.output_device.snapshot(),
+                          self.instruction_count,
+                          self.memory_writes,
+                          self.input_device.snapshot() if self.input_device is not None else None,
+                          (self.cpus.index(self.cpu), self._next_cpu,
+                           tuple(cpu.halted for cpu in self.cpus)))
+
+    def restore(self, snapshot: VMSnapshot):
+
+        self.ram.restore(snapshot.memory)
+        size = len(snapshot.registers) // len(self.cpus)
+        (current, self._next_cpu, halted) = snapshot.cpus
+
+        for (i, cpu) in enumerate(self.cpus):
+            cpu.register_file[:] = array('H', snapshot.registers[i * size:(i + 1) * size])
+            cpu.halted = halted[i]
+            cpu.waiting_input = False
 
-            for index, byte in enumerate(data):
+        self.cpu = self.cpus[current]
 
-                args = (uint8_t(byte), start_addr + index)
+        self._code_segments[:] = snapshot.code_segments
+        self._data_segments[:] = snapshot.data_segments
 
-                self.ram.write_byte(args)
+        self._should_halt = snapshot.should_halt
+        self.halt_reason = snapshot.halt_reason
 
-            self._data_segments.append(Segment(name, start_addr, len(data)))
+        self.output_device.restore(snapshot.output)
 
+        self.instruction_count = snapshot.instruction_count
+        self.memory_writes = snapshot.memory_writes
+
+        if self.input_device is not None and snapshot.input is not None:
+            self.input_device.restore(snapshot.input)
+
+        self.fault = None
+        self.waiting_input = False
+
+        if self.trace is not None:
+            self.trace.clear()
 
     def fetch_instruction(self):
         
         try:
-            opcode = self.ram.read_byte(self.cpu.ip).uint8
+            opcode = self.ram.fetch_byte(self.cpu.ip).uint8
             self.opcodes[opcode]
         except KeyError:
-            self.stdout += f"Ogiltig instruktion ({hex(opcode)}), avslutar körning.\n"
-            self._should_halt = True
+            self.output_device.write_text(f"Ogiltig instruktion ({hex(opcode)}), avslutar körning.\n")
+            self.stop(HaltReason.INVALID_INSTRUCTION)
 
         return opcode
 
     def decode_instruction(self, opcode):
 
-        instruction_pointer = self.cpu.ip + 1
-
         try:
-            isize = self.opcodes[opcode]['size']
+            self.opcodes[opcode]['size']
         except KeyError:
-            self.stdout += "Segmentation fault (core dumped)\n"
-            self._should_halt = True
+            self.output_device.write_text("Segmentation fault (core dumped)\n")
+            self.stop(HaltReason.INVALID_INSTRUCTION)
             
             return ()
 
+        return self.decode_at(self.cpu.ip, opcode)
+
+    def decode_at(self, addr: uint16_t, opcode: int):
+        # Decodes the arguments of a known opcode located at addr, without
+        # touching the CPU. 
+
+        instruction_pointer = addr + 1
+
+        isize = self.opcodes[opcode]['size']
+
         if isize == 0:
             # Zero arguments
 
@@ -329,109 +955,577 @@ class VirtualMachineV2:
 
         elif isize == 1:
 
-            byte = self.ram.read_byte(instruction_pointer)
+            byte = self.ram.fetch_byte(instruction_pointer)
 
-            return tuple([byte])
+            return (byte, )
         
         elif isize == 2:
             # One argument (1 word)
 
-            word = self.ram.read_word(instruction_pointer)
+            word = self.ram.fetch_word(instruction_pointer)
 
-            return tuple([word])
+            return (word, )
 
         elif isize == 3:
             # Two arguments (1 byte and 1 word)
             if self.opcodes[opcode]['reversed']:
 
-                word = self.ram.read_word(instruction_pointer)
-                byte = self.ram.read_byte(instruction_pointer + 2)
+                word = self.ram.fetch_word(instruction_pointer)
+                byte = self.ram.fetch_byte(instruction_pointer.iadd(2))
 
             else:
 
-                byte = self.ram.read_byte(instruction_pointer)
-                word = self.ram.read_word(instruction_pointer + 1)
+                byte = self.ram.fetch_byte(instruction_pointer)
+                word = self.ram.fetch_word(instruction_pointer.iadd(1))
 
             return (word, byte)
 
         elif isize == 4:
             # Two arguments (2 words)
 
-            word_1 = self.ram.read_word(instruction_pointer)
-            word_2 = self.ram.read_word(instruction_pointer + 2)
+            word_1 = self.ram.fetch_word(instruction_pointer)
+            word_2 = self.ram.fetch_word(instruction_pointer.iadd(2))
 
             return (word_1, word_2)
 
-    def run_program(self):
+    def _fetch_decoded(self):
+        # Returns (opcode, func, args, size, arg0, arg1) for the instruction
+        # at IP, arg0 and arg1 being the arguments as plain ints, or
+        # None if it could not be decoded. Decoded instructions are cached
+        # per address until memory underneath them is written.
 
-        # IP | Instruction | Arguments
-        # ----------------------------
-        
-        self.output += f"{'IP' : <8}|{' Instruction' : <15} | {'Arguments' : >15}\n"
-        self.output += f"-------------------------------------------------\n"
+        ip = self.cpu.ip.uint16
+        decoded = self._decode_cache.get(ip)
+
+        if decoded is not None:
+            return decoded
+
+        opcode = self.fetch_instruction()
+
+        if self.should_halt():
+            return None
+
+        args = self.decode_instruction(opcode)
+
+        if self.should_halt():
+            return None
 
-        self.started_at = time.time()
-        while not self.should_halt():
+        isize = self.opcodes[opcode]['size']
+        values = [arg.val for arg in args] + [0, 0]
+        decoded = (opcode, self.opcodes[opcode]['func'], args, isize, values[0], values[1])
 
-            opcode = self.fetch_instruction()
+        if self._decode_cache_enabled:
+            self._decode_cache[ip] = decoded
 
-            if self.should_halt():
+            for offset in range(isize + 1):
+                self._decoded_pages[((ip + offset) % len(self.ram)) // PAGE_SIZE] = 1
+
+        return decoded
+
+    def _invalidate_decoded(self, addr: int, length: int):
+
+        if not self._decode_cache:
+            return
+
+        memory_size = len(self.ram)
+        decoded_pages = self._decoded_pages
+
+        # All of memory, like a restore() or reset()
+        if length >= memory_size:
+            self.clear_decode_cache()
+            return
+
+        for page in range(addr // PAGE_SIZE, (addr + length - 1) // PAGE_SIZE + 1):
+            if decoded_pages[page % len(decoded_pages)]:
                 break
+        else:
+            return
+
+        # Any instruction covering a written byte starts at most 
+        # MAX_INSTRUCTION_SIZE - 1 bytes before it.
+        for offset in range(1 - MAX_INSTRUCTION_SIZE, length):
+            self._decode_cache.pop((addr + offset) % memory_size, None)
+
+    def clear_decode_cache(self):
+        self._decode_cache.clear()
+        self._decoded_pages = bytearray(len(self._decoded_pages))
+
+    def _begin_run(self):
+        # Returns the absolute instruction count and RAM write count at
+        # which the run has to stop.
+
+        never = sys.maxsize
+
+        if self._run_started_at is None:
+            self.started_at = time.time()
+        else:
+            self.started_at = self._run_started_at
+        self._writes_base = self.ram.write_count - self.memory_writes
+
+        instruction_limit = never
+        if self.max_instructions is not None:
+            instruction_limit = self.max_instructions
+
+        write_limit = never
+        if self.max_memory_writes is not None:
+            write_limit = self._writes_base + self.max_memory_writes
+
+        if self.instruction_count >= instruction_limit and not self._should_halt:
+            self.stop(HaltReason.INSTRUCTION_LIMIT)
+
+        # A run() slice ends the run early without halting
+        if self._slice_end is not None:
+            instruction_limit = min(instruction_limit, self._slice_end)
+
+        return (instruction_limit, write_limit)
+
+    def _check_budgets(self, count: int, write_limit: int):
+        # Stops the VM if a budget is exhausted. Called after executing 
+        # an instruction, the instruction limit is checked by the caller.
+
+        if self._should_halt:
+            return
+
+        if self.output_device.truncated:
+            self.stop(HaltReason.OUTPUT_LIMIT)
+
+        elif self.ram.write_count > write_limit:
+            self.stop(HaltReason.MEMORY_WRITE_LIMIT)
+
+        elif self.max_instructions is not None and count >= self.max_instructions:
+            self.stop(HaltReason.INSTRUCTION_LIMIT)
+
+        elif self.max_run_time is not None and self.started_at + self.max_run_time < time.time():
+            self.stop(HaltReason.TIME_LIMIT)
+
+    def _end_run(self, count: int):
+
+        self.instruction_count = count
+        self.memory_writes = self.ram.write_count - self._writes_base
+
+    def run_program(self):
+
+        if self._hooks:
+            return self.run_instrumented()
+
+        trace = self.trace
+        output_device = self.output_device
+        ram = self.ram
+
+        (instruction_limit, write_limit) = self._begin_run()
+        count = self.instruction_count
+        next_check = min(count + self.time_check_interval, instruction_limit)
+
+        try:
+            while not self._should_halt and count < instruction_limit:
 
-            args = self.decode_instruction(opcode)
+                decoded = self._fetch_decoded()
 
-            if self.opcodes[opcode]['size'] == 0:
-                ip_print = f"{hex(self.cpu.ip.uint16) : <10}"
-                op_name = self.opcodes[opcode]['name']
+                if decoded is None:
+                    break
+
+                (opcode, func, args, isize, arg0, arg1) = decoded
+
+                if trace is not None:
+                    trace.record(self.cpu.ip.uint16, opcode, arg0, arg1)
+
+                # Increment IP (+1 for instruction opcode) before executing
+                self.cpu.ip.uint16 += isize + 1
+
+                if isize == 0:
+                    func()
+                else:
+                    func(args)
+
+                count += 1
+
+                if count >= next_check or output_device.truncated or ram.write_count > write_limit:
+
+                    self._check_budgets(count, write_limit)
+                    next_check = min(count + self.time_check_interval, instruction_limit)
+
+        finally:
+            self._end_run(count)
+
+    def run_instrumented(self):
+        # run_program() calling the hooks registered with add_hook(). Every
+        # engine runs this instead while there are hooks, so that engines
+        # never pay for hooks when there are none.
+
+        trace = self.trace
+        hooks = self._hooks
 
-                self.output += f"{ip_print : <8} {op_name : <15}\n"
+        (instruction_limit, write_limit) = self._begin_run()
+        count = self.instruction_count
+        next_check = min(count + self.time_check_interval, instruction_limit)
+
+        try:
+            while not self._should_halt and count < instruction_limit:
+
+                decoded = self._fetch_decoded()
+
+                if decoded is None:
+                    break
+
+                (opcode, func, args, isize, arg0, arg1) = decoded
+                ip = self.cpu.ip.uint16
+
+                if trace is not None:
+                    trace.record(ip, opcode, arg0, arg1)
+
+                for callback in hooks.get(HookEvent.BEFORE_INSTRUCTION, ()):
+                    callback(self, ip, opcode, args)
+
+                self.cpu.ip.uint16 += isize + 1
+
+                if isize == 0:
+                    func()
+                else:
+                    func(args)
 
-                self.cpu.ip.uint16 += self.opcodes[opcode]['size'] + 1
-                self.opcodes[opcode]['func']()
+                count += 1
 
+                if opcode == CALL_OPCODE:
+                    for callback in hooks.get(HookEvent.CALL, ()):
+                        callback(self, ip, self.cpu.ip.uint16)
+
+                elif opcode == RET_OPCODE:
+                    for callback in hooks.get(HookEvent.RET, ()):
+                        callback(self, ip, self.cpu.ip.uint16)
+
+                for callback in hooks.get(HookEvent.AFTER_INSTRUCTION, ()):
+                    callback(self, ip, opcode, args)
+
+                if count >= next_check or self.output_device.truncated or self.ram.write_count > write_limit:
+
+                    self._check_budgets(count, write_limit)
+                    next_check = min(count + self.time_check_interval, instruction_limit)
+
+        finally:
+            self._end_run(count)
+
+    def run_fast(self):
+        # Alternative to run_program() which keeps registers in plain ints,
+        # see cors_vm.fast. No execution trace is recorded.
+
+        if self._hooks:
+            return self.run_instrumented()
+
+        cors_vm.fast.run(self)
+
+    @property
+    def translator(self):
+
+        if self._translator is None:
+            self._translator = BlockTranslator(self)
+
+        return self._translator
+
+    def run_blocks(self):
+        # Alternative to run_program() which executes whole basic blocks
+        # translated into Python functions. No execution trace is recorded.
+        # Blocks end early once the output or memory write budget is
+        # exhausted.
+
+        if self._hooks:
+            return self.run_instrumented()
+
+        translator = self.translator
+
+        (instruction_limit, write_limit) = self._begin_run()
+        count = self.instruction_count
+        next_check = min(count + self.time_check_interval, instruction_limit)
+
+        translator.write_limit = write_limit
+
+        try:
+            while not self._should_halt and count < instruction_limit:
+
+                ip = self.cpu.ip.uint16
+                remaining = instruction_limit - count
+
+                if remaining < translator.max_block_instructions:
+                    # Never run past the instruction limit
+                    block = translator.translate(ip, remaining)
+                else:
+                    block = translator.lookup(ip)
+
+                if block is None:
+                    # Let the interpreter report the invalid instruction
+                    self.fetch_instruction()
+                    break
+
+                translator.invalidated = False
+
+                try:
+                    count += block(translator)
+                except BaseException:
+                    # Count the instructions before the one that raised
+                    count += translator.executed
+                    raise
+
+                if count >= next_check or self.output_device.truncated or self.ram.write_count > write_limit:
+
+                    self._check_budgets(count, write_limit)
+                    next_check = min(count + self.time_check_interval, instruction_limit)
+
+        finally:
+            self._end_run(count)
+
+    @property
+    def status(self):
+
+        if self._should_halt:
+            return VMStatus.FAULT if self.halt_reason in FAULT_REASONS else VMStatus.HALTED
+
+        if self.waiting_input:
+            return VMStatus.WAITING_INPUT
+
+        return VMStatus.RUNNING
+
+    def run(self, max_steps: int = None, engine=None):
+        # Runs at most max_steps instructions with engine, one of
+        # run_program (the default), run_fast or run_blocks, and returns
+        # the status. A VM that is still RUNNING or WAITING_INPUT continues
+        # where it stopped on the next call. Budgets apply as usual, the
+        # run time limit to every call. Exceptions raised by the guest's
+        # instructions stop the VM with HaltReason.FAULT.
+
+        if engine is None:
+            engine = self.run_program
+
+        self.waiting_input = False
+
+        if len(self.cpus) > 1:
+            return self._run_cpus(max_steps, engine)
+
+        return self._run_slice(max_steps, engine)
+
+    def _run_slice(self, max_steps: int, engine):
+        # Runs the current CPU
+
+        if max_steps is not None:
+            self._slice_end = self.instruction_count + max_steps
+
+        try:
+            engine()
+
+        except WaitingForInput:
+            # Execute the input instruction again once there is input
+            self.cpu.ip.isub(self.opcodes[0xb]['size'] + 1)
+            self.waiting_input = True
+
+        except Exception as err:
+            self.output_device.write_text("Segmentation fault (core dumped)\n")
+            self.fault = err
+            self.stop(HaltReason.FAULT)
+
+        finally:
+            self._slice_end = None
+
+        return self.status
+
+    def _run_cpus(self, max_steps: int, engine):
+        # Round-robin over the CPUs, quantum instructions at a time and in
+        # a fixed order so that every run interleaves the same way. halt 
+        # stops the CPU executing it and the VM halts once every CPU has,
+        # any other halt reason stops the whole VM. CPUs waiting for input
+        # are passed over until the next call.
+
+        cpus = self.cpus
+        end = None if max_steps is None else self.instruction_count + max_steps
+
+        for cpu in cpus:
+            cpu.waiting_input = False
+
+        # CPUs that could not run since one last did
+        idle = 0
+
+        # Keep the start of an enclosing run, see cors_vm.replay
+        outer_started_at = self._run_started_at
+        if outer_started_at is None:
+            self._run_started_at = time.time()
+
+        try:
+            while not self._should_halt and idle < len(cpus):
+
+                if end is not None and self.instruction_count >= end:
+                    break
+
+                cpu = cpus[self._next_cpu]
+                self._next_cpu = (self._next_cpu + 1) % len(cpus)
+
+                if cpu.halted or cpu.waiting_input:
+                    idle += 1
+                    continue
+
+                idle = 0
+                self.cpu = cpu
+
+                steps = self.quantum
+                if end is not None:
+                    steps = min(steps, end - self.instruction_count)
+
+                if self._run_slice(steps, engine) == VMStatus.WAITING_INPUT:
+                    cpu.waiting_input = True
+                    self.waiting_input = False
+
+                elif self.halt_reason == HaltReason.HALT:
+                    cpu.halted = True
+                    self._should_halt = False
+                    self.halt_reason = None
+
+        finally:
+            self._run_started_at = outer_started_at
+
+        if not self._should_halt and idle == len(cpus):
+
+            if all(cpu.halted for cpu in cpus):
+                self.stop(HaltReason.HALT)
             else:
-                op_size = self.opcodes[opcode]['size']
+                self.waiting_input = True
 
-                ip_print = f"{hex(self.cpu.ip.uint16) : <10}"
-                op_name = self.opcodes[opcode]['name']
-                args_print = ""
-                for arg in args:
-                    args_print += f"{arg} "
+        return self.status
 
-                self.output += f"{ip_print : <8} {op_name : <15}{args_print : <15}\n"
-                self.cpu.ip.uint16 += self.opcodes[opcode]['size'] + 1
-                self.opcodes[opcode]['func'](args)
+    def start_cpu(self, index: int, start_addr: uint16_t):
+        # Starts CPU index executing at start_addr
 
-            if self.started_at + MAX_RUN_TIME < time.time():
+        cpu = self.cpus[index]
 
-                self._should_halt = True
+        cpu.ip.uint16 = start_addr.uint16
+        cpu.halted = False
 
-            # Increment IP (+1 for instruction opcode, before decode)
+    def steps(self, max_steps: int = TIME_CHECK_INTERVAL, engine=None):
+        # Generator running the VM in slices of max_steps instructions,
+        # yielding the status after each one until the VM halts or faults.
+        # While WAITING_INPUT is yielded, feed the input device before
+        # resuming.
 
+        while True:
+            status = self.run(max_steps, engine)
+
+            yield status
+
+            if status in (VMStatus.HALTED, VMStatus.FAULT):
+                return
 
     def should_halt(self):
 
         return self._should_halt
+
+    # Instrumentation
+
+    @property
+    def hooked(self):
+        return bool(self._hooks)
+
+    def add_hook(self, event: HookEvent, callback):
+        # Calls callback on event, see HookEvent for the arguments. Memory
+        # reads made to fetch instructions are not reported.
+
+        callbacks = self._hooks.setdefault(event, list())
+
+        if not callbacks:
+            if event == HookEvent.MEMORY_READ:
+                self.ram.add_read_observer(self._hook_memory_read)
+
+            elif event == HookEvent.MEMORY_WRITE:
+                self.ram.add_write_observer(self._hook_memory_write)
+
+        callbacks.append(callback)
+
+    def remove_hook(self, event: HookEvent, callback):
+
+        callbacks = self._hooks[event]
+        callbacks.remove(callback)
+
+        if not callbacks:
+            del self._hooks[event]
+
+            if event == HookEvent.MEMORY_READ:
+                self.ram.remove_read_observer(self._hook_memory_read)
+
+            elif event == HookEvent.MEMORY_WRITE:
+                self.ram.remove_write_observer(self._hook_memory_write)
+
+    def _hook_memory_read(self, addr: int, length: int):
+        for callback in self._hooks[HookEvent.MEMORY_READ]:
+            callback(self, addr, length)
+
+    def _hook_memory_write(self, addr: int, length: int):
+        for callback in self._hooks[HookEvent.MEMORY_WRITE]:
+            callback(self, addr, length)
     
     # Instructions
 
     def halt(self):
+        self.stop(HaltReason.HALT)
+
+    def stop(self, reason: HaltReason):
+
         self._should_halt = True
+        self.halt_reason = reason
+
+        for callback in self._hooks.get(HookEvent.HALT, ()):
+            callback(self, reason)
 
     def out(self, args):
         (addr, ) = args
 
-        i = 0
-        while True:
+        # Find the end of the string and write it as one chunk. Stop early
+        # once the device cannot take any more output, reading one byte
+        # more than it takes so that it notes the truncation.
+        memory = self.ram.memory
+        size = len(memory)
+        start = addr.uint16
 
-            byte = self.ram.read_byte(addr + i).uint8
+        remaining = self.output_device.remaining
+        count = None if remaining is None else remaining + 1
 
-            if byte == 0:
-                break
+        chunks = list()
 
-            self.stdout += chr(byte)
+        try:
+            # Addresses wrap at 0x10000, at most once around memory
+            for _ in range(2):
+                stop = size if count is None else min(size, start + count)
+                end = self.ram.find(b'\x00', start, stop)
+
+                if end != -1:
+                    chunks.append(memory[start:end])
+                    break
+
+                chunks.append(memory[start:stop])
+
+                if count is not None:
+                    count -= max(stop - start, 0)
+
+                    if count <= 0:
+                        break
+
+                if size <= 0xffff:
+                    raise IndexError('Segmentation fault, reading outside MAX memory_size.')
+
+                start = 0
+
+        finally:
+            self.output_device.write(b''.join(chunks))
+
+    # Execute on the running CPU, used with several CPUs
+
+    def push_reg(self, args):
+        self.cpu.push_reg(args)
+
+    def pop_reg(self, args):
+        self.cpu.pop_reg(args)
+
+    def move_to_reg(self, args):
+        self.cpu.move_to_reg(args)
+
+    def move_byte(self, args):
+        # m_byte (value) (addr), decoded as (addr, value)
+        (addr, value) = args
 
-            i += 1
+        self.ram.write_byte((value, addr))
 
     def call_func(self, args):
 
@@ -452,7 +1546,7 @@ class VirtualMachineV2:
 
         # Finally we set IP to the addr of the function to be called
 
-        self.cpu.ip.uint16 = self.cpu.registers[call_reg.val]['value'].uint16
+        self.cpu.ip.uint16 = self.cpu.read_register(call_reg.val)
         
     def return_func(self):
 
@@ -461,6 +1555,20 @@ class VirtualMachineV2:
 
         self.cpu.sp.uint16 = self.cpu.bp.uint16
         
+    def read_input(self, args):
+
+        if self.input_device is None:
+            return self.fake_input(args)
+
+        line = self.input_device.readline(INPUT_SIZE)
+
+        if line is None:
+            raise WaitingForInput()
+
+        # Written to the same 256 byte buffer below SP as fake_input()
+        for (i, byte) in enumerate(line):
+            self.ram.write_byte((uint8_t(byte), uint16_t(self.cpu.sp.uint16 - 256 + i)))
+
     def fake_input(self, args):
         # Used for exploitation_02
         # Data loaded at 0x2000, read from there.
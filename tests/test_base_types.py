@@ -0,0 +1,49 @@
+import pickle
+
+from cors_vm.base_types import uint16_t, uint8_t
+
+def test_uint8_values_are_interned():
+
+    assert uint8_t(0x41) is uint8_t(0x41)
+    assert uint8_t(0x141) is uint8_t(0x41)
+    assert uint8_t(-1).uint8 == 0xff
+
+def test_value_types_have_no_instance_dict():
+
+    assert not hasattr(uint8_t(1), '__dict__')
+    assert not hasattr(uint16_t(1), '__dict__')
+
+def test_uint16_bytes():
+
+    word = uint16_t(0x1337)
+
+    assert word.lo_byte == 0x37
+    assert word.ho_byte == 0x13
+    assert word.as_tuple() == (0x13, 0x37)
+    assert word.val == 0x1337
+
+    word.uint16 = 0x12345
+
+    assert word.uint16 == 0x2345
+
+def test_uint16_arithmetic_wraps():
+
+    assert (uint16_t(0xffff) + 1).uint16 == 0
+    assert (uint16_t(0) - 2).uint16 == 0xfffe
+    assert (uint16_t(5) - uint16_t(3)).uint16 == 2
+
+def test_uint16_in_place_arithmetic():
+
+    word = uint16_t(0x7fff)
+
+    assert word.isub(2) is word
+    assert word.uint16 == 0x7ffd
+
+    word.iadd(0x8003)
+
+    assert word.uint16 == 0
+
+def test_value_types_can_be_pickled():
+
+    assert pickle.loads(pickle.dumps(uint8_t(7))) is uint8_t(7)
+    assert pickle.loads(pickle.dumps(uint16_t(0x1337))).uint16 == 0x1337
@@ -0,0 +1,72 @@
+import json
+
+import cors_vm.batch as batch
+
+def test_run_job_resets_prewarmed_vm_between_jobs(challenge_image, exploit):
+
+    batch._init_worker({'engine': 'run_program', 'budgets': {}})
+
+    first = batch.run_job({'id': 1, 'image': str(challenge_image), 'payload': exploit.hex()})
+    second = batch.run_job({'id': 2, 'image': str(challenge_image), 'payload': b'kort'.hex()})
+
+    assert first['stdout'] == "Anslutningen avslutas.CORS_CTF{flag}"
+    assert first['halt_reason'] == 'halt'
+    assert second['stdout'].startswith("Anslutningen avslutas.")
+    assert "CORS_CTF" not in second['stdout']
+
+def test_run_job_reports_errors(tmp_path):
+
+    result = batch.run_job({'id': 'saknas', 'image': str(tmp_path / 'missing.img')})
+
+    assert result['id'] == 'saknas'
+    assert 'FileNotFoundError' in result['error']
+
+def test_run_job_reports_missing_image():
+
+    result = batch.run_job({'id': 'utan bild', 'payload': '41'})
+
+    assert result['id'] == 'utan bild'
+    assert result['image'] is None
+    assert 'KeyError' in result['error']
+
+def test_run_job_payload_is_read_a_line_at_a_time(challenge_image, exploit):
+
+    # The challenge reads one line, so the exploit after a newline is
+    # never read
+    result = batch.run_job({'id': 1, 'image': str(challenge_image), 'payload': (b'kort\n' + exploit).hex()})
+
+    assert result['stdout'] == "Anslutningen avslutas."
+
+def test_run_batch_runs_jobs_across_processes(challenge_image, exploit):
+
+    jobs = [{'id': i, 'image': str(challenge_image), 'payload': (exploit if i % 2 else b'').hex()}
+            for i in range(20)]
+
+    results = list(batch.run_batch(jobs, workers=2, chunk_size=3, max_instructions=10000))
+
+    assert sorted(result['id'] for result in results) == list(range(20))
+
+    for result in results:
+        assert ("CORS_CTF{flag}" in result['stdout']) == bool(result['id'] % 2)
+        assert result['instruction_count'] > 0
+
+def test_cli_reads_payload_directory(challenge_image, tmp_path, capsys, exploit):
+
+    payloads = tmp_path / 'payloads'
+    payloads.mkdir()
+
+    (payloads / 'exploit.bin').write_bytes(exploit)
+    (payloads / 'empty.bin').write_bytes(b'')
+
+    batch.main([str(payloads), '--image', str(challenge_image), '--workers', '1'])
+
+    results = {result['id']: result for result in map(json.loads, capsys.readouterr().out.splitlines())}
+
+    assert set(results) == {'exploit.bin', 'empty.bin'}
+    assert "CORS_CTF{flag}" in results['exploit.bin']['stdout']
+
+def test_read_jobs_skips_blank_lines():
+
+    jobs = list(batch.read_jobs(['{"image": "a.img", "payload": "41"}', '', '{"id": "b", "image": "b.img"}']))
+
+    assert jobs == [{'id': 0, 'image': 'a.img', 'payload': '41'}, {'id': 'b', 'image': 'b.img'}]
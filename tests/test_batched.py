@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.batched import BatchedVM
+from cors_vm.devices import InputDevice
+
+# Opcodes and how many argument bytes they take
+OPCODES = {0x0: 0, 0x3: 2, 0x4: 4, 0x5: 3, 0x6: 1, 0x7: 1, 0x8: 3, 0x9: 1, 0xa: 0, 0xb: 1, 0x90: 0}
+
+def random_program(rng, memory_size):
+    # Mostly valid instructions with operands pointing anywhere, the odd
+    # invalid opcode and registers that do not exist
+
+    program = bytearray()
+
+    while len(program) < 48:
+        opcode = rng.choice(list(OPCODES) + [0x42])
+        program.append(opcode)
+
+        for _ in range(OPCODES.get(opcode, 0)):
+            program.append(rng.choice([0, 1, 2, 3, 4, 5, rng.randrange(256), memory_size >> 8]))
+
+    return bytes(program)
+
+def random_vm(seed, memory_size):
+
+    rng = random.Random(seed)
+
+    vm = cvm.VirtualMachineV2(random_program(rng, memory_size), memory_size=memory_size,
+                              num_registers=2, trace=False, max_instructions=64,
+                              max_output_bytes=rng.choice([None, 8]),
+                              max_memory_writes=rng.choice([None, 6]))
+    vm.cpu.sp.uint16 = rng.randrange(memory_size)
+    vm.load_data((uint16_t(0x80), bytes(rng.randrange(256) for _ in range(32)), "data"))
+
+    return vm
+
+def vm_state(vm):
+    return (bytes(vm.ram.memory), bytes(vm.cpu.register_file), vm.stdout, vm.halt_reason,
+            vm.instruction_count, vm.memory_writes, vm.status)
+
+@pytest.mark.parametrize('memory_size', [256, 1024])
+def test_batched_engine_matches_scalar_engine(memory_size):
+
+    seeds = range(200)
+
+    expected = list()
+    for seed in seeds:
+        vm = random_vm(seed, memory_size)
+        vm.run()
+        expected.append(vm_state(vm))
+
+    batch = BatchedVM([random_vm(seed, memory_size) for seed in seeds])
+    batch.run()
+
+    for (seed, vm, state) in zip(seeds, batch.vms, expected):
+        assert vm_state(vm) == state, seed
+
+def test_batched_engine_runs_payloads_in_lockstep(input_challenge, exploit):
+
+    vms = [cvm.VirtualMachineV2(trace=False, input_device=InputDevice()) for _ in range(8)]
+
+    for (i, vm) in enumerate(vms):
+        vm.restore(input_challenge.snapshot())
+        vm.input_device.feed(exploit if i % 2 else b'kort\n')
+
+    statuses = BatchedVM(vms).run()
+
+    for (i, vm) in enumerate(vms):
+        assert ("CORS_CTF{flag}" in vm.stdout) == bool(i % 2)
+        assert vm.status == statuses[i]
+
+    assert statuses[1] == cvm.VMStatus.HALTED
+
+def test_waiting_instances_retire_and_resume(input_challenge, exploit):
+
+    batch = BatchedVM([input_challenge])
+
+    assert batch.run() == [cvm.VMStatus.WAITING_INPUT]
+    assert input_challenge.cpu.ip.uint16 == 0x3737
+
+    input_challenge.input_device.feed(exploit + b'\n')
+
+    assert batch.run() == [cvm.VMStatus.HALTED]
+    assert input_challenge.stdout == "Anslutningen avslutas.CORS_CTF{flag}"
+
+def test_batch_needs_matching_vms():
+
+    with pytest.raises(ValueError):
+        BatchedVM([cvm.VirtualMachineV2(), cvm.VirtualMachineV2(memory_size=1024)])
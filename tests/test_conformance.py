@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+import cors_vm.conformance as conformance
+
+from cors_vm.conformance import Case
+
+# Minimal cases the harness found run_blocks disagreeing on
+REGRESSIONS = [
+    # Fault in the middle of a block, the noop before it is still counted
+    Case(bytes.fromhex('9007'), b'', b'', 32768, 0x7fff, 2, None, None),
+    # Output budget exhausted in the middle of a block
+    Case(bytes.fromhex('03008090'), b'Hej\x00', b'', 32768, 0x7fff, 2, 2, None),
+    # Uncached block near the instruction limit overwriting itself
+    Case(bytes.fromhex('040000000590'), b'', b'', 1024, 0x3ff, 2, None, None),
+    # Block decoded up to the end of memory
+    Case(bytes.fromhex('0601060107'), b'', b'', 1024, 0x3ff, 8, None, None),
+]
+
+@pytest.mark.parametrize('case', REGRESSIONS)
+def test_regressions(case):
+
+    for engine in conformance.available_engines():
+        assert conformance.differs(case, engine) is None, engine
+
+def test_fake_input_case_runs_on_every_engine():
+
+    # input, halt, without an input device the line is read from 0x2000
+    case = Case(bytes.fromhex('0b00'), b'', None, 32768, 0x7fff, 8, None, None)
+
+    (memory, *_) = conformance.run_case(case, 'run_program')
+
+    assert memory[0x7fff - 256:0x7fff] == memory[0x2000:0x2100]
+
+    for engine in conformance.available_engines():
+        assert conformance.differs(case, engine) is None, engine
+
+def test_cpu_and_sliced_cases_run_on_every_engine():
+
+    # out DATA_ADDR, noop, halt, on two CPUs a step at a time
+    case = Case(bytes.fromhex('0300809000'), b'Hej\x00', b'', 1024, 0x3ff, 64, None, None,
+                cpu_starts=(0x3, ), steps=1)
+
+    (*_, stdout, halt_reason, count, writes, status) = conformance.run_case(case, 'run_program')
+
+    assert stdout == "Hej"
+    assert count == 5
+
+    for engine in conformance.available_engines():
+        assert conformance.differs(case, engine) is None, engine
+
+    # batched runs a single CPU
+    assert not conformance.runs_case('batched', case)
+
+def test_engines_agree_on_generated_programs():
+
+    mismatches = list(conformance.check(300, seed=1))
+
+    assert mismatches == [], conformance.format_mismatch(mismatches[0])
+
+def test_structured_programs_run_on_every_engine():
+
+    rng = random.Random(3)
+    program = conformance.structured_program(rng, 1024)
+
+    case = Case(program, b'Hej\x00', b'', 1024, 0x3ff, 256, None, None)
+
+    (memory, registers, stdout, halt_reason, count, writes, status) = conformance.run_case(case, 'run_program')
+
+    assert count > 1
+    assert conformance.differs(case, 'run_blocks') is None
+
+def test_shrink_finds_minimal_case():
+
+    case = Case(bytes.fromhex('0803000390900a9000'), b'data', b'input\n', 1024, 0x3ff, 64, 8, 8)
+
+    # Pretend every program with a ret fails
+    shrunk = conformance.shrink(case, lambda candidate: 0xa in candidate.program)
+
+    assert shrunk == Case(b'\x0a', b'', b'', 1024, 0x3ff, 1, None, None)
+
+def test_mismatch_is_reported_and_shrunk(monkeypatch):
+
+    def broken_fast(vm, steps):
+        # Loses the output of every run
+        status = vm.run(steps, vm.run_fast)
+        vm.output_device.clear()
+
+        return status
+
+    monkeypatch.setitem(conformance.ENGINES, 'run_fast', broken_fast)
+
+    mismatch = next(conformance.check(100, seed=0, engines=['run_fast']))
+
+    assert mismatch.engine == 'run_fast'
+    assert mismatch.expected[2] != '' and mismatch.actual[2] == ''
+    assert len(mismatch.case.program) <= 3
+
+    assert 'stdout' in conformance.format_mismatch(mismatch)
@@ -71,4 +71,39 @@ def test_multiple_push_and_pops_to_stack():
 
     assert 0x41 == vm.cpu.ip.uint16
     assert 0x42 == vm.cpu.bp.uint16
-    
\ No newline at end of file
+    
+def test_registers_are_backed_by_register_file():
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.cpu.reg01.uint16 = 0x1337
+    vm.cpu.ip = uint16_t(0x0042)
+
+    assert list(vm.cpu.register_file) == [0x0042, 0x7fff, 0x7fff, 0x1337]
+
+    # Register 4 is an alias of the instruction pointer
+    assert vm.cpu.read_register(4) == 0x0042
+    assert vm.cpu.register_name(4) == "Instruction Pointer"
+
+def test_cpu_with_additional_registers():
+
+    vm = cvm.VirtualMachineV2()
+    cpu = cvm.CentralProcessingUnit(vm.ram, num_registers=3)
+
+    assert cpu.num_registers == 7
+    assert cpu.register_name(5) == "Register 02"
+    assert cpu.register_name(6) == "Register 03"
+
+    cpu.move_to_reg((uint16_t(0x41), uint8_t(0x6)))
+    cpu.push_reg(uint8_t(0x6))
+    cpu.pop_reg(uint8_t(0x5))
+
+    assert cpu.read_register(5) == 0x41
+    assert cpu.register(5).uint16 == 0x41
+
+def test_invalid_register_number_raises():
+
+    vm = cvm.VirtualMachineV2()
+
+    with pytest.raises(IndexError):
+        vm.cpu.move_to_reg((uint16_t(0x41), uint8_t(0x5)))
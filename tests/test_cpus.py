@@ -0,0 +1,117 @@
+import pytest
+
+import cors_vm.state as state
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.parallel import run_parallel
+
+def printer(addr):
+    # out addr, out addr, halt
+    word = addr.to_bytes(2, 'big')
+
+    return b'\x03' + word + b'\x03' + word + b'\x00'
+
+@pytest.fixture
+def two_printers():
+    # CPU 0 prints "A" twice, CPU 1 prints "B" twice
+    vm = cvm.VirtualMachineV2(num_cpus=2, trace=False)
+
+    vm.load_program((uint16_t(0x1000), printer(0x3000)))
+    vm.load_program((uint16_t(0x2000), printer(0x3002)), "cpu_1")
+    vm.load_data((uint16_t(0x3000), b"A\x00B\x00", "letters"))
+
+    vm.start_cpu(0, uint16_t(0x1000))
+    vm.start_cpu(1, uint16_t(0x2000))
+
+    return vm
+
+@pytest.mark.parametrize('quantum, output', [(1, "ABAB"), (2, "AABB"), (64, "AABB")])
+def test_cpus_interleave_round_robin(two_printers, engine_of, quantum, output):
+
+    two_printers.quantum = quantum
+
+    assert two_printers.run(engine=engine_of(two_printers)) == cvm.VMStatus.HALTED
+    assert two_printers.stdout == output
+    assert two_printers.halt_reason == cvm.HaltReason.HALT
+    assert two_printers.instruction_count == 6
+
+def test_cpus_have_own_registers_and_stacks(engine_of):
+
+    # mov 0x0100 Reg01, push Reg01, halt
+    program = b'\x08\x01\x00\x03\x06\x03\x00'
+
+    vm = cvm.VirtualMachineV2(program, num_cpus=3, trace=False)
+    vm.start_cpu(2, uint16_t(0x0000))
+
+    vm.run(engine=engine_of(vm))
+
+    (first, second, third) = vm.cpus
+
+    assert first.sp.uint16 == 0x7ffd
+    assert second.halted and second.sp.uint16 == 0x6fff
+    assert third.sp.uint16 == 0x5ffd
+    assert vm.ram.read_word(uint16_t(0x5ffd)).uint16 == 0x0100
+    assert vm.ram.read_word(uint16_t(0x7ffd)).uint16 == 0x0100
+
+def test_cpus_share_memory(engine_of):
+
+    vm = cvm.VirtualMachineV2(num_cpus=2, quantum=1, trace=False)
+
+    # CPU 0 writes "OK" to 0x3000 while CPU 1 runs a noop, then CPU 1
+    # prints it
+    vm.load_program((uint16_t(0x1000), b'\x04\x4f\x4b\x30\x00\x00'))
+    vm.load_program((uint16_t(0x2000), b'\x90\x03\x30\x00\x00'), "cpu_1")
+
+    vm.start_cpu(0, uint16_t(0x1000))
+    vm.start_cpu(1, uint16_t(0x2000))
+
+    vm.run(engine=engine_of(vm))
+
+    assert vm.stdout == "OK"
+
+def test_invalid_instruction_stops_every_cpu(two_printers):
+
+    two_printers.ram.load(0x2003, b'\x42')
+    two_printers.quantum = 1
+
+    assert two_printers.run() == cvm.VMStatus.FAULT
+    assert two_printers.stdout.startswith("ABA")
+    assert two_printers.cpus[0].halted is False
+
+def test_sliced_run_and_snapshot_keep_schedule(two_printers):
+
+    snapshot = two_printers.snapshot()
+    two_printers.quantum = 1
+
+    assert two_printers.run(3) == cvm.VMStatus.RUNNING
+
+    copy = state.loads(state.dumps(two_printers), quantum=1)
+
+    assert two_printers.run() == cvm.VMStatus.HALTED
+    assert copy.run() == cvm.VMStatus.HALTED
+    assert two_printers.stdout == copy.stdout == "ABAB"
+
+    two_printers.restore(snapshot)
+    two_printers.run()
+
+    assert two_printers.stdout == "ABAB"
+
+def test_run_parallel_runs_cpus_in_processes(two_printers):
+
+    # Both CPUs also write a word to their own address
+    two_printers.ram.load(0x1006, b'\x04\x11\x11\x40\x00\x00')
+    two_printers.ram.load(0x2006, b'\x04\x22\x22\x40\x02\x00')
+
+    assert run_parallel(two_printers) == cvm.VMStatus.HALTED
+
+    assert two_printers.stdout == "AABB"
+    assert two_printers.ram.read_word(uint16_t(0x4000)).uint16 == 0x1111
+    assert two_printers.ram.read_word(uint16_t(0x4002)).uint16 == 0x2222
+    assert two_printers.instruction_count == 8
+    assert all(cpu.halted for cpu in two_printers.cpus)
+
+def test_vm_needs_room_for_stacks():
+
+    with pytest.raises(ValueError):
+        cvm.VirtualMachineV2(num_cpus=9)
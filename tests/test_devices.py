@@ -0,0 +1,131 @@
+import io
+
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.devices import InputDevice, OutputDevice
+
+@pytest.fixture
+def print_program():
+    # out 0x1000, out 0x1000, halt
+    return b'\x03\x10\x00\x03\x10\x00\x00'
+
+def test_output_device_streams_chunks_to_callback():
+
+    chunks = []
+    device = OutputDevice(sink=chunks.append)
+
+    device.write(b'hej ')
+    device.write(b'')
+    device.write(bytearray(b'svejs'))
+
+    assert chunks == [b'hej ', b'svejs']
+    assert device.getvalue() == b'hej svejs'
+
+def test_output_device_writes_to_binary_and_text_files():
+
+    binary = io.BytesIO()
+    text = io.StringIO()
+
+    OutputDevice(sink=binary).write(b'\xe5\xe4\xf6')
+    OutputDevice(sink=text).write(b'\xe5\xe4\xf6')
+
+    assert binary.getvalue() == b'\xe5\xe4\xf6'
+    assert text.getvalue() == 'åäö'
+
+def test_output_device_truncates_at_limit():
+
+    device = OutputDevice(limit=5)
+
+    assert device.write(b'abc') == 3
+    assert device.write(b'defg') == 2
+    assert device.write(b'h') == 0
+
+    assert device.getvalue() == b'abcde'
+    assert device.truncated
+
+def test_output_device_without_buffer_only_streams():
+
+    chunks = []
+    device = OutputDevice(sink=chunks.append, keep=False)
+
+    device.write(b'abc')
+
+    assert chunks == [b'abc']
+    assert device.getvalue() == b''
+    assert len(device) == 3
+
+def test_out_instruction_writes_one_chunk_per_string(print_program):
+
+    chunks = []
+    vm = cvm.VirtualMachineV2(output_device=OutputDevice(sink=chunks.append))
+
+    vm.load_data((uint16_t(0x1000), b"CORS_CTF\x00", "flag"))
+    vm.load_program((uint16_t(0x0000), print_program))
+    vm.run_program()
+
+    assert chunks == [b'CORS_CTF', b'CORS_CTF']
+    assert vm.stdout == "CORS_CTFCORS_CTF"
+
+def test_out_instruction_respects_output_limit(print_program):
+
+    vm = cvm.VirtualMachineV2(output_device=OutputDevice(limit=10))
+
+    vm.load_data((uint16_t(0x1000), b"CORS_CTF\x00", "flag"))
+    vm.load_program((uint16_t(0x0000), print_program))
+    vm.run_program()
+
+    assert vm.stdout == "CORS_CTFCO"
+    assert vm.output_device.truncated
+
+def test_out_instruction_wraps_at_end_of_memory():
+
+    vm = cvm.VirtualMachineV2(memory_size=0x10000)
+
+    vm.ram.load(0xfffe, b"CO")
+    vm.ram.load(0x0000, b"RS\x00")
+    vm.load_program((uint16_t(0x1000), b'\x03\xff\xfe\x00'))
+
+    assert vm.run(engine=vm.run_fast) == cvm.VMStatus.HALTED
+    assert vm.stdout == "CORS"
+
+def test_out_instruction_faults_past_end_of_smaller_memory():
+
+    vm = cvm.VirtualMachineV2(memory_size=0x8000)
+
+    vm.ram.load(0x7ffe, b"CO")
+    vm.load_program((uint16_t(0x1000), b'\x03\x7f\xfe\x00'))
+
+    assert vm.run() == cvm.VMStatus.FAULT
+    assert vm.stdout.startswith("CO")
+
+def test_invalid_instruction_message_goes_to_output_device():
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.load_program((uint16_t(0x0000), b'\xff'))
+    vm.run_program()
+
+    assert vm.stdout == "Ogiltig instruktion (0xff), avslutar körning.\n"
+
+def test_input_device_returns_whole_lines():
+
+    device = InputDevice(b'hej')
+
+    assert device.readline(8) is None
+
+    device.feed(b' svejs\nabcdefghijk')
+
+    assert device.readline(260) == b'hej svejs'
+    assert device.readline(4) == b'abcd'
+    assert device.readline(16) is None
+
+    device.close()
+
+    assert device.readline(16) == b'efghijk'
+    assert device.readline(16) == b''
+
+    with pytest.raises(ValueError):
+        device.feed(b'mer')
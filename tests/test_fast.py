@@ -0,0 +1,106 @@
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+
+@pytest.fixture
+def loop_program():
+    # 0x0000: mov 0x0100 -> Reg01, call Reg01, mov 0x0000 -> IP
+    # 0x0100: push Reg01, pop BP, noop, m_byte 0x41 -> 0x1000,
+    #         m_word 0x4243 -> 0x1001, out 0x1000, ret
+    main = b'\x08\x01\x00\x03\x09\x03\x08\x00\x00\x00'
+    sub = (b'\x06\x03\x07\x02\x90\x05\x41\x10\x00\x04\x42\x43\x10\x01'
+           b'\x03\x10\x00\x0a')
+
+    return (main, sub)
+
+def state(vm):
+    return (vm.cpu.ip.uint16, vm.cpu.sp.uint16, vm.cpu.bp.uint16,
+            vm.cpu.reg01.uint16, vm.stdout, vm.halt_reason,
+            vm.instruction_count, vm.ram.write_count, bytes(vm.ram.memory))
+
+def build(loop_program, **kwargs):
+
+    (main, sub) = loop_program
+
+    vm = cvm.VirtualMachineV2(**kwargs)
+    vm.load_program((uint16_t(0x0100), sub), "sub")
+    vm.load_program((uint16_t(0x0000), main))
+
+    return vm
+
+def test_push_and_pop_instructions(engine):
+
+    vm = cvm.VirtualMachineV2()
+
+    # mov 0x0041 -> Reg01, push Reg01, pop BP, halt
+    vm.load_program((uint16_t(0x0000), b'\x08\x00\x41\x03\x06\x03\x07\x02\x00'))
+    getattr(vm, engine)()
+
+    assert vm.cpu.bp.uint16 == 0x41
+    assert vm.cpu.sp.uint16 == 0x7fff
+
+def test_m_byte_instruction_writes_value_to_address(engine):
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.load_program((uint16_t(0x0000), b'\x05\x41\x10\x00\x00'))
+    getattr(vm, engine)()
+
+    assert vm.ram.memory[0x1000] == 0x41
+
+@pytest.mark.parametrize("max_instructions", [1, 7, 100, 1001])
+def test_engines_match_run_program(loop_program, max_instructions, engine):
+
+    reference = build(loop_program, max_instructions=max_instructions)
+    reference.run_program()
+
+    vm = build(loop_program, max_instructions=max_instructions)
+    getattr(vm, engine)()
+
+    assert state(vm) == state(reference)
+
+def test_run_fast_can_resume_after_budget(loop_program):
+
+    reference = build(loop_program, max_instructions=50)
+    reference.run_program()
+
+    vm = build(loop_program, max_instructions=20)
+    vm.run_fast()
+
+    vm.max_instructions = 50
+    vm._should_halt = False
+    vm.run_fast()
+
+    assert state(vm) == state(reference)
+
+def test_run_fast_invalidates_decode_cache(loop_program):
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.load_program((uint16_t(0x0000), b'\x08\x00\x41\x03\x00'))
+    vm.run_program()
+
+    # Patch the mov argument from the fast engine, then rerun the cached
+    # code with the reference engine.
+    vm.load_program((uint16_t(0x1000), b'\x04\x00\x42\x00\x01\x00'))
+    vm._should_halt = False
+    vm.run_fast()
+
+    vm._should_halt = False
+    vm.cpu.ip.uint16 = 0x0000
+    vm.run_program()
+
+    assert vm.cpu.reg01.uint16 == 0x42
+
+def test_additional_registers(engine):
+
+    vm = cvm.VirtualMachineV2(num_registers=2)
+
+    # mov 0x0041 -> Register 02, push Register 02, pop Reg01, halt
+    vm.load_program((uint16_t(0x0000), b'\x08\x00\x41\x05\x06\x05\x07\x03\x00'))
+    getattr(vm, engine)()
+
+    assert vm.cpu.reg01.uint16 == 0x41
+    assert vm.cpu.read_register(5) == 0x41
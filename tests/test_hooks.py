@@ -0,0 +1,87 @@
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t
+
+# mov 0x0010 Reg01, call Reg01, halt, <pad>, out 0x2000, ret
+PROGRAM = (b'\x08\x00\x10\x03\x09\x03\x00' + b'\x90' * 9 +
+           b'\x03\x20\x00\x0a')
+
+@pytest.fixture
+def vm():
+    vm = cvm.VirtualMachineV2(PROGRAM, trace=False)
+    vm.load_data((uint16_t(0x2000), b"Hej\x00", "greeting"))
+
+    return vm
+
+def test_no_hooks_does_not_instrument(vm, engine, monkeypatch):
+
+    def instrumented():
+        raise AssertionError('run_instrumented() used without hooks')
+
+    monkeypatch.setattr(vm, 'run_instrumented', instrumented)
+
+    getattr(vm, engine)()
+
+    assert vm.stdout == "Hej"
+    assert not vm.hooked
+
+def test_instruction_hooks(vm, engine):
+
+    before = list()
+    after = list()
+
+    vm.add_hook(cvm.HookEvent.BEFORE_INSTRUCTION, lambda vm, ip, opcode, args: before.append((ip, opcode)))
+    vm.add_hook(cvm.HookEvent.AFTER_INSTRUCTION, lambda vm, ip, opcode, args: after.append((ip, opcode)))
+
+    getattr(vm, engine)()
+
+    assert before == [(0x0, 0x8), (0x4, 0x9), (0x10, 0x3), (0x13, 0xa), (0x6, 0x0)]
+    assert after == before
+    assert vm.stdout == "Hej"
+    assert vm.instruction_count == 5
+
+def test_call_ret_and_halt_hooks(vm, engine):
+
+    events = list()
+
+    vm.add_hook(cvm.HookEvent.CALL, lambda vm, ip, new_ip: events.append(('call', ip, new_ip)))
+    vm.add_hook(cvm.HookEvent.RET, lambda vm, ip, new_ip: events.append(('ret', ip, new_ip)))
+    vm.add_hook(cvm.HookEvent.HALT, lambda vm, reason: events.append(('halt', reason)))
+
+    getattr(vm, engine)()
+
+    assert events == [('call', 0x4, 0x10), ('ret', 0x13, 0x6), ('halt', cvm.HaltReason.HALT)]
+
+def test_memory_hooks_exclude_instruction_fetches(vm):
+
+    reads = list()
+    writes = list()
+
+    vm.add_hook(cvm.HookEvent.MEMORY_READ, lambda vm, addr, length: reads.append((addr, length)))
+    vm.add_hook(cvm.HookEvent.MEMORY_WRITE, lambda vm, addr, length: writes.append((addr, length)))
+
+    vm.run_program()
+
+    # out reads the string and its terminator, ret pops BP and IP
+    assert reads == [(0x2000, 4), (0x7ffb, 2), (0x7ffd, 2)]
+
+    # call pushes IP and BP
+    assert writes == [(0x7ffd, 2), (0x7ffb, 2)]
+
+def test_remove_hook_restores_fast_path(vm):
+
+    def hook(vm, addr, length):
+        pass
+
+    vm.add_hook(cvm.HookEvent.MEMORY_READ, hook)
+
+    assert vm.hooked
+    assert 'read_byte' in vars(vm.ram)
+
+    vm.remove_hook(cvm.HookEvent.MEMORY_READ, hook)
+
+    assert not vm.hooked
+    assert 'read_byte' not in vars(vm.ram)
+    assert 'read_word' not in vars(vm.ram)
@@ -0,0 +1,110 @@
+import mmap
+
+import pytest
+
+import cors_vm.image as image
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.paged_memory import CopyOnWriteMemory, SharedImage
+
+@pytest.fixture
+def challenge(challenge, exploit):
+    # The challenge from vm.py, with the exploit as user data
+    challenge.load_data((uint16_t(0x2000), exploit, "user_func"))
+
+    return challenge
+
+def test_anonymous_memory_behaves_like_bytearray_memory():
+
+    ram = cvm.RandomAccessMemory.anonymous(1024)
+
+    assert ram.mapped
+    assert len(ram) == 1024
+
+    ram.write_word((uint16_t(0x4142), uint16_t(0x10)))
+    ram.load(0x20, b'abc')
+
+    assert ram.read_word(uint16_t(0x10)).uint16 == 0x4142
+    assert ram.memory[0x20:0x23] == b'abc'
+
+    ram.reset()
+
+    assert bytes(ram.memory) == bytes(1024)
+
+def test_memory_buffer_must_match_size():
+
+    with pytest.raises(ValueError):
+        cvm.RandomAccessMemory(1024, bytearray(512))
+
+def test_image_round_trips_segments_and_memory(challenge, tmp_path):
+
+    path = image.write_image(challenge, tmp_path / 'challenge.img')
+    header = image.read_header(path)
+
+    assert header.offset % mmap.ALLOCATIONGRANULARITY == 0
+    assert header.ip == 0x1000
+    assert [s.name for s in header.code_segments] == [s.name for s in challenge.code_segments]
+    assert [s.start_addr.uint16 for s in header.data_segments] == [0x7337, 0x7237, 0x2000]
+
+    vm = image.load_image(path)
+
+    assert vm.ram.mapped
+    assert bytes(vm.ram.memory) == bytes(challenge.ram.memory)
+    assert vm.cpu.ip.uint16 == 0x1000
+
+def test_long_segment_names_are_cut_on_a_character_boundary(challenge, tmp_path):
+
+    # 254 bytes and then a two byte character
+    name = "a" * 254 + "ö" * 10
+    challenge.load_data((uint16_t(0x5000), b"data\x00", name))
+
+    header = image.read_header(image.write_image(challenge, tmp_path / 'challenge.img'))
+
+    assert header.data_segments[-1].name == "a" * 254
+
+def test_image_of_copy_on_write_memory(challenge, tmp_path):
+
+    vm = cvm.VirtualMachineV2(ram=CopyOnWriteMemory(SharedImage(bytes(challenge.ram.memory))))
+    vm.restore(challenge.snapshot())
+
+    path = image.write_image(vm, tmp_path / 'challenge.img')
+    loaded = image.load_image(path)
+
+    assert bytes(loaded.ram.memory) == bytes(challenge.ram.memory)
+
+    loaded.run_program()
+    assert "CORS_CTF{flag}" in loaded.stdout
+
+def test_mapped_image_runs_like_loaded_challenge(challenge, tmp_path, engine):
+
+    path = image.write_image(challenge, tmp_path / 'challenge.img')
+    vm = image.load_image(path)
+
+    getattr(challenge, engine)()
+    getattr(vm, engine)()
+
+    assert "CORS_CTF{flag}" in vm.stdout
+    assert vm.stdout == challenge.stdout
+    assert bytes(vm.ram.memory) == bytes(challenge.ram.memory)
+
+def test_private_mapping_does_not_change_image(challenge, tmp_path):
+
+    path = image.write_image(challenge, tmp_path / 'challenge.img')
+    contents = path.read_bytes()
+
+    first = image.load_image(path)
+    first.run_program()
+
+    second = image.load_image(path)
+
+    assert path.read_bytes() == contents
+    assert bytes(second.ram.memory) == bytes(challenge.ram.memory)
+
+def test_read_header_rejects_other_files(tmp_path):
+
+    path = tmp_path / 'other.img'
+    path.write_bytes(b'\x00' * 64)
+
+    with pytest.raises(ValueError):
+        image.read_header(path)
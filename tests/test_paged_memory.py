@@ -0,0 +1,102 @@
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.paged_memory import CopyOnWriteMemory, SharedImage
+
+@pytest.fixture
+def template(challenge, exploit):
+    # The challenge from vm.py, with the exploit as user data
+    challenge.load_data((uint16_t(0x2000), exploit, "user_func"))
+
+    return challenge
+
+def session(template, image):
+
+    vm = cvm.VirtualMachineV2(ram=CopyOnWriteMemory(image))
+    vm.restore(template.snapshot())
+
+    return vm
+
+def test_shared_image_stores_identical_pages_once():
+
+    image = SharedImage(bytes(4096))
+
+    assert len(image.pages) == 16
+    assert len(set(map(id, image.pages))) == 1
+
+def test_copy_on_write_memory_shares_pages_until_written():
+
+    image = SharedImage(b'\x01' * 1024)
+
+    first = CopyOnWriteMemory(image)
+    second = CopyOnWriteMemory(image)
+
+    first.write_byte((uint8_t(0x41), uint16_t(0x0101)))
+    first.write_word((uint16_t(0x4243), uint16_t(0x02ff)))
+
+    assert first.private_pages() == [1, 2, 3]
+    assert second.private_pages() == []
+
+    assert first.read_byte(uint16_t(0x0101)).uint8 == 0x41
+    assert first.read_word(uint16_t(0x02ff)).uint16 == 0x4243
+    assert second.read_byte(uint16_t(0x0101)).uint8 == 0x01
+    assert bytes(image.pages[1]) == b'\x01' * 256
+
+def test_paged_memory_view_behaves_like_bytearray():
+
+    ram = CopyOnWriteMemory(SharedImage(bytes(1024)))
+    reference = cvm.RandomAccessMemory(1024)
+
+    for memory in (ram, reference):
+        memory.load(0x00fe, b'\x01\x02\x03\x04')
+        memory.memory[0x03ff] = 0x05
+
+    assert ram.memory[0x00fd:0x0103] == bytes(reference.memory[0x00fd:0x0103])
+    assert ram.memory[-1] == 0x05
+    assert bytes(ram.memory) == bytes(reference.memory)
+
+    for (start, end) in ((0, 1024), (0x00ff, 1024), (0x0102, 1024), (0x0102, 0x0200)):
+        assert ram.memory.find(b'\x05', start, end) == reference.memory.find(b'\x05', start, end)
+        assert ram.memory.find(b'\x00', start, end) == reference.memory.find(b'\x00', start, end)
+
+    with pytest.raises(IndexError):
+        ram.memory[1024]
+
+    with pytest.raises(IndexError):
+        ram.read_word(uint16_t(0x03ff))
+
+def test_sessions_on_shared_image_run_like_private_memory(template, engine):
+
+    image = SharedImage.from_memory(template.ram)
+
+    reference = cvm.VirtualMachineV2()
+    reference.restore(template.snapshot())
+    getattr(reference, engine)()
+
+    first = session(template, image)
+    second = session(template, image)
+
+    getattr(first, engine)()
+
+    assert "CORS_CTF{flag}" in first.stdout
+    assert first.stdout == reference.stdout
+    assert bytes(first.ram.memory) == bytes(reference.ram.memory)
+
+    # Only the stack pages were copied
+    assert first.ram.private_pages() == [0x7e, 0x7f]
+    assert second.ram.private_pages() == []
+
+def test_restore_shares_pages_again(template):
+
+    image = SharedImage.from_memory(template.ram)
+
+    vm = session(template, image)
+    snapshot = vm.snapshot()
+
+    vm.run_program()
+    vm.restore(snapshot)
+
+    assert vm.ram.private_pages() == []
+    assert bytes(vm.ram.memory) == bytes(template.ram.memory)
@@ -0,0 +1,70 @@
+import itertools
+
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t
+from cors_vm.profiler import Profiler
+
+@pytest.fixture
+def vm():
+    # main_func() calls secret_func, which prints and returns
+    vm = cvm.VirtualMachineV2(trace=False)
+
+    vm.load_program((uint16_t(0x1000), b'\x08\x13\x37\x03\x09\x03\x00'), "main_func()")
+    vm.load_program((uint16_t(0x1337), b'\x03\x20\x00\x0a'), "secret_func")
+    vm.load_data((uint16_t(0x2000), b"Hej\x00", "greeting"))
+
+    vm.cpu.ip.uint16 = 0x1000
+
+    return vm
+
+@pytest.fixture
+def ticks():
+    # Timer advancing one second per call
+    counter = itertools.count()
+
+    return lambda: float(next(counter))
+
+def test_profiler_counts_per_ip_and_opcode(vm, engine, ticks):
+
+    with Profiler(vm, timer=ticks) as profiler:
+        getattr(vm, engine)()
+
+    assert not vm.hooked
+    assert vm.stdout == "Hej"
+
+    assert profiler.ip_counts == {0x1000: 1, 0x1004: 1, 0x1337: 1, 0x133a: 1, 0x1006: 1}
+    assert profiler.opcode_counts == {0x8: 1, 0x9: 1, 0x3: 1, 0xa: 1, 0x0: 1}
+    assert profiler.ip_times[0x1337] == 1.0
+
+    assert profiler.segment_totals() == {"main_func()": (3, 3.0), "secret_func": (2, 2.0)}
+
+def test_profiler_report(vm, ticks):
+
+    with Profiler(vm, timer=ticks) as profiler:
+        vm.run_program()
+
+    report = profiler.report()
+
+    assert report.startswith("Segment")
+    assert "main_func()" in report
+    assert "0x1337 secret_func" in report
+    assert "out" in report
+
+def test_profiler_collapsed_stacks(vm, ticks, tmp_path):
+
+    with Profiler(vm, timer=ticks) as profiler:
+        vm.run_program()
+
+    assert profiler.collapsed() == "main_func() 3\nmain_func();secret_func 2\n"
+    assert profiler.collapsed('time') == "main_func() 3000000\nmain_func();secret_func 2000000\n"
+
+    path = tmp_path / 'vm.collapsed'
+    profiler.write_collapsed(path)
+
+    assert path.read_text() == profiler.collapsed()
+
+    with pytest.raises(ValueError):
+        profiler.collapsed('cycles')
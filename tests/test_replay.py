@@ -0,0 +1,170 @@
+import io
+import time
+
+import pytest
+
+import cors_vm.replay as replay
+import cors_vm.state as state
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t
+from cors_vm.replay import Recorder, Replay, ReplayInput
+
+def record(vm, payload, **kwargs):
+    # Records a session where the payload arrives after the guest started
+    # waiting for it
+
+    log = io.BytesIO()
+
+    with Recorder(vm, log, **kwargs) as recorder:
+        assert recorder.run() == cvm.VMStatus.WAITING_INPUT
+
+        vm.input_device.feed(payload + b'\n')
+        recorder.run()
+
+    return Replay(*replay.read_log(log.getvalue()))
+
+def test_replay_reproduces_session(input_challenge, exploit, engine):
+
+    session = record(input_challenge, exploit, checkpoint_interval=50)
+
+    assert session.output == b"Anslutningen avslutas.CORS_CTF{flag}"
+    assert session.halt_reason == cvm.HaltReason.HALT
+    assert session.instruction_count == input_challenge.instruction_count
+
+    vm = session.replay(engine)
+
+    assert vm.stdout == input_challenge.stdout
+    assert bytes(vm.ram.memory) == bytes(input_challenge.ram.memory)
+    assert bytes(vm.cpu.register_file) == bytes(input_challenge.cpu.register_file)
+    assert vm.halt_reason == cvm.HaltReason.HALT
+
+def test_log_holds_events_and_checkpoints(input_challenge, exploit):
+
+    session = record(input_challenge, exploit, checkpoint_interval=50)
+    kinds = [record.kind for record in session.records]
+
+    assert kinds.count(replay.INPUT) == 1
+    assert kinds.count(replay.STOP) == 1
+    assert kinds.count(replay.CHECKPOINT) == 1 + input_challenge.instruction_count // 50
+
+    # Checkpoints after the first only hold what changed
+    (first, second) = [record for record in session.records if record.kind == replay.CHECKPOINT][:2]
+    assert len(second.payload) < len(first.payload)
+
+def test_seek_starts_from_nearest_checkpoint(input_challenge, exploit):
+
+    session = record(input_challenge, exploit, checkpoint_interval=50)
+
+    reference = session.seek(0)
+
+    for count in (0, 49, 50, 51, 120, 200):
+        reference.run(count - reference.instruction_count)
+
+        vm = session.seek(count)
+
+        assert vm.instruction_count == count
+        assert bytes(vm.ram.memory) == bytes(reference.ram.memory)
+        assert bytes(vm.cpu.register_file) == bytes(reference.cpu.register_file)
+        assert vm.stdout == reference.stdout
+
+    # Past the end of the recording the VM stops where the session did
+    assert session.seek(10 ** 6).instruction_count == input_challenge.instruction_count
+
+def test_time_limit_is_replayed_from_log():
+
+    # mov 0x0000 -> IP, forever
+    vm = cvm.VirtualMachineV2(b'\x08\x00\x00\x00', trace=False, max_run_time=0.0,
+                              time_check_interval=100)
+    log = io.BytesIO()
+
+    with Recorder(vm, log, checkpoint_interval=1000) as recorder:
+        recorder.run()
+
+    assert vm.halt_reason == cvm.HaltReason.TIME_LIMIT
+
+    session = Replay(*replay.read_log(log.getvalue()))
+    replayed = session.replay()
+
+    assert replayed.halt_reason == cvm.HaltReason.TIME_LIMIT
+    assert replayed.instruction_count == vm.instruction_count
+
+def test_time_limit_covers_every_checkpoint_slice():
+
+    # mov 0x0000 -> IP, forever, with checkpoints far more often than the
+    # instructions run within the time limit
+    vm = cvm.VirtualMachineV2(b'\x08\x00\x00\x00', trace=False, max_run_time=0.3,
+                              time_check_interval=100)
+    log = io.BytesIO()
+
+    started_at = time.time()
+
+    with Recorder(vm, log, checkpoint_interval=500) as recorder:
+        assert recorder.run() == cvm.VMStatus.HALTED
+
+    assert vm.halt_reason == cvm.HaltReason.TIME_LIMIT
+    assert time.time() - started_at < 3
+    assert vm.instruction_count > 500
+
+def test_truncated_log_is_read_up_to_last_record(input_challenge):
+
+    log = io.BytesIO()
+
+    recorder = Recorder(input_challenge, log, checkpoint_interval=50)
+    recorder.run()
+
+    data = log.getvalue()
+
+    (config, records) = replay.read_log(data[:-3])
+
+    assert config['checkpoint_interval'] == 50
+    assert len(records) == len(replay.read_log(data)[1]) - 1
+
+def test_replaying_vm_can_be_snapshot_and_saved(input_challenge, exploit):
+
+    session = record(input_challenge, exploit, checkpoint_interval=50)
+
+    vm = session.seek(0)
+    snapshot = vm.snapshot()
+    saved = state.dumps(vm)
+
+    vm.run()
+    assert vm.stdout == input_challenge.stdout
+
+    # The recorded input is still there after a restore and a load
+    vm.restore(snapshot)
+    vm.run()
+    assert vm.stdout == input_challenge.stdout
+
+    loaded = state.loads(saved, trace=False)
+    loaded.run()
+    assert loaded.stdout == input_challenge.stdout
+
+def test_replay_input_returns_recorded_pieces():
+
+    device = ReplayInput([b'a' * 4, b'b', b''])
+    device.feed(b'mer\n')
+
+    assert [device.readline(4) for _ in range(5)] == [b'aaaa', b'b', b'', b'mer', None]
+
+def test_recorder_flushes_every_slice(tmp_path):
+
+    # 0x0000: out 0x2000, loop
+    vm = cvm.VirtualMachineV2(b'\x03\x20\x00\x08\x00\x00\x00', trace=False)
+    vm.load_data((uint16_t(0x2000), b"hej\x00", "text"))
+
+    path = tmp_path / 'session.cvmr'
+    recorder = Recorder(vm, path, checkpoint_interval=1000)
+
+    recorder.run(10)
+
+    # Read while the recorder still has the file open
+    (_, records) = replay.read_log(path.read_bytes())
+    assert [record.payload for record in records if record.kind == replay.OUTPUT] == [b'hej'] * 5
+
+    recorder.close()
+
+def test_read_log_rejects_other_data():
+
+    with pytest.raises(ValueError):
+        replay.read_log(b'CVMS' + bytes(16))
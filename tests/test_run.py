@@ -0,0 +1,89 @@
+import pytest
+
+import cors_vm.state as state
+import cors_vm.virtual_machine as cvm
+
+@pytest.fixture
+def loop_program():
+    # mov 0x0000 IP, loops forever
+    return b'\x08\x00\x00\x00'
+
+def test_run_executes_bounded_slices(loop_program, engine_of):
+
+    vm = cvm.VirtualMachineV2(loop_program, trace=False)
+
+    for i in range(1, 4):
+        assert vm.run(100, engine_of(vm)) == cvm.VMStatus.RUNNING
+        assert vm.instruction_count == 100 * i
+
+    assert not vm.should_halt()
+    assert vm.cpu.ip.uint16 == 0x0000
+
+def test_instruction_budget_still_halts_sliced_run(loop_program, engine_of):
+
+    vm = cvm.VirtualMachineV2(loop_program, trace=False, max_instructions=250)
+
+    statuses = list(vm.steps(100, engine_of(vm)))
+
+    assert statuses == [cvm.VMStatus.RUNNING] * 2 + [cvm.VMStatus.HALTED]
+    assert vm.halt_reason == cvm.HaltReason.INSTRUCTION_LIMIT
+    assert vm.instruction_count == 250
+
+def test_run_waits_for_input_and_resumes(input_challenge, engine_of, exploit):
+
+    run = engine_of(input_challenge)
+
+    assert input_challenge.run(None, run) == cvm.VMStatus.WAITING_INPUT
+    assert input_challenge.cpu.ip.uint16 == 0x3737
+
+    # Nothing changes until a whole line is available
+    input_challenge.input_device.feed(exploit[:100])
+
+    assert input_challenge.run(None, run) == cvm.VMStatus.WAITING_INPUT
+    assert input_challenge.cpu.ip.uint16 == 0x3737
+
+    input_challenge.input_device.feed(exploit[100:] + b'\n')
+
+    assert input_challenge.run(None, run) == cvm.VMStatus.HALTED
+    assert input_challenge.stdout == "Anslutningen avslutas.CORS_CTF{flag}"
+
+def test_interleaved_vms_match_uninterrupted_run(input_challenge, engine_of, exploit):
+
+    reference = state.loads(state.dumps(input_challenge))
+    reference.input_device.feed(exploit + b'\n')
+    reference.run(None, engine_of(reference))
+
+    vms = [state.loads(state.dumps(input_challenge)) for _ in range(3)]
+    generators = [vm.steps(1, engine_of(vm)) for vm in vms]
+
+    for vm in vms:
+        vm.input_device.feed(exploit + b'\n')
+
+    for statuses in zip(*generators):
+        pass
+
+    for vm in vms:
+        assert vm.status == cvm.VMStatus.HALTED
+        assert vm.stdout == reference.stdout
+        assert vm.instruction_count == reference.instruction_count
+
+def test_exception_in_guest_is_reported_as_fault(engine_of):
+
+    # mov 0x8000 IP, beyond the end of memory
+    vm = cvm.VirtualMachineV2(b'\x08\x80\x00\x00', trace=False)
+
+    assert vm.run(None, engine_of(vm)) == cvm.VMStatus.FAULT
+    assert vm.halt_reason == cvm.HaltReason.FAULT
+    assert isinstance(vm.fault, IndexError)
+    assert vm.instruction_count == 1
+
+def test_waiting_vm_state_includes_pending_input(input_challenge, exploit):
+
+    input_challenge.input_device.feed(exploit[:100])
+    input_challenge.run()
+
+    vm = state.loads(state.dumps(input_challenge))
+    vm.input_device.feed(exploit[100:] + b'\n')
+
+    assert vm.run() == cvm.VMStatus.HALTED
+    assert vm.stdout == "Anslutningen avslutas.CORS_CTF{flag}"
@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+
+import cors_vm.image as image
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.server import VMServer
+
+@pytest.fixture
+def spinning_image(tmp_path):
+    # Prints a greeting and then loops forever
+    vm = cvm.VirtualMachineV2(b'\x03\x01\x00\x08\x00\x03\x00')
+    vm.load_data((uint16_t(0x0100), b"hej\x00", "greeting"))
+
+    return image.write_image(vm, tmp_path / 'spinning.img')
+
+async def connect(server, data=b''):
+
+    (reader, writer) = await asyncio.open_connection(server.host, server.port)
+
+    writer.write(data)
+    await writer.drain()
+
+    return (reader, writer)
+
+def serve(server, client):
+    # Runs client(server) against the started server
+
+    async def main():
+        await server.start()
+
+        try:
+            return await asyncio.wait_for(client(server), 10)
+        finally:
+            server._server.close()
+
+    return asyncio.run(main())
+
+def test_server_runs_exploit_sent_by_client(challenge_image, exploit):
+
+    async def client(server):
+        (reader, writer) = await connect(server)
+
+        # The guest waits for input, send it in two parts
+        writer.write(exploit[:100])
+        await asyncio.sleep(0.05)
+        writer.write(exploit[100:] + b'\n')
+
+        return await reader.read()
+
+    server = VMServer(challenge_image, port=0)
+
+    assert serve(server, client) == b"Anslutningen avslutas.CORS_CTF{flag}"
+    assert server.sessions == set()
+
+def test_spinning_guest_does_not_starve_other_sessions(challenge_image, spinning_image, exploit):
+
+    spinning = VMServer(spinning_image, port=0, slice_steps=64, max_instructions=200000)
+    server = VMServer(challenge_image, port=0, slice_steps=64)
+
+    async def client(server):
+        await spinning.start()
+
+        try:
+            # Keep the writer, the session ends once the client disconnects
+            (spin_reader, spin_writer) = await connect(spinning)
+            assert await spin_reader.readexactly(3) == b'hej'
+
+            (reader, writer) = await connect(server, exploit + b'\n')
+            output = await reader.read()
+
+            # The spinning guest is still running
+            assert len(spinning.sessions) == 1
+
+            await spin_reader.read()
+
+            return output
+        finally:
+            spinning._server.close()
+
+    assert serve(server, client) == b"Anslutningen avslutas.CORS_CTF{flag}"
+
+def test_session_budgets_end_session(spinning_image):
+
+    async def client(server):
+        (reader, _) = await connect(server)
+
+        return await reader.read()
+
+    server = VMServer(spinning_image, port=0, max_instructions=5000)
+    assert serve(server, client) == b'hej'
+
+    server = VMServer(spinning_image, port=0, max_output_bytes=2)
+    assert serve(server, client) == b'he'
+
+    server = VMServer(spinning_image, port=0, max_session_time=0.1)
+    assert serve(server, client) == b'hej'
+
+def test_closed_input_ends_waiting_guest(challenge_image):
+
+    async def client(server):
+        (reader, writer) = await connect(server, b'kort')
+        writer.write_eof()
+
+        return await reader.read()
+
+    assert serve(VMServer(challenge_image, port=0), client) == b"Anslutningen avslutas."
+
+def test_disconnected_client_ends_session(spinning_image):
+
+    async def client(server):
+        (reader, writer) = await connect(server)
+        assert await reader.readexactly(3) == b'hej'
+
+        assert len(server.sessions) == 1
+
+        # Leave while the guest is still running
+        writer.close()
+        await writer.wait_closed()
+
+        while server.sessions:
+            await asyncio.sleep(0.01)
+
+    server = VMServer(spinning_image, port=0, slice_steps=64)
+
+    serve(server, client)
+
+    assert server.sessions == set()
+
+def test_session_memory_is_unmapped_when_session_ends(challenge_image):
+
+    vms = list()
+
+    class TrackingServer(VMServer):
+
+        def new_vm(self, writer):
+            vms.append(super().new_vm(writer))
+            return vms[-1]
+
+    async def client(server):
+        (reader, writer) = await connect(server, b'kort\n')
+
+        return await reader.read()
+
+    assert serve(TrackingServer(challenge_image, port=0), client) == b"Anslutningen avslutas."
+
+    (vm, ) = vms
+    assert vm.ram.mapped and vm.ram.memory.closed
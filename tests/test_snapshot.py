@@ -0,0 +1,152 @@
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+
+def run_with(vm, payload, engine):
+
+    vm.load_data((uint16_t(0x2000), payload, "user_func"))
+    getattr(vm, engine)()
+
+    return (vm.stdout, vm.halt_reason, vm.instruction_count, bytes(vm.cpu.register_file))
+
+def test_restore_returns_vm_to_snapshot(challenge, engine, exploit):
+
+    snapshot = challenge.snapshot()
+    memory = bytes(challenge.ram.memory)
+
+    first = run_with(challenge, exploit, engine)
+
+    assert "CORS_CTF{flag}" in first[0]
+
+    challenge.restore(snapshot)
+
+    assert bytes(challenge.ram.memory) == memory
+    assert challenge.stdout == ""
+    assert challenge.halt_reason is None
+    assert challenge.cpu.ip.uint16 == 0x1000
+    assert [segment.name for segment in challenge.data_segments] == ["cors_flag", "con_close"]
+
+    assert run_with(challenge, exploit, engine) == first
+
+def test_restore_replays_different_payloads(challenge, engine, exploit):
+
+    snapshot = challenge.snapshot()
+
+    for payload in (b'A' * 16 + b'\x00', exploit, b'\x00'):
+        challenge.restore(snapshot)
+        result = run_with(challenge, payload, engine)
+
+        fresh = cvm.VirtualMachineV2()
+        fresh.restore(snapshot)
+
+        assert run_with(fresh, payload, engine) == result
+
+def test_restore_copies_all_memory_at_once(challenge, exploit):
+
+    snapshot = challenge.snapshot()
+
+    run_with(challenge, exploit, "run_program")
+
+    assert challenge.ram.restore(snapshot.memory) == 128
+    assert bytes(challenge.ram.memory) == snapshot.memory
+    assert challenge._decode_cache == {}
+
+    assert challenge.ram.restore(snapshot.memory) == 0
+
+def test_restore_only_copies_changed_pages(challenge, exploit):
+
+    challenge.ram.track_dirty()
+    snapshot = challenge.snapshot()
+
+    run_with(challenge, exploit, "run_program")
+
+    # The payload at 0x2000 spans two pages, the stack another two
+    assert challenge.ram.restore(snapshot.memory) == 4
+    assert challenge.ram.restore(snapshot.memory) == 0
+
+def test_restore_keeps_unchanged_decoded_instructions(challenge, exploit):
+
+    challenge.ram.track_dirty()
+    snapshot = challenge.snapshot()
+
+    run_with(challenge, exploit, "run_program")
+
+    # The injected code runs from the stack
+    assert 0x7f00 in challenge._decode_cache
+
+    challenge.restore(snapshot)
+
+    assert 0x1000 in challenge._decode_cache
+    assert 0x7f00 not in challenge._decode_cache
+
+def test_dirty_pages_cover_all_kinds_of_writes():
+
+    ram = cvm.RandomAccessMemory(4096)
+    ram.track_dirty()
+
+    ram.write_byte((uint8_t(1), uint16_t(0x0010)))
+    ram.write_word((uint16_t(0x0102), uint16_t(0x02ff)))
+    ram.load(0x0800, b'\x01' * 300)
+
+    assert ram.dirty_pages() == [0x0, 0x2, 0x3, 0x8, 0x9]
+
+    ram.clear_dirty()
+
+    assert ram.dirty_pages() == []
+
+def test_dirty_pages_wrap_around_end_of_memory():
+
+    ram = cvm.RandomAccessMemory(1024)
+    ram.track_dirty()
+
+    ram.write_word((uint16_t(0x0102), uint16_t(0x03ff)))
+
+    assert ram.dirty_pages() == [0x0, 0x3]
+
+def test_dirty_pages_include_fast_engine_writes(engine):
+
+    vm = cvm.VirtualMachineV2(track_dirty=True)
+
+    # mov 0x0041 -> Reg01, push Reg01, m_byte 0x42 -> 0x1000, halt
+    vm.load_program((uint16_t(0x0000), b'\x08\x00\x41\x03\x06\x03\x05\x42\x10\x00\x00'))
+    vm.ram.clear_dirty()
+
+    getattr(vm, engine)()
+
+    assert vm.ram.dirty_pages() == [0x10, 0x7f]
+
+def test_diff_against_baseline(challenge):
+
+    challenge.ram.track_dirty()
+    baseline = challenge.ram.snapshot()
+
+    run_with(challenge, b'A' * 3 + b'\x00', "run_program")
+    diff = challenge.ram.diff(baseline)
+
+    assert diff[0] == (0x2000, b'AAA')
+    assert sum(len(data) for (addr, data) in diff) < 300
+
+    # The same diff without tracking
+    assert challenge.ram.diff(bytes(baseline)) == diff
+
+    fresh = cvm.RandomAccessMemory(len(challenge.ram))
+    fresh.load(0, baseline)
+    fresh.apply_diff(diff)
+
+    assert bytes(fresh.memory) == bytes(challenge.ram.memory)
+
+def test_restore_with_dirty_tracking_only_compares_dirty_pages(challenge, exploit):
+
+    challenge.ram.track_dirty()
+    snapshot = challenge.snapshot()
+
+    run_with(challenge, exploit, "run_program")
+
+    assert len(challenge.ram.dirty_pages()) == 4
+
+    challenge.restore(snapshot)
+
+    assert challenge.ram.dirty_pages() == []
+    assert bytes(challenge.ram.memory) == snapshot.memory
@@ -0,0 +1,88 @@
+import pytest
+
+import cors_vm.state as state
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.paged_memory import CopyOnWriteMemory, SharedImage
+
+def segments(segments):
+    return [(s.name, s.start_addr.uint16, s.length) for s in segments]
+
+def vm_state(vm):
+    return (bytes(vm.ram.memory), bytes(vm.cpu.register_file),
+            segments(vm.code_segments), segments(vm.data_segments),
+            vm.should_halt(), vm.halt_reason, vm.stdout, vm.instruction_count, vm.memory_writes)
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_loads_recreates_dumped_vm(challenge, compress, exploit):
+
+    challenge.load_data((uint16_t(0x2000), exploit, "user_func"))
+    challenge.max_instructions = 70
+    challenge.run_program()
+
+    vm = state.loads(state.dumps(challenge, compress=compress))
+
+    assert vm_state(vm) == vm_state(challenge)
+    assert vm.halt_reason == cvm.HaltReason.INSTRUCTION_LIMIT
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_copy_on_write_memory_round_trips(challenge, compress, exploit):
+
+    vm = cvm.VirtualMachineV2(ram=CopyOnWriteMemory(SharedImage(challenge.ram.memory)))
+    vm.restore(challenge.snapshot())
+    vm.load_data((uint16_t(0x2000), exploit, "user_func"))
+
+    loaded = state.loads(state.dumps(vm, compress=compress))
+
+    assert vm_state(loaded) == vm_state(vm)
+
+    loaded.run_program()
+    assert "CORS_CTF{flag}" in loaded.stdout
+
+def test_resumed_vm_finishes_like_uninterrupted_run(challenge, engine, exploit):
+
+    challenge.load_data((uint16_t(0x2000), exploit, "user_func"))
+    data = state.dumps(challenge)
+
+    vm = state.loads(data)
+    getattr(challenge, engine)()
+    getattr(vm, engine)()
+
+    assert "CORS_CTF{flag}" in vm.stdout
+    assert vm_state(vm) == vm_state(challenge)
+
+def test_dumps_against_baseline_stores_only_changes(challenge, exploit):
+
+    baseline = challenge.ram.snapshot()
+    full = state.dumps(challenge, compress=False)
+
+    challenge.load_data((uint16_t(0x2000), exploit, "user_func"))
+    challenge.run_program()
+
+    data = state.dumps(challenge, baseline, compress=False)
+
+    assert len(data) < len(full) - len(challenge.ram) + 1024
+
+    vm = state.loads(data, baseline=baseline)
+
+    assert vm_state(vm) == vm_state(challenge)
+
+    with pytest.raises(ValueError):
+        state.loads(data)
+
+def test_loads_into_existing_vm(challenge):
+
+    data = state.dumps(challenge)
+    target = cvm.VirtualMachineV2(trace=False)
+
+    assert state.loads(data, target) is target
+    assert vm_state(target) == vm_state(challenge)
+
+    with pytest.raises(ValueError):
+        state.loads(data, cvm.VirtualMachineV2(memory_size=1024))
+
+def test_loads_rejects_other_data():
+
+    with pytest.raises(ValueError):
+        state.loads(b'\x00' * 64)
@@ -0,0 +1,53 @@
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.trace import TRACE_HEADER
+
+@pytest.fixture
+def default_program():
+    return b'\x08\x00\x41\x03\x90\x90\x00'
+
+def test_trace_records_executed_instructions(default_program):
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    assert list(vm.trace.entries()) == [(0x0, 0x8, 0x41, 0x3),
+                                        (0x4, 0x90, 0, 0),
+                                        (0x5, 0x90, 0, 0),
+                                        (0x6, 0x0, 0, 0)]
+
+def test_trace_renders_table_on_demand(default_program):
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    lines = vm.output.splitlines()
+
+    assert vm.output.startswith(TRACE_HEADER)
+    assert lines[2] == "0x0        mov            0x41 0x3       "
+    assert lines[5] == "0x6        halt           "
+
+def test_trace_ring_buffer_keeps_last_entries(default_program):
+
+    vm = cvm.VirtualMachineV2(trace_limit=2)
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    assert len(vm.trace) == 2
+    assert vm.trace.dropped == 2
+    assert [entry[0] for entry in vm.trace.entries()] == [0x5, 0x6]
+
+def test_trace_can_be_turned_off(default_program):
+
+    vm = cvm.VirtualMachineV2(trace=False)
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    assert vm.trace is None
+    assert vm.output == ""
+    assert vm.cpu.reg01.uint16 == 0x41
@@ -0,0 +1,138 @@
+import pytest
+
+import cors_vm.virtual_machine as cvm
+
+from cors_vm.base_types import uint16_t, uint8_t
+from cors_vm.translator import compile_block, decode_block
+
+@pytest.fixture
+def call_program():
+    # Call function at address placed in Reg01
+    return b'\x08\x37\x37\x03\x09\x03\x08\x00\x41\x03\x00'
+
+@pytest.fixture
+def subroutine():
+
+    return b'\x03\x13\x37\x0A'
+
+def test_decode_block_ends_at_call(call_program):
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x0000), call_program))
+
+    block = decode_block(vm, 0x0000)
+
+    assert [i.opcode for i in block.instructions] == [0x8, 0x9]
+    assert block.length == 6
+
+def test_decode_block_ends_at_mov_to_instruction_pointer():
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x0000), b'\x90\x08\x10\x00\x00\x90\x00'))
+
+    block = decode_block(vm, 0x0000)
+
+    assert [i.opcode for i in block.instructions] == [0x90, 0x8]
+
+def test_run_blocks_matches_run_program(call_program, subroutine):
+
+    results = []
+    for engine in ('run_program', 'run_blocks'):
+        vm = cvm.VirtualMachineV2()
+
+        CORS_FLAG = b"CORS_CTF{03783743}\x00"
+        vm.load_data((uint16_t(0x1337), CORS_FLAG, "cors_flag"))
+        vm.load_program((uint16_t(0x3737), subroutine), "secret_func")
+        vm.load_program((uint16_t(0x0000), call_program))
+
+        getattr(vm, engine)()
+
+        results.append((vm.stdout, vm.cpu.reg01.uint16, vm.cpu.ip.uint16,
+                        vm.cpu.sp.uint16, bytes(vm.ram.memory)))
+
+    assert results[0] == results[1]
+    assert "CORS_CTF" in results[1][0]
+
+def test_translator_finds_blocks_in_code_segments(call_program, subroutine):
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x3737), subroutine), "secret_func")
+    vm.load_program((uint16_t(0x0000), call_program))
+
+    starts = [block.start for block in vm.translator.find_blocks()]
+
+    assert starts == [0x3737, 0x0000, 0x0006]
+
+def test_write_invalidates_translated_block():
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x0000), b'\x08\x00\x41\x03\x00'))
+    vm.run_blocks()
+
+    assert 0x0000 in vm.translator.blocks
+
+    vm.ram.write_word((uint16_t(0x0042), uint16_t(0x0001)))
+
+    assert 0x0000 not in vm.translator.blocks
+
+    vm._should_halt = False
+    vm.cpu.ip.uint16 = 0x0000
+    vm.run_blocks()
+
+    assert vm.cpu.reg01.uint16 == 0x42
+
+def test_block_stops_when_it_overwrites_itself():
+
+    vm = cvm.VirtualMachineV2()
+
+    # m_word 0x0041 -> 0x0007 patches the argument of the following mov
+    program = b'\x04\x00\x41\x00\x07\x90\x08\x00\x00\x03\x00'
+    vm.load_program((uint16_t(0x0000), program))
+    vm.run_blocks()
+
+    assert vm.cpu.reg01.uint16 == 0x41
+
+def test_run_blocks_reports_invalid_instruction():
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x0000), b'\x90\xff'))
+    vm.run_blocks()
+
+    assert "Ogiltig instruktion (0xff)" in vm.stdout
+
+def test_compiled_blocks_are_shared_between_vms():
+
+    blocks = list()
+
+    for program in (b'\x90\x90\x00', b'\x90\x90\x00', b'\x90\x00'):
+        vm = cvm.VirtualMachineV2(program, trace=False)
+        blocks.append((vm, compile_block(vm, decode_block(vm, 0x0000))))
+
+    ((first_vm, first), (second_vm, second), (_, other)) = blocks
+
+    # The same code is compiled once and bound to each VM
+    assert first is not second
+    assert first.__code__ is second.__code__
+    assert other.__code__ is not first.__code__
+
+    assert second(second_vm.translator) == 3
+    assert second_vm.cpu.ip.uint16 == 0x3
+    assert first_vm.cpu.ip.uint16 == 0x0
+
+def test_writes_only_check_pages_holding_blocks():
+
+    vm = cvm.VirtualMachineV2()
+    vm.load_program((uint16_t(0x0000), b'\x08\x00\x41\x03\x00'))
+    vm.run_blocks()
+
+    pages = bytes(vm.translator._block_pages)
+
+    # A write to a page without blocks keeps the cached ones
+    vm.ram.write_word((uint16_t(0x0001), uint16_t(0x4000)))
+
+    assert 0x0000 in vm.translator.blocks
+    assert bytes(vm.translator._block_pages) == pages
+
+    vm.translator.flush()
+
+    assert not any(vm.translator._block_pages)
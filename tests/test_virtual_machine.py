@@ -37,7 +37,7 @@ def test_virtual_machine_can_start_without_program():
 
     assert vm.ram.read_byte(uint16_t(0x0000)).uint8 == 0
 
-def test_virtual_machine_can_load_program_at_0x0000(default_program):
+def test_virtual_machine_can_load_program_at_0x0000(default_program, engine):
 
     vm = cvm.VirtualMachineV2()
 
@@ -48,7 +48,7 @@ def test_virtual_machine_can_load_program_at_0x0000(default_program):
     program = (uint16_t(0x0000), default_program)
     vm.load_program(program)
 
-    vm.run_program()
+    getattr(vm, engine)()
 
     assert vm.cpu.reg01.uint16 == 65
 
@@ -62,7 +62,7 @@ def test_virtual_machine_provides_code_segment_length_value(default_program):
 
     assert vm.code_segments[0].length == 5
 
-def test_virtual_machine_can_load_program_at_0x1000(default_program):
+def test_virtual_machine_can_load_program_at_0x1000(default_program, engine):
 
     vm = cvm.VirtualMachineV2()
 
@@ -73,7 +73,7 @@ def test_virtual_machine_can_load_program_at_0x1000(default_program):
     program = (uint16_t(0x1000), default_program)
     vm.load_program(program)
 
-    vm.run_program()
+    getattr(vm, engine)()
 
     assert vm.cpu.reg01.uint16 == 65
 
@@ -114,7 +114,7 @@ def test_virtual_machine_can_load_multiple_data_sets_into_memory():
     assert "second_string" in data_strings
 
 
-def test_virtual_machine_can_run_subroutine_from_main_program(call_program, subroutine):
+def test_virtual_machine_can_run_subroutine_from_main_program(call_program, subroutine, engine):
 
     vm = cvm.VirtualMachineV2()
 
@@ -125,7 +125,7 @@ def test_virtual_machine_can_run_subroutine_from_main_program(call_program, subr
     program = (uint16_t(0x0000), call_program)
     vm.load_program(program)
     
-    vm.run_program()
+    getattr(vm, engine)()
         
     assert "CORS_CTF" in vm.stdout
     assert 0x41 == vm.cpu.reg01.uint16
@@ -156,4 +156,160 @@ def test_virtual_machine_crashes_with_vulnerable_input(program_with_input):
 
     # If the function works properly it should copy
     assert vm.ram.memory[0x7efe] == 0x43
-    assert vm.ram.memory[0x7eff] == 0x4f
\ No newline at end of file
+    assert vm.ram.memory[0x7eff] == 0x4f
+
+def test_virtual_machine_caches_decoded_instructions(default_program):
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    # mov at 0x0000 and halt at 0x0004
+    assert sorted(vm._decode_cache.keys()) == [0x0000, 0x0004]
+
+def test_virtual_machine_write_invalidates_decoded_instructions(default_program):
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    assert vm.cpu.reg01.uint16 == 0x41
+
+    # Overwrite the argument of the cached mov instruction
+    vm.ram.write_word((uint16_t(0x0042), uint16_t(0x0001)))
+
+    assert 0x0000 not in vm._decode_cache
+
+    vm._should_halt = False
+    vm.cpu.ip.uint16 = 0x0000
+    vm.run_program()
+
+    assert vm.cpu.reg01.uint16 == 0x42
+
+def test_virtual_machine_runs_without_decode_cache(default_program):
+
+    vm = cvm.VirtualMachineV2(decode_cache=False)
+
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    assert vm.cpu.reg01.uint16 == 0x41
+    assert len(vm._decode_cache) == 0
+
+@pytest.fixture
+def print_loop():
+    # Set Reg01 to 0x0000, print the string at 0x1000 and call 0x0000 again
+    return b'\x08\x00\x00\x03\x03\x10\x00\x09\x03'
+
+def test_virtual_machine_reports_halt_reason(default_program, engine):
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.load_program((uint16_t(0x0000), default_program))
+    getattr(vm, engine)()
+
+    assert vm.halt_reason == cvm.HaltReason.HALT
+    assert vm.instruction_count == 2
+
+def test_virtual_machine_stops_at_instruction_limit(engine):
+
+    vm = cvm.VirtualMachineV2(max_instructions=5)
+
+    vm.load_program((uint16_t(0x0000), b'\x90' * 100 + b'\x00'))
+    getattr(vm, engine)()
+
+    assert vm.halt_reason == cvm.HaltReason.INSTRUCTION_LIMIT
+    assert vm.instruction_count == 5
+    assert vm.cpu.ip.uint16 == 5
+
+def test_virtual_machine_stops_at_output_limit(engine, print_loop):
+
+    vm = cvm.VirtualMachineV2(max_output_bytes=20)
+
+    vm.load_data((uint16_t(0x1000), b"CORS\x00", "message"))
+    vm.load_program((uint16_t(0x0000), print_loop))
+    getattr(vm, engine)()
+
+    assert vm.halt_reason == cvm.HaltReason.OUTPUT_LIMIT
+    assert vm.stdout == "CORS" * 5
+
+def test_virtual_machine_stops_at_memory_write_limit(print_loop, engine):
+
+    vm = cvm.VirtualMachineV2(max_memory_writes=10)
+
+    vm.load_data((uint16_t(0x1000), b"CORS\x00", "message"))
+    vm.load_program((uint16_t(0x0000), print_loop))
+    getattr(vm, engine)()
+
+    # Every call pushes IP and BP
+    assert vm.halt_reason == cvm.HaltReason.MEMORY_WRITE_LIMIT
+    assert vm.memory_writes == 12
+    assert vm.instruction_count == 18
+
+def test_virtual_machine_checks_time_limit_every_interval(print_loop):
+
+    vm = cvm.VirtualMachineV2(max_run_time=0.0, time_check_interval=10)
+
+    vm.load_data((uint16_t(0x1000), b"CORS\x00", "message"))
+    vm.load_program((uint16_t(0x0000), print_loop))
+    vm.run_program()
+
+    assert vm.halt_reason == cvm.HaltReason.TIME_LIMIT
+    assert vm.instruction_count == 10
+
+def test_ram_loads_any_buffer():
+
+    import mmap
+    from array import array
+
+    ram = cvm.RandomAccessMemory(64)
+
+    assert ram.load(0, b'\x01\x02') == 2
+    assert ram.load(2, bytearray(b'\x03')) == 1
+    assert ram.load(3, memoryview(b'\x04\x05')[1:]) == 1
+
+    buffer = mmap.mmap(-1, 4)
+    buffer.write(b'\x06\x07\x08\x09')
+    assert ram.load(4, buffer) == 4
+
+    assert ram.load(8, array('B', [10, 11])) == 2
+
+    assert bytes(ram.memory[0:10]) == b'\x01\x02\x03\x05\x06\x07\x08\x09\x0a\x0b'
+
+def test_ram_read_word_stops_at_end_of_memory():
+
+    ram = cvm.RandomAccessMemory(1024)
+    ram.load(0x3fe, b'\x41\x42')
+
+    assert ram.read_word(uint16_t(0x3fe)).uint16 == 0x4142
+
+    # Addresses past the end wrap around
+    assert ram.read_word(uint16_t(0x7fe)).uint16 == 0x4142
+
+    with pytest.raises(IndexError):
+        ram.read_word(uint16_t(0x3ff))
+
+def test_ram_load_checks_bounds_once():
+
+    ram = cvm.RandomAccessMemory(16)
+
+    with pytest.raises(ValueError):
+        ram.load(15, b'\x01\x02')
+
+    assert bytes(ram.memory) == bytes(16)
+
+def test_load_data_invalidates_decoded_instructions(default_program):
+
+    vm = cvm.VirtualMachineV2()
+
+    vm.load_program((uint16_t(0x0000), default_program))
+    vm.run_program()
+
+    vm.load_data((uint16_t(0x0001), b'\x00\x42', "patch"))
+    vm._should_halt = False
+    vm.cpu.ip.uint16 = 0x0000
+    vm.run_program()
+
+    assert vm.cpu.reg01.uint16 == 0x42
@@ -1,5 +1,5 @@
-import virtual_machine as cvm
-from base_types import uint16_t, uint8_t
+import cors_vm.virtual_machine as cvm
+from cors_vm.base_types import uint16_t, uint8_t
 
 # Anropa metod på minnesadress 0x3737
 main_program = b'\x08\x37\x37\x03\x09\x03\x00'
@@ -32,7 +32,8 @@ buf += code + b'\x7f\x00\x7f\x00'
 
 vm.load_data((uint16_t(0x2000), buf, "user_func"))
 
-vm.run_program()
+# A single short run, translating blocks costs more than it saves here
+vm.run_fast()
 
 
 print(vm.stdout)
\ No newline at end of file